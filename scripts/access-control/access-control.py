@@ -1,82 +1,279 @@
 #!/usr/bin/env python3
 
 import yaml
-import subprocess
+import os
 import sys
 import getopt
 import json
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# The command runner is shared with the image scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'images'))
+import ibmapi  # noqa: E402
+import runner  # noqa: E402
 
 help_message = """access-control.py -k <apiKey> -f <access-bindings-file>
 
 -k, --apiKey                       apikey from the IBM Cloud IAM
 -b, --access-bindings              access binding file which contains the users and the access controls(groups)
+    --cli                          use the ibmcloud CLI instead of the IBM Cloud REST APIs
+    --apiEndpoint                  base URL replacing the IBM Cloud API endpoints (e.g. a local test server)
+    --prune                        remove the access group members that are not in the access binding file
+-j, --maxJobs                      number of invites and group changes run at the same time (default: 8)
 -h, --help                         print help
 """
 
-existing_users = []
+# Concurrent invites and group changes, each retried with exponential backoff
+WORKERS = 8
+RETRIES = 5
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 60
+# Members added to an access group per REST request, the CLI adds them one by one
+MAX_MEMBERS_PER_ADD = 50
+# Throttling, server side and network errors in the ibmcloud CLI output
+RETRYABLE = re.compile(r"\b(HTTP|status( code)?):? *(429|5\d\d)\b|too many requests|rate limit|timed? ?out|"
+                       r"temporarily|connection reset", re.IGNORECASE)
+# Errors of an operation that has been done already
+# A REST conflict is told by its HTTP status (ApiError.status), not by this text
+ALREADY_DONE = re.compile(r"already (exists|invited|a member|in the account)", re.IGNORECASE)
+
+existing_users = set()
+# IAM ID of the users, the REST API adds group members by IAM ID
+iam_ids = {}
+# REST client, the ibmcloud CLI is used when None
+api = None
 
 
 def get_existing_users(pull=False):
-    global existing_users
-    if pull:
+    if pull and api:
+        try:
+            users = api.users()
+        except ibmapi.ApiError as e:
+            raise Exception("Failed to get the users list from IBM cloud", e)
+        for user in users:
+            existing_users.add(user["user_id"])
+            iam_ids[user["user_id"]] = user.get("iam_id")
+    elif pull:
         out, err, ret = exec_cmd(["ibmcloud", "account", "users", "--output", "JSON"])
         if ret != 0:
             raise Exception("Failed to get the users list from IBM cloud", out, err)
         users = json.loads(out)
         for user in users:
-            existing_users.append(user["userId"])
+            existing_users.add(user["userId"])
+            iam_ids[user["userId"]] = user.get("ibmUniqueId")
     return existing_users
 
 
+def get_group_members(group):
+    """User IDs of the users in the access group."""
+    if api:
+        try:
+            members = api.group_members(group)
+        except ibmapi.ApiError as e:
+            raise Exception("Failed to get the members of", group, e)
+    else:
+        out, err, ret = exec_cmd(["ibmcloud", "iam", "access-group-users", group, "--output", "JSON"])
+        if ret != 0:
+            raise Exception("Failed to get the members of", group, out, err)
+        members = json.loads(out or "[]")
+    # The bindings list user IDs, which need not be the email (federated IDs), the IAM ID tells the user apart
+    users_by_iam_id = {iam_id: user for user, iam_id in iam_ids.items() if iam_id}
+    users = set()
+    for member in members:
+        if member.get("type", "user") != "user":
+            continue
+        iam_id = member.get("iam_id") or member.get("ibmUniqueId")
+        users.add(users_by_iam_id.get(iam_id) or member.get("userId") or member.get("email") or iam_id)
+    return users
+
+
 def exec_cmd(cmd):
-    cp = subprocess.run(cmd, universal_newlines=True,
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return cp.stdout, cp.stderr, cp.returncode
+    # Callers parse the JSON output, so keep all of it and stay quiet (login carries the apikey)
+    return runner.exec_cmd(cmd, capture=True, echo=False)
 
 def ibmcloud_login(apiKey):
     return exec_cmd(["ibmcloud", "login", "--apikey", apiKey, "--no-region", "-q"])
 
-def sync(access_bindings_file):
-    invitation_failed_users = []
-    access_group_failed_users = []
+def plan_sync(data, prune=False):
+    """Operations bringing the account and its access groups to the bindings.
+
+    Returns the users to invite, and per group the users to add and, with
+    prune, the members to remove.
+    """
     get_existing_users(pull=True)
+    wanted = {}
+    for group in data["groups"]:
+        wanted.setdefault(group["name"], set()).update(group["users"] or [])
+    invites = sorted(set().union(*wanted.values()) - existing_users)
+    changes = []
+    for group, users in wanted.items():
+        present = get_group_members(group)
+        missing = users - present
+        extra = present - users if prune else set()
+        print("group:", group, "members:", len(present & users), "present,", len(missing), "missing,",
+              len(present - users), "not in the bindings" + (", removing them" if prune and extra else ""))
+        changes.append((group, sorted(missing), sorted(extra)))
+    return invites, changes
+
+class Operation:
+    """One invite, group addition or removal, retried until it succeeds or fails for good."""
+
+    def __init__(self, description, func, *args, users=()):
+        """users are the users the operation is about, func can narrow the list down to those left to do."""
+        self.description = description
+        self.func = func
+        self.args = args
+        self.users = users
+        self.attempts = 0
+        self.error = None
+
+    def attempt(self):
+        """(done, retryable) of one more call."""
+        self.attempts += 1
+        status = None
+        try:
+            out, err, ret = self.func(*self.args)
+        except ibmapi.ApiError as e:
+            out, err, ret, status = "", str(e), 1, e.status
+        if ret == 0:
+            return True, False
+        message = "{} {}".format(out, err)
+        # The text tells about a single user only, one line of it must not settle a whole batch
+        if status == 409 or (len(self.users) <= 1 and ALREADY_DONE.search(message)):
+            # An earlier attempt went through before its answer got lost
+            return True, False
+        self.error = message.strip()
+        if status is not None:
+            return False, status == 429 or status >= 500
+        return False, bool(RETRYABLE.search(message))
+
+
+def run(operation, retries):
+    delay = RETRY_DELAY
+    while True:
+        done, retryable = operation.attempt()
+        if done or not retryable or operation.attempts > retries:
+            return done
+        time.sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+def execute(operations, workers=WORKERS, retries=RETRIES):
+    """Run the operations on a pool of workers, return the failed ones."""
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run, operation, retries): operation for operation in operations}
+        for future in as_completed(futures):
+            operation = futures[future]
+            if future.result():
+                print(operation.description, "done")
+            else:
+                print(operation.description, "failed after", operation.attempts, "attempts:", operation.error)
+                failed.append(operation)
+    return failed
+
+def sync(access_bindings_file, prune=False, workers=WORKERS):
     with open(access_bindings_file) as f:
         data = yaml.load(f, Loader=yaml.FullLoader)
-        for group in data["groups"]:
-            print("group: ", group["name"])
-            print("users: ", group["users"])
-            for user in group["users"]:
-                print("Inviting user ", user)
-                if user not in existing_users:
-                    out, err, ret = invite_user(user)
-                    if ret != 0:
-                        invitation_failed_users.append(user)
-                        print("Failed to invite an user", out, err)
-                        continue
-                else:
-                    print("user: ", user, "already in the existing users list, hence skipped to invite")
-                print("Adding user ", user, " to the group: ", group["name"])
-                out, err, ret = add_to_access_group(user, group["name"])
-                if ret != 0:
-                    access_group_failed_users.append(user)
-                    print("Failed to add user", user, " to", group["name"])
+    invites, changes = plan_sync(data, prune)
+    started = time.time()
+    # Group additions need the IAM ID the invite returns, so the invites go first
+    invitations = [Operation("Inviting user " + user, invite_user, user, users=[user]) for user in invites]
+    invitation_failed_users = [user for operation in execute(invitations, workers) for user in operation.users]
+    if api and any(not iam_ids.get(user) for user in invites if user not in invitation_failed_users):
+        # A retried invite found the user invited already, the IAM ID is in the users list
+        get_existing_users(pull=True)
+    memberships = []
+    for group, missing, extra in changes:
+        missing = [user for user in missing if user not in invitation_failed_users]
+        # The CLI output can't tell which users of a batch failed
+        batch = MAX_MEMBERS_PER_ADD if api else 1
+        for i in range(0, len(missing), batch):
+            users = missing[i:i + batch]
+            memberships.append(Operation("Adding users {} to the group {}".format(users, group), add_to_access_group,
+                                         users, group, users=users))
+        memberships += [Operation("Removing user {} from the group {}".format(user, group), remove_from_access_group,
+                                  user, group, users=[user]) for user in extra]
+    access_group_failed_users = [user for operation in execute(memberships, workers) for user in operation.users]
+    operations = invitations + memberships
+    if operations:
+        seconds = time.time() - started
+        print("{} operations in {:.1f}s ({:.1f} ops/s), {} retries, {} failed".format(
+            len(operations), seconds, len(operations) / max(seconds, 0.001),
+            sum(operation.attempts - 1 for operation in operations),
+            len(invitation_failed_users) + len(access_group_failed_users)))
+    else:
+        print("Access groups are in sync, nothing to do")
     if len(invitation_failed_users) != 0 or len(access_group_failed_users) != 0:
         raise Exception("Failed to sync! invitation_failed_users: ", invitation_failed_users,
                         " and access_group_failed_users: ", access_group_failed_users)
 
+# The REST calls below raise ibmapi.ApiError, whose status tells the executor whether to retry
+
 def invite_user(user):
-    return exec_cmd(["ibmcloud", "account", "user-invite", user])
+    if api:
+        resp = api.invite_user(user)
+        for invited in resp.get("resources", []):
+            iam_ids[user] = invited.get("iam_id")
+        existing_users.add(user)
+        return json.dumps(resp), "", 0
+    out, err, ret = exec_cmd(["ibmcloud", "account", "user-invite", user])
+    if ret == 0:
+        existing_users.add(user)
+    return out, err, ret
+
+def add_to_access_group(users, group):
+    """Add the users to the group in one call.
+
+    The REST API answers with a status per member; users is narrowed down to
+    the failed ones, so that a retry only adds those.
+    """
+    if api:
+        unknown = [user for user in users if not iam_ids.get(user)]
+        if unknown:
+            return "", "no IAM ID known for " + ", ".join(unknown), 1
+        resp = api.add_group_members(group, [iam_ids[user] for user in users])
+        by_iam_id = {iam_ids[user]: user for user in users}
+        failed = {}
+        for member in resp.get("members", []):
+            status = member.get("status_code") or 200
+            if status >= 400 and status != 409:
+                failed[by_iam_id.get(member.get("iam_id"), member.get("iam_id"))] = (status, member.get("errors"))
+        if failed:
+            users[:] = [user for user in users if user in failed]
+            statuses = [status for status, _ in failed.values()]
+            # Retry the batch when any member is retryable, the others fail again and are reported then
+            status = 429 if 429 in statuses else max(statuses)
+            raise ibmapi.ApiError("failed to add {} to {}: {}".format(", ".join(users), group, json.dumps(
+                {user: errors for user, (_, errors) in failed.items()})), status)
+        return json.dumps(resp), "", 0
+    return exec_cmd(["ibmcloud", "iam", "access-group-user-add", group] + list(users))
 
-def add_to_access_group(user, group):
-    return exec_cmd(["ibmcloud", "iam", "access-group-user-add", group, user])
+def remove_from_access_group(user, group):
+    if api:
+        api.remove_group_member(group, iam_ids.get(user) or user)
+        return "", "", 0
+    return exec_cmd(["ibmcloud", "iam", "access-group-user-remove", group, user, "-f"])
 
 def main(argv):
+    global api
     apiKey = ''
     access_bindings = "access-bindings.yaml"
+    useCli = False
+    apiEndpoint = None
+    prune = False
+    maxJobs = WORKERS
     try:
-        (opts, args) = getopt.getopt(argv, 'hk:b:', [
-            'access-bindings='
-            'apiKey='
+        (opts, args) = getopt.getopt(argv, 'hk:b:j:', [
+            'access-bindings=',
+            'apiKey=',
+            'cli',
+            'apiEndpoint=',
+            'prune',
+            'maxJobs='
         ])
     except getopt.GetoptError:
         print(help_message)
@@ -89,13 +286,35 @@ def main(argv):
             apiKey = arg
         elif opt in ('-b', '--access-bindings'):
             access_bindings = arg
+        elif opt == '--cli':
+            useCli = True
+        elif opt == '--apiEndpoint':
+            apiEndpoint = arg
+        elif opt == '--prune':
+            prune = True
+        elif opt in ('-j', '--maxJobs'):
+            try:
+                maxJobs = int(arg)
+            except ValueError:
+                maxJobs = 0
+            if maxJobs < 1:
+                print(help_message)
+                sys.exit(2)
 
-    out, err, ret = ibmcloud_login(apiKey)
-    if ret != 0:
-        print("Failed to login to IBM cloud", out, err)
-        sys.exit(2)
+    if useCli:
+        out, err, ret = ibmcloud_login(apiKey)
+        if ret != 0:
+            print("Failed to login to IBM cloud", out, err)
+            sys.exit(2)
+    else:
+        api = ibmapi.Client(apiKey, apiEndpoint)
+        try:
+            api.token()
+        except ibmapi.ApiError as e:
+            print("Failed to login to IBM cloud", e)
+            sys.exit(2)
     try:
-        sync(access_bindings)
+        sync(access_bindings, prune, maxJobs)
     except Exception as syncerr:
         print(syncerr)
         sys.exit(2)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+import codec
+import footprint
+import pipeline
+
+GB = 1024 * 1024 * 1024
+# Allowance on top of the image size when the source image can't be inspected
+BUFFER_GB = 50.0
+CONVERT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert_qcow2_ova.py')
+
+help_epilog = """Example image manifest file:
+---
+- imageUrl: https://mirror.openshift.com/pub/openshift-v4/ppc64le/dependencies/rhcos/4.5/4.5.4/rhcos-4.5.4-ppc64le-openstack.ppc64le.qcow2.gz
+  imageSize: 120
+  imageName: rhcos-454-ppc64le
+  imageDist: coreos
+- imageUrl: /root/rhel-8.2-update-2-ppc64le-kvm.qcow2
+  imageName: rhel-82u2-ppc64le
+  imageDist: rhel
+"""
+
+
+class Job:
+
+    def __init__(self, spec, index):
+        self.index = index
+        self.url = spec['imageUrl']
+        self.size = str(spec.get('imageSize', '120'))
+        self.name = spec['imageName']
+        self.dist = spec['imageDist']
+        self.sha256 = spec.get('imageSha256')
+        self.threads = spec.get('threads')
+        self.codec = codec.parse(str(spec['codec'])) if spec.get('codec') else None
+        self.footprint = 0
+        self.tempdir = None
+        self.process = None
+        self.log = None
+        self.log_path = None
+        self.started = None
+        self.seconds = 0.0
+        self.returncode = None
+        self.output_bytes = 0
+
+    def __str__(self):
+        return '{}({})'.format(self.name, self.dist)
+
+    @property
+    def work_dir(self):
+        # Named work directory of convert_qcow2_ova.py -W, where it keeps the pipeline state
+        return os.path.join(self.tempdir, 'convert-' + self.name)
+
+    def downloading(self):
+        return 'fetch' not in pipeline.completed_stages(self.work_dir)
+
+
+def estimate_footprint(job):
+    """Projected peak scratch usage of a job in bytes, planned from its source image."""
+    try:
+        return footprint.plan(job.url, job.size, job.dist).peak
+    except (OSError, footprint.PlanError) as e:
+        print("Warning: cannot plan", job, "(", e, ") assuming", job.size, "+", BUFFER_GB, "GB")
+        return int((float(job.size) + BUFFER_GB) * GB)
+
+
+def load_manifest(manifest):
+    with open(manifest) as f:
+        data = yaml.load(f, Loader=yaml.FullLoader)
+    jobs = []
+    for index, spec in enumerate(data or []):
+        for key in ('imageUrl', 'imageName', 'imageDist'):
+            if key not in spec:
+                raise ValueError("image #{} in {} has no {}".format(index + 1, manifest, key))
+        try:
+            jobs.append(Job(spec, index))
+        except codec.CodecError as e:
+            raise ValueError("image #{} in {}: {}".format(index + 1, manifest, e))
+    return jobs
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("{!r} is not a positive integer".format(value))
+    return number
+
+
+def codec_spec(value):
+    try:
+        return codec.parse(value)
+    except codec.CodecError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+class Scheduler:
+    """Run conversions concurrently within a scratch space, CPU and IO budget.
+
+    A job is admitted when its projected peak scratch footprint fits in the
+    space not yet reserved by running jobs, enough CPU slots are free and,
+    while its source image is fetched, an IO slot is free. The IO slot is
+    held until the fetch stage shows up in the pipeline state of the job.
+    Every job runs convert_qcow2_ova.py in its own process with its own
+    temporary directory, so loop devices, mount points and chroots of
+    parallel RHEL preparations never collide.
+    """
+
+    def __init__(self, args, footprint=estimate_footprint):
+        self.args = args
+        self.footprint = footprint
+        self.cpu_slots = args.cpuSlots
+        self.space = shutil.disk_usage(args.tempDir).free - int(args.reserveGb * GB)
+        self.reserved = 0
+        self.used_slots = 0
+        self.running = []
+        self.done = []
+
+    def _threads(self, job):
+        return job.threads or max(1, self.cpu_slots // self.args.maxJobs)
+
+    def _codec(self, job):
+        return job.codec or self.args.codec
+
+    def _output(self, job):
+        extension = self._codec(job).extension if self._codec(job) else '.ova.gz'
+        return os.path.join(self.args.outputDir, job.name + extension)
+
+    def _fits(self, job):
+        return (len(self.running) < self.args.maxJobs
+                and self.reserved + job.footprint <= self.space
+                and self.used_slots + self._threads(job) <= self.cpu_slots
+                and sum(1 for j in self.running if j.downloading()) < self.args.ioSlots)
+
+    def _command(self, job):
+        cmd = [sys.executable, CONVERT_SCRIPT, '-u', job.url, '-s', job.size, '-n', job.name,
+               '-d', job.dist, '-T', job.tempdir, '-W', job.tempdir, '--gzipThreads', str(self._threads(job)),
+               '--skipSpaceCheck']
+        if self._codec(job):
+            cmd += ['--codec', codec.spec(self._codec(job))]
+        for flag, value in (('-U', self.args.rhnUser), ('-P', self.args.rhnPassword),
+                            ('-O', self.args.osPassword), ('--imageSha256', job.sha256),
+                            ('--cacheDir', self.args.cacheDir), ('--packageCache', self.args.packageCache),
+                            ('--rpmDir', self.args.rpmDir)):
+            if value:
+                cmd += [flag, value]
+        return cmd
+
+    def _start(self, job):
+        job.tempdir = tempfile.mkdtemp(dir=self.args.tempDir, prefix='batch-{}-'.format(job.index))
+        job.log_path = os.path.join(self.args.logDir, job.name + '.log')
+        job.log = open(job.log_path, 'w')
+        print("Starting", job, "reserving", round(job.footprint / GB, 1), "GB and", self._threads(job), "CPUs,",
+              "log:", job.log_path)
+        job.started = time.time()
+        job.process = subprocess.Popen(self._command(job), cwd=self.args.outputDir,
+                                       stdout=job.log, stderr=subprocess.STDOUT)
+        self.reserved += job.footprint
+        self.used_slots += self._threads(job)
+        self.running.append(job)
+
+    def _finish(self, job):
+        job.seconds = time.time() - job.started
+        job.returncode = job.process.returncode
+        job.log.close()
+        shutil.rmtree(job.tempdir, ignore_errors=True)
+        output = self._output(job)
+        if job.returncode == 0 and os.path.exists(output):
+            job.output_bytes = os.path.getsize(output)
+        self.reserved -= job.footprint
+        self.used_slots -= self._threads(job)
+        self.running.remove(job)
+        self.done.append(job)
+        print("Finished", job, "with exit code", job.returncode, "in", round(job.seconds, 1), "seconds")
+
+    def run(self, jobs):
+        pending = list(jobs)
+        for job in pending:
+            job.footprint = self.footprint(job)
+        for job in [j for j in pending if j.footprint > self.space]:
+            print("ERROR:", job, "needs", round(job.footprint / GB, 1), "GB of scratch space but only",
+                  round(self.space / GB, 1), "GB are available in", self.args.tempDir)
+            job.returncode = 2
+            pending.remove(job)
+            self.done.append(job)
+        while pending or self.running:
+            # Backfill: start every pending job that fits, in manifest order
+            for job in list(pending):
+                if self._fits(job) or (not self.running and job is pending[0]):
+                    pending.remove(job)
+                    self._start(job)
+            time.sleep(1)
+            for job in list(self.running):
+                if job.process.poll() is not None:
+                    self._finish(job)
+        return self.done
+
+
+def print_summary(jobs, seconds):
+    print("\n{:<30} {:>6} {:>10} {:>12} {:>10}".format("IMAGE", "EXIT", "SECONDS", "OUTPUT(MB)", "MB/s"))
+    total = 0
+    for job in sorted(jobs, key=lambda j: j.index):
+        mb = job.output_bytes / (1024 * 1024)
+        rate = mb / job.seconds if job.seconds else 0.0
+        total += job.output_bytes
+        print("{:<30} {:>6} {:>10.1f} {:>12.1f} {:>10.1f}".format(job.name, job.returncode, job.seconds, mb, rate))
+    total_mb = total / (1024 * 1024)
+    print("Total: {} images, {:.1f} MB in {:.1f} seconds, {:.1f} MB/s".format(
+        len(jobs), total_mb, seconds, total_mb / seconds if seconds else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert several QCOW2 images to OVA concurrently",
+                                     epilog=help_epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-m', '--manifest', dest='manifest', required=True, help="YAML file listing the images to convert")
+    parser.add_argument('-U', '--rhnUser', dest='rhnUser', help="RedHat Subscription username. Required for rhel images")
+    parser.add_argument('-P', '--rhnPassword', dest='rhnPassword', help="RedHat Subscription password. Required for rhel images")
+    parser.add_argument('-O', '--osPassword', dest='osPassword', help="Root user password. Required for rhel and centos images")
+    parser.add_argument('-T', '--tempDir', dest='tempDir', default=tempfile.gettempdir(), help="Scratch space shared by the conversions (defaults to system specific temp directory, eg. '/tmp')")
+    parser.add_argument('-o', '--outputDir', dest='outputDir', default=os.getcwd(), help="Directory receiving the OVA images. Defaults to the current directory")
+    parser.add_argument('--logDir', dest='logDir', help="Directory for the per image logs. Defaults to the output directory")
+    parser.add_argument('-j', '--maxJobs', dest='maxJobs', type=positive_int, default=4, help="Maximum number of concurrent conversions. Default is %(default)s")
+    parser.add_argument('--cpuSlots', dest='cpuSlots', type=positive_int, default=os.cpu_count() or 1, help="CPUs shared by the conversions. Defaults to the number of CPUs")
+    parser.add_argument('--ioSlots', dest='ioSlots', type=positive_int, default=2, help="Maximum number of conversions fetching their source image at the same time. Default is %(default)s")
+    parser.add_argument('--codec', dest='codec', type=codec_spec, help="Compression of the OVA images, see convert_qcow2_ova.py --codec. A codec set for an image in the manifest takes precedence. Defaults to gzip")
+    parser.add_argument('--reserveGb', dest='reserveGb', type=float, default=5.0, help="Scratch space (in GB) kept free at all times. Default is %(default)s GB")
+    parser.add_argument('--cacheDir', dest='cacheDir', help="Persistent cache directory passed to every conversion")
+    parser.add_argument('--packageCache', dest='packageCache', help="Persistent dnf/yum package cache shared by the RHEL/CentOS conversions")
+    parser.add_argument('--rpmDir', dest='rpmDir', help="Local RPM directory or repository mirror shared by the RHEL/CentOS conversions")
+    args = parser.parse_args()
+    args.outputDir = os.path.abspath(args.outputDir)
+    args.logDir = os.path.abspath(args.logDir or args.outputDir)
+    os.makedirs(args.logDir, exist_ok=True)
+
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        print("ERROR: Failed to read the manifest:", e)
+        sys.exit(2)
+
+    started = time.time()
+    done = Scheduler(args).run(jobs)
+    print_summary(done, time.time() - started)
+    if any(job.returncode != 0 for job in done):
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
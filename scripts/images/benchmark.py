@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""Benchmark the stages of the image pipeline on synthetic sparse images.
+
+Fixtures are generated reproducibly from a seed: sparse raw volumes of a
+given apparent size where a given fraction is data, spread over the volume in
+extents like a freshly installed OS image. The data mixes text, structured
+records and incompressible blocks so it compresses about as well as a real
+image. Fixtures are kept in the work directory and reused by later runs.
+
+Each stage of convert_qcow2_ova.py is timed separately on every fixture:
+
+- gunzip:   decompress the gzipped qcow2 (or, without qemu-img, the data of
+            the volume, which is what a qcow2 of it holds)
+- convert:  qemu-img convert of the qcow2 to raw (skipped without qemu-img)
+- clone:    sparse clone of the raw volume and its sparse accounting
+- tar:      the OVA tar stream, without compression
+- checksum: the SHA-256 of the volume as the OVF manifest computes it
+- package:  the whole packaging stage, tar + gzip + checksums, to disk
+
+The RHEL preparation needs root and loop devices and is not benchmarked;
+nothing needs the network. Results are written as JSON and can be compared
+against a baseline, a stage slower than the baseline by more than the
+threshold is reported as a regression and fails the run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import codec
+import ingest
+import metrics
+import ova
+import pgzip
+import runner
+import sparse
+
+GB = 1024 * 1024 * 1024
+MB = 1024 * 1024
+EXTENT_SIZE = 8 * MB
+BLOCK_POOL = 16
+STAGES = ['gunzip', 'convert', 'clone', 'tar', 'checksum', 'package']
+WORDS = (b'the kernel module package systemd config service network device file system user root '
+         b'library python cloud init grub boot partition volume image version release update').split()
+
+
+def _text_block(rng, size):
+    out = bytearray()
+    while len(out) < size:
+        line = b' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+        out += line + b'\n'
+    return bytes(out[:size])
+
+
+def _record_block(rng, size):
+    out = bytearray()
+    base = rng.getrandbits(32)
+    while len(out) < size:
+        n = len(out) // 64
+        out += (base + n).to_bytes(8, 'little') + bytes(24) + rng.getrandbits(64).to_bytes(8, 'little') + bytes(24)
+    return bytes(out[:size])
+
+
+def _random_block(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def block_pool(seed, block_size=MB):
+    """BLOCK_POOL data blocks compressing roughly like OS image content."""
+    rng = random.Random(seed)
+    kinds = [_text_block, _record_block, _random_block, _text_block, _record_block]
+    blocks = []
+    for index in range(BLOCK_POOL):
+        quarter = block_size // 4
+        parts = [kinds[(index + n) % len(kinds)](rng, quarter) for n in range(3)]
+        parts.append(bytes(block_size - 3 * quarter))  # unused space inside files
+        blocks.append(b''.join(parts))
+    return blocks
+
+
+def extents(apparent, ratio):
+    """Data extents (offset, length) covering ratio of a volume of apparent bytes."""
+    data = max(EXTENT_SIZE, int(apparent * ratio) // MB * MB)
+    count = max(1, -(-data // EXTENT_SIZE))
+    stride = apparent // count // MB * MB
+    result = []
+    for index in range(count):
+        length = min(EXTENT_SIZE, data - index * EXTENT_SIZE)
+        result.append((index * stride, length))
+    return result
+
+
+class Fixture:
+
+    def __init__(self, workdir, size_gb, ratio, seed):
+        self.size_gb = size_gb
+        self.ratio = ratio
+        self.seed = seed
+        self.name = '{}g-{}pct-{}'.format(size_gb, round(ratio * 100, 2), seed)
+        self.dir = os.path.join(workdir, self.name)
+        self.image_dir = os.path.join(self.dir, 'image')
+        self.raw = os.path.join(self.image_dir, 'volume')
+        self.qcow2 = os.path.join(self.dir, 'volume.qcow2')
+        self.gz = None
+        self.apparent = int(size_gb * GB)
+        self.data = 0
+
+    def _write_raw(self):
+        blocks = block_pool(self.seed)
+        fd = os.open(self.raw, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            n = 0
+            for offset, length in extents(self.apparent, self.ratio):
+                for pos in range(offset, offset + length, MB):
+                    block = blocks[n % BLOCK_POOL]
+                    # A distinct first line per block keeps repeated blocks from being identical
+                    block = '{:016x}\n'.format(pos).encode('ascii') + block[17:]
+                    os.pwrite(fd, block[:offset + length - pos], pos)
+                    n += 1
+            os.ftruncate(fd, self.apparent)
+        finally:
+            os.close(fd)
+        with open(os.path.join(self.image_dir, 'volume.ovf'), 'w') as f:
+            f.write('<ovf:Envelope/>\n')
+        with open(os.path.join(self.image_dir, 'volume.meta'), 'w') as f:
+            f.write('vol1-file = volume\n')
+
+    def _write_gz(self, qemu_img):
+        if qemu_img:
+            cmd = ['qemu-img', 'convert', '-f', 'raw', '-O', 'qcow2', self.raw, self.qcow2]
+            result = runner.run(cmd, echo=False)
+            if result.returncode != 0:
+                raise RuntimeError("qemu-img failed: " + result.stderr)
+            source = self.qcow2
+        else:
+            # What a qcow2 holds: the data clusters, without the holes
+            source = os.path.join(self.dir, 'volume.data')
+            with open(source, 'wb') as out:
+                for piece in sparse.read_sparse(self.raw, 4 * MB):
+                    if not isinstance(piece, int):
+                        out.write(piece)
+        self.gz = source + '.gz'
+        pgzip.compress_file(source, self.gz)
+
+    def prepare(self, qemu_img):
+        """Generate the fixture unless an identical one is in the work directory."""
+        stamp = os.path.join(self.dir, 'fixture.json')
+        wanted = {'apparent': self.apparent, 'ratio': self.ratio, 'seed': self.seed, 'qcow2': qemu_img}
+        try:
+            with open(stamp) as f:
+                ready = json.load(f) == wanted
+        except (OSError, ValueError):
+            ready = False
+        if not ready:
+            print("Generating fixture", self.name, "...")
+            shutil.rmtree(self.dir, ignore_errors=True)
+            os.makedirs(self.image_dir)
+            self._write_raw()
+            self._write_gz(qemu_img)
+            with open(stamp, 'w') as f:
+                json.dump(wanted, f)
+        self.gz = (self.qcow2 if qemu_img else os.path.join(self.dir, 'volume.data')) + '.gz'
+        self.data = sparse.sparse_info(self.raw).data
+
+
+class StageError(Exception):
+    pass
+
+
+class _NullSink:
+
+    def write(self, data):
+        return len(data)
+
+    def write_zeros(self, count):
+        pass
+
+
+def _run_stage(name, record, fixture, target, threads):
+    if name == 'gunzip':
+        result = ingest.stream_gunzip(fixture.gz, target)
+        record['bytes_in'], record['bytes_out'] = result.bytes_in, result.bytes_out
+    elif name == 'convert':
+        result = runner.run(['qemu-img', 'convert', '-f', 'qcow2', '-O', 'raw', fixture.qcow2, target], echo=False)
+        if result.returncode != 0:
+            raise StageError("qemu-img convert exited with {}: {}".format(result.returncode, result.stderr.strip()))
+        record['bytes_in'] = fixture.data
+    elif name == 'clone':
+        sparse.clone(fixture.raw, target)
+        record['bytes_in'] = sparse.sparse_info(target).allocated
+    elif name == 'tar':
+        ova.stream_ova(fixture.image_dir, _NullSink(), with_manifest=False)
+        record['bytes_in'] = fixture.apparent
+    elif name == 'checksum':
+        ova.sha256_sparse(fixture.raw)
+        record['bytes_in'] = fixture.apparent
+    elif name == 'package':
+        result = ova.write_ova(fixture.image_dir, target, codec.parse('gzip'), threads)
+        record['bytes_in'], record['bytes_out'] = result.bytes_in, result.bytes_out
+
+
+def run_fixture(fixture, stages, qemu_img, threads, scratch):
+    """Time the stages on fixture, return one result dict per stage."""
+    recorder = metrics.Recorder(labels={'fixture': fixture.name})
+    for name in stages:
+        if name == 'convert' and not qemu_img:
+            print("  skipping convert, qemu-img is not installed")
+            continue
+        target = os.path.join(scratch, 'out')
+        try:
+            with recorder.stage(name) as record:
+                _run_stage(name, record, fixture, target, threads)
+        except StageError as e:
+            print("  {:<10} FAILED: {}".format(name, e))
+            continue
+        finally:
+            for leftover in (target, target + '.sha256'):
+                if os.path.exists(leftover):
+                    os.unlink(leftover)
+        print("  {:<10} {:>9.2f} s".format(name, record['seconds']))
+    results = []
+    for record in recorder.stages:
+        results.append({
+            'fixture': fixture.name, 'stage': record['stage'], 'status': record['status'],
+            'apparent_bytes': fixture.apparent, 'data_bytes': fixture.data, 'seconds': record['seconds'],
+            'mb_per_second': record['mb_per_second'],
+            'cpu_seconds': round(record['cpu_user_seconds'] + record['cpu_system_seconds']
+                                 + record['children_cpu_user_seconds'] + record['children_cpu_system_seconds'], 3),
+        })
+    return results
+
+
+def compare(results, baseline, threshold, min_seconds):
+    """Print the change against baseline, return the regressed (fixture, stage) pairs."""
+    # Failed stages have no meaningful timing, on either side
+    previous = {(r['fixture'], r['stage']): r['seconds'] for r in baseline['results'] if r.get('status', 'ok') == 'ok'}
+    regressions = []
+    print("\n{:<22} {:<10} {:>10} {:>10} {:>8}".format("FIXTURE", "STAGE", "BASELINE", "SECONDS", "CHANGE"))
+    for result in results:
+        key = (result['fixture'], result['stage'])
+        if key not in previous or result['status'] != 'ok':
+            continue
+        base = previous[key]
+        change = (result['seconds'] - base) / base if base else 0.0
+        regressed = result['seconds'] > base * (1 + threshold) and result['seconds'] - base > min_seconds
+        if regressed:
+            regressions.append(key)
+        print("{:<22} {:<10} {:>10.2f} {:>10.2f} {:>+7.0%}{}".format(
+            key[0], key[1], base, result['seconds'], change, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image pipeline stages on synthetic sparse images")
+    parser.add_argument('-s', '--sizes', dest='sizes', default='1,10,120', help="Comma separated apparent sizes (in GB) of the fixtures. Default is %(default)s")
+    parser.add_argument('-r', '--dataRatio', dest='dataRatio', type=float, default=0.05, help="Fraction of the volume holding data, the rest are holes. Default is %(default)s")
+    parser.add_argument('--seed', dest='seed', type=int, default=1, help="Seed of the fixture content. Default is %(default)s")
+    parser.add_argument('--stages', dest='stages', default=','.join(STAGES), help="Comma separated stages to time. Default is %(default)s")
+    parser.add_argument('--threads', dest='threads', type=int, help="Compression threads. Defaults to the number of CPUs")
+    parser.add_argument('-w', '--workDir', dest='workDir', default=os.path.join(tempfile.gettempdir(), 'image-benchmark'), help="Directory keeping the fixtures between runs. Default is %(default)s")
+    parser.add_argument('-o', '--output', dest='output', default='benchmark-results.json', help="JSON file receiving the results. Default is %(default)s")
+    parser.add_argument('-b', '--baseline', dest='baseline', help="Results of an earlier run to compare against")
+    parser.add_argument('--threshold', dest='threshold', type=float, default=0.2, help="Relative slowdown of a stage reported as a regression. Default is %(default)s")
+    parser.add_argument('--minSeconds', dest='minSeconds', type=float, default=0.5, help="Ignore slowdowns smaller than this many seconds. Default is %(default)s")
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error("unknown stages: {}, use {}".format(', '.join(unknown), ','.join(STAGES)))
+    if not 0 < args.dataRatio <= 1:
+        parser.error("--dataRatio must be in (0, 1]")
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print("ERROR: Failed to read the baseline:", e)
+            sys.exit(2)
+
+    qemu_img = shutil.which('qemu-img') is not None
+    os.makedirs(args.workDir, exist_ok=True)
+    scratch = tempfile.mkdtemp(dir=args.workDir, prefix='run-')
+    results = []
+    try:
+        for size in args.sizes.split(','):
+            fixture = Fixture(args.workDir, float(size), args.dataRatio, args.seed)
+            fixture.prepare(qemu_img)
+            print("Fixture {}: {} bytes apparent, {} bytes of data".format(fixture.name, fixture.apparent, fixture.data))
+            results += run_fixture(fixture, stages, qemu_img, args.threads, scratch)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'machine': platform.machine(), 'cpus': os.cpu_count(), 'python': platform.python_version(),
+                 'qemu_img': qemu_img},
+        'params': {'sizes': args.sizes, 'data_ratio': args.dataRatio, 'seed': args.seed, 'threads': args.threads},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.output)
+
+    failed = [r for r in results if r['status'] != 'ok']
+    if failed:
+        print(len(failed), "stage(s) failed:", ', '.join('{} {}'.format(r['fixture'], r['stage']) for r in failed))
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold, args.minSeconds)
+        if regressions:
+            print(len(regressions), "stage(s) regressed by more than {:.0%}".format(args.threshold))
+            sys.exit(2)
+    if failed:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Persistent, content-addressed cache for image conversion stages.
+
+Artifacts (the decompressed qcow2, the converted raw volume) are stored under
+a key derived from the source: its sha256 when known, otherwise the URL and
+ETag (or path, size and mtime for local files). Several builds may share one
+cache directory:
+
+- entries are published with an atomic rename, so readers never see a
+  partially written artifact
+- a build holds a shared flock on an entry while it uses it and eviction
+  skips entries that are in use
+- the total size is bounded, least recently used entries are evicted first;
+  the use is recorded in the mtime of the entry's lock file, not of the
+  entry, whose inode can be hard linked into a work directory where its
+  mtime is part of the pipeline fingerprint
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import tempfile
+
+import sparse
+
+GB = 1024 * 1024 * 1024
+DEFAULT_MAX_GB = 100
+
+
+def source_key(source, etag=None, sha256=None):
+    """Cache key for a source URL or local path."""
+    if sha256:
+        ident = 'sha256:' + sha256.lower()
+    elif source.startswith('http://') or source.startswith('https://'):
+        if not etag:
+            return None  # nothing tells us when the remote object changes
+        ident = 'url:{}\netag:{}'.format(source, etag)
+    else:
+        st = os.stat(source)
+        ident = 'path:{}\nsize:{}\nmtime:{}'.format(os.path.abspath(source), st.st_size, st.st_mtime_ns)
+    return hashlib.sha256(ident.encode('utf-8')).hexdigest()
+
+
+class StageCache:
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_GB * GB):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.entries = os.path.join(self.root, 'entries')
+        os.makedirs(self.entries, exist_ok=True)
+
+    def _path(self, key, stage):
+        return os.path.join(self.entries, '{}.{}'.format(key, stage))
+
+    @staticmethod
+    def _touch(path):
+        """Mark the entry at path as recently used."""
+        with open(path + '.lock', 'a'):
+            os.utime(path + '.lock')
+
+    @staticmethod
+    def _last_used(path, st):
+        try:
+            return os.stat(path + '.lock').st_mtime
+        except FileNotFoundError:
+            return st.st_mtime
+
+    @contextlib.contextmanager
+    def _global_lock(self):
+        with open(os.path.join(self.root, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def contains(self, key, stage):
+        return os.path.exists(self._path(key, stage))
+
+    @contextlib.contextmanager
+    def use(self, key, stage):
+        """Yield the path of a cached artifact, or None, protected from eviction."""
+        path = self._path(key, stage)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                if not os.path.exists(path):
+                    yield None
+                    return
+                os.utime(lock.fileno())  # mark as recently used
+                yield path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def restore(self, key, stage, dest, link=False):
+        """Copy (reflink when possible) a cached artifact to dest, return False on a miss.
+
+        link allows a hard link for artifacts dest will only ever read.
+        """
+        with self.use(key, stage) as path:
+            if path is None:
+                return False
+            sparse.clone(path, dest, link=link)
+            return True
+
+    def store(self, key, stage, src, move=False, link=False):
+        """Add src to the cache and return the cached path.
+
+        With move the file is renamed into the cache (it must live on the same
+        filesystem), otherwise it is cloned so the caller keeps its copy; link
+        allows that clone to be a hard link.
+        """
+        path = self._path(key, stage)
+        fd, tmp = tempfile.mkstemp(dir=self.entries, prefix='.incoming-')
+        os.close(fd)
+        try:
+            if move:
+                os.replace(src, tmp)
+            else:
+                sparse.clone(src, tmp, link=link)
+            with self._global_lock():
+                os.replace(tmp, path)
+                self._touch(path)
+                self._evict(keep=path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return path
+
+    def _evict(self, keep=None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.entries):
+            if name.startswith('.') or name.endswith('.lock'):
+                continue
+            path = os.path.join(self.entries, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            size = st.st_blocks * 512
+            total += size
+            entries.append((self._last_used(path, st), size, path))
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            with open(path + '.lock', 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # in use by another build
+                try:
+                    os.unlink(path)
+                    total -= size
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return total
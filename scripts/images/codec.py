@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Output compression codecs for OVA images, and a benchmark to pick one.
+
+A codec is given as NAME[:LEVEL]:
+
+- gzip (levels 0-9, default 6): pigz compatible parallel gzip, the format
+  PowerVS imports
+- zstd (levels 1-22, default 3): multi-threaded zstandard, several times
+  faster than gzip for a similar ratio, for internal staging (caches,
+  transfers between build hosts). Needs the optional zstandard package
+- none: the uncompressed OVA; holes are kept as holes when the output is a
+  regular file
+
+All writers share the interface of pgzip.ParallelGzipWriter (write,
+write_zeros, close, bytes_in, bytes_out, threads, rate).
+
+    python3 codec.py -i <raw image> [-c gzip:1,gzip:6,zstd:3,none] [--threads N]
+
+compresses the data of a raw image with each codec, prints the ratio and
+throughput and recommends the fastest setting for this host's core count.
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+
+import pgzip
+import sparse
+
+ZERO_CHUNK = 4 * 1024 * 1024
+DEFAULT_BENCHMARK = 'gzip:1,gzip:6,gzip:9,zstd:1,zstd:3,zstd:9,none'
+# Link speed (Mbit/s) the recommendation assumes the output is shipped over
+DEFAULT_LINK_MBPS = 1000
+
+Codec = namedtuple('Codec', ['name', 'level', 'extension'])
+BenchResult = namedtuple('BenchResult', ['codec', 'bytes_in', 'bytes_out', 'seconds'])
+
+CODECS = {
+    # name: (default level, min level, max level, extension)
+    'gzip': (pgzip.DEFAULT_LEVEL, 0, 9, '.ova.gz'),
+    'zstd': (3, 1, 22, '.ova.zst'),
+    'none': (None, None, None, '.ova'),
+}
+
+
+class CodecError(Exception):
+    pass
+
+
+def parse(spec):
+    """Codec for a NAME[:LEVEL] string."""
+    name, _, level = spec.strip().lower().partition(':')
+    if name not in CODECS:
+        raise CodecError("unknown codec {!r}, use one of {}".format(name, ', '.join(sorted(CODECS))))
+    default, low, high, extension = CODECS[name]
+    if not level:
+        return Codec(name, default, extension)
+    if default is None:
+        raise CodecError("codec {} takes no level".format(name))
+    if not level.isdigit() or not low <= int(level) <= high:
+        raise CodecError("{} level must be between {} and {}".format(name, low, high))
+    return Codec(name, int(level), extension)
+
+
+def spec(codec):
+    return codec.name if codec.level is None else '{}:{}'.format(codec.name, codec.level)
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise CodecError("the zstd codec needs the zstandard package (pip3 install zstandard)")
+    return zstandard
+
+
+def require(codec):
+    """Raise CodecError when the optional package codec needs is missing."""
+    if codec.name == 'zstd':
+        _import_zstandard()
+
+
+class _Writer:
+    """Common statistics and zero run handling of the non gzip writers."""
+
+    def __init__(self, fileobj, threads):
+        self.fileobj = fileobj
+        self.threads = threads
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.time()
+        self.seconds = 0.0
+        self.closed = False
+
+    def write_zeros(self, count):
+        zeros = bytes(min(count, ZERO_CHUNK))
+        while count:
+            size = min(count, ZERO_CHUNK)
+            self.write(zeros[:size] if size < ZERO_CHUNK else zeros)
+            count -= size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+        self.seconds = time.time() - self.started
+
+    @property
+    def rate(self):
+        """Uncompressed bytes per second."""
+        elapsed = self.seconds or (time.time() - self.started)
+        return self.bytes_in / elapsed if elapsed > 0 else 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+
+
+class PlainWriter(_Writer):
+    """Uncompressed output. Zero runs are skipped over when fileobj supports it."""
+
+    def __init__(self, fileobj, threads=None):
+        super().__init__(fileobj, 1)
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.bytes_in += len(data)
+        self.bytes_out += len(data)
+        return len(data)
+
+    def write_zeros(self, count):
+        if hasattr(self.fileobj, 'write_zeros'):
+            self.fileobj.write_zeros(count)
+            self.bytes_in += count
+            self.bytes_out += count
+        else:
+            super().write_zeros(count)
+
+
+class _CountingFile:
+    """Count the bytes the zstandard stream writer hands to fileobj."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.count += len(data)
+        return len(data)
+
+    def flush(self):
+        if hasattr(self.fileobj, 'flush'):
+            self.fileobj.flush()
+
+
+class ZstdWriter(_Writer):
+    """Multi-threaded zstandard frame written to fileobj."""
+
+    def __init__(self, fileobj, level=3, threads=None):
+        zstandard = _import_zstandard()
+        super().__init__(fileobj, threads or os.cpu_count() or 1)
+        self._out = _CountingFile(fileobj)
+        compressor = zstandard.ZstdCompressor(level=level, threads=self.threads)
+        self._stream = compressor.stream_writer(self._out, closefd=False)
+
+    def write(self, data):
+        self._stream.write(data)
+        self.bytes_in += len(data)
+        self.bytes_out = self._out.count
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._stream.close()
+        self.bytes_out = self._out.count
+        super().close()
+
+
+def open_writer(codec, fileobj, threads=None, block_size=pgzip.BLOCK_SIZE):
+    """Compressing write-only file object for codec on top of fileobj."""
+    if codec.name == 'gzip':
+        return pgzip.ParallelGzipWriter(fileobj, level=codec.level, threads=threads, block_size=block_size)
+    if codec.name == 'zstd':
+        return ZstdWriter(fileobj, level=codec.level, threads=threads)
+    return PlainWriter(fileobj, threads)
+
+
+class _NullFile:
+
+    def write(self, data):
+        return len(data)
+
+
+def benchmark(path, codecs, threads=None, sample=None, block_size=pgzip.BLOCK_SIZE):
+    """Compress the content of the raw image path with each codec into nowhere.
+
+    Only the first sample bytes of data extents are used when sample is set,
+    holes are fed as zero runs like the packaging stage does.
+    """
+    results = []
+    for codec in codecs:
+        writer = open_writer(codec, _NullFile(), threads, block_size)
+        data = 0
+        with writer:
+            for piece in sparse.read_sparse(path, ZERO_CHUNK):
+                if isinstance(piece, int):
+                    writer.write_zeros(piece)
+                    continue
+                writer.write(piece)
+                data += len(piece)
+                if sample and data >= sample:
+                    break
+        results.append(BenchResult(codec, writer.bytes_in, writer.bytes_out, writer.seconds))
+    return results
+
+
+def recommend(results, link_mbps=DEFAULT_LINK_MBPS):
+    """Result whose output is ready soonest when shipped over link_mbps while it is compressed."""
+    link = link_mbps * 1000 * 1000 / 8
+
+    def completion(result):
+        return max(result.seconds, result.bytes_out / link)
+    return min(results, key=completion) if results else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure compression ratio and throughput of the OVA codecs on a raw image")
+    parser.add_argument('-i', '--image', dest='image', required=True, help="Raw image to compress")
+    parser.add_argument('-c', '--codecs', dest='codecs', default=DEFAULT_BENCHMARK, help="Comma separated codecs to measure. Default is %(default)s")
+    parser.add_argument('--threads', dest='threads', type=int, default=os.cpu_count() or 1, help="Compression threads. Defaults to the number of CPUs (%(default)s)")
+    parser.add_argument('--sampleMb', dest='sampleMb', type=int, help="Only compress the first sampleMb MB of data of the image")
+    parser.add_argument('--linkMbps', dest='linkMbps', type=float, default=DEFAULT_LINK_MBPS, help="Speed (Mbit/s) of the link the images are shipped over, used for the recommendation. Default is %(default)s")
+    args = parser.parse_args()
+
+    codecs = []
+    for item in args.codecs.split(','):
+        try:
+            codec = parse(item)
+            require(codec)
+        except CodecError as e:
+            print("Skipping {}: {}".format(item, e))
+            continue
+        codecs.append(codec)
+    if not codecs:
+        print("ERROR: no usable codec")
+        sys.exit(2)
+
+    sample = args.sampleMb * 1024 * 1024 if args.sampleMb else None
+    results = benchmark(args.image, codecs, args.threads, sample)
+    print("{:<10} {:>14} {:>14} {:>8} {:>10} {:>10}".format("CODEC", "BYTES IN", "BYTES OUT", "RATIO", "SECONDS", "MB/s"))
+    for result in results:
+        ratio = result.bytes_in / result.bytes_out if result.bytes_out else 0.0
+        rate = result.bytes_in / (1024 * 1024) / result.seconds if result.seconds else 0.0
+        print("{:<10} {:>14} {:>14} {:>8.1f} {:>10.1f} {:>10.1f}".format(
+            spec(result.codec), result.bytes_in, result.bytes_out, ratio, result.seconds, rate))
+
+    print("Recommendation for {} threads and a {} Mbit/s link:".format(args.threads, args.linkMbps))
+    staging = recommend(results, args.linkMbps)
+    print("  staging:       --codec", spec(staging.codec))
+    final = recommend([r for r in results if r.codec.name == 'gzip'], args.linkMbps)
+    if final:
+        print("  PowerVS image: --codec", spec(final.codec))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 
-import subprocess
 import sys
 import argparse
 import platform
-import gzip
 import os
-import tarfile
-import urllib.request
 import tempfile
 import shutil
 import stat
-import math
 from urllib.parse import urlparse
 from pathlib import Path
 from jinja2 import Template
 
+import cache
+import codec
+import downloader
+import footprint
+import ingest
+import metrics
+import multipart
+import runner
+import ova
+import pipeline
+import pgzip
+import rpmcache
+import sparse
+
 
 template_meta = """os-type = rhel
 architecture = ppc64le
@@ -72,10 +81,12 @@ mv /etc/resolv.conf /etc/resolv.conf.orig | true
 echo "nameserver 9.9.9.9" | tee /etc/resolv.conf
 
 if [ "{{ distribution }}" == "rhel" ];then
+    set +o xtrace
     subscription-manager register --force --auto-attach --username={{ rh_sub_username }} --password={{ rh_sub_password }}
+    set -o xtrace
 fi
-yum update -y
-yum install http://public.dhe.ibm.com/systems/virtualization/powervc/rhel8_cloud_init/cloud-init-19.1-8.ibm.el8.noarch.rpm -y
+yum update -y {{ yum_opts }}
+yum install {{ cloud_init }} -y {{ yum_opts }}
 ln -s /usr/lib/systemd/system/cloud-init-local.service /etc/systemd/system/multi-user.target.wants/cloud-init-local.service
 ln -s /usr/lib/systemd/system/cloud-init.service /etc/systemd/system/multi-user.target.wants/cloud-init.service
 ln -s /usr/lib/systemd/system/cloud-config.service /etc/systemd/system/multi-user.target.wants/cloud-config.service
@@ -83,11 +94,11 @@ ln -s /usr/lib/systemd/system/cloud-final.service /etc/systemd/system/multi-user
 
 rm -rf /etc/systemd/system/multi-user.target.wants/firewalld.service
 
-rpm -vih --nodeps http://public.dhe.ibm.com/software/server/POWER/Linux/yum/download/ibm-power-repo-latest.noarch.rpm
+rpm -vih --nodeps {{ power_repo }}
 sed -i 's/^more \/opt\/ibm\/lop\/notice/#more \/opt\/ibm\/lop\/notice/g' /opt/ibm/lop/configure
 echo 'y' | /opt/ibm/lop/configure
-yum install  powerpc-utils librtas DynamicRM  devices.chrp.base.ServiceRM rsct.opt.storagerm rsct.core rsct.basic rsct.core src -y
-yum install -y device-mapper-multipath
+yum install  powerpc-utils librtas DynamicRM  devices.chrp.base.ServiceRM rsct.opt.storagerm rsct.core rsct.basic rsct.core src -y {{ yum_opts }}
+yum install -y device-mapper-multipath {{ yum_opts }}
 
 cat <<EOF > /etc/multipath.conf
 defaults {
@@ -115,7 +126,9 @@ do
 done
 grub2-mkconfig -o /boot/grub2/grub.cfg
 rm -rf /etc/sysconfig/network-scripts/ifcfg-eth0
+set +o xtrace
 echo {{ root_password }} | passwd root --stdin
+set -o xtrace
 if [ "{{ distribution }}" == "rhel" ];then
     subscription-manager unregister
     subscription-manager clean
@@ -226,41 +239,16 @@ system_info:
    ssh_svcname: sshd"""
 
 
-def exec_cmd(cmd):
-    print("command:", cmd)
-    execute = subprocess.run([cmd], shell=True, universal_newlines=True,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return execute.stdout, execute.stderr, execute.returncode
-
-
-def gzip_gunzip(sfile, dfile, block_size=65536):
-    with gzip.open(sfile, 'rb') as s_file, open(dfile, 'wb') as d_file:
-        while True:
-            block = s_file.read(block_size)
-            if not block:
-                break
-            else:
-                d_file.write(block)
+# Default timeout in seconds of the external commands, None waits forever
+command_timeout = None
 
 
-def gzip_gzip(sfile, dfile, block_size=65536):
-    # run the pigz if present in the system for better performance
-    pigz_path = shutil.which("pigz")
-    if pigz_path != "":
-        print("pigz found in ", pigz_path, " will use pigz for gzip")
-        cmd = 'pigz -k -c ' + sfile + ' > ' + dfile
-        out, err, ret = exec_cmd(cmd)
-        if ret != 0:
-            print('ERROR: Failed to gzip the file:', err)
-            sys.exit(2)
-    else:
-        with gzip.open(dfile, 'wb') as d_file, open(sfile, 'rb') as s_file:
-            while True:
-                block = s_file.read(block_size)
-                if not block:
-                    break
-                else:
-                    d_file.write(block)
+def exec_cmd(cmd, timeout=None, redact=None):
+    # Output is streamed as it arrives, only its tail is kept for error messages
+    snap = metrics.snapshot()
+    result = runner.run(cmd, timeout=timeout or command_timeout, redact=redact)
+    metrics.record_command(cmd, result.returncode, snap, result.rusage)
+    return result.stdout, result.stderr, result.returncode
 
 
 def get_image_name(image_url):
@@ -268,10 +256,42 @@ def get_image_name(image_url):
     return (os.path.basename(a.path))
 
 
-def get_image(image_url, image_file):
-    with urllib.request.urlopen(image_url) as response, open(image_file, 'wb') as out_file:
-        data = response.read()  # a `bytes` object
-        out_file.write(data)
+def get_image(image_url, image_file, sha256=None, workers=downloader.DEFAULT_WORKERS):
+    with metrics.stage('download') as stage:
+        try:
+            result = downloader.download(image_url, image_file, workers=workers, sha256=sha256)
+        except downloader.DownloadError as e:
+            print('ERROR: Failed to download the image:', e)
+            sys.exit(2)
+        stage['bytes_in'] = stage['bytes_out'] = result.size
+    print("Downloaded", result.size, "bytes in", round(result.seconds, 1), "seconds, sha256:", result.sha256)
+
+
+def get_gunzipped_image(image_url, image_file, sha256=None):
+    # Decompress while downloading, the .gz itself never lands on disk
+    with metrics.stage('download_gunzip') as stage:
+        try:
+            result = ingest.stream_gunzip(image_url, image_file, sha256=sha256)
+        except (ingest.IngestError, downloader.DownloadError) as e:
+            print('ERROR: Failed to get the image:', e)
+            sys.exit(2)
+        stage['bytes_in'], stage['bytes_out'] = result.bytes_in, result.bytes_out
+    print("Extracted", result.bytes_in, "bytes into", result.bytes_out, "bytes in", round(result.seconds, 1),
+          "seconds, sha256:", result.sha256)
+
+
+def get_cache_key(image_url, sha256=None):
+    etag = None
+    if ingest.is_remote(image_url) and not sha256:
+        pool = downloader.ConnectionPool()
+        try:
+            etag = downloader.probe(image_url, pool).etag
+        except downloader.DownloadError as e:
+            print('ERROR: Failed to get the image:', e)
+            sys.exit(2)
+        finally:
+            pool.close()
+    return cache.source_key(image_url, etag, sha256)
 
 
 def remove_extn(file_path):
@@ -282,35 +302,79 @@ def get_file_size(image_file):
     return Path(image_file).stat().st_size
 
 
-def create_tar(image_file_source, image_file_path):
-    with tarfile.open(image_file_path, "w") as tar:
-        os.chdir(image_file_source)
-        for name in os.listdir('.'):
-            tar.add(name)
-
-
-def prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPassword, imageDist):
+def create_ova_gz(image_file_source, ova_image_file, level=pgzip.DEFAULT_LEVEL, threads=None,
+                  block_size=pgzip.BLOCK_SIZE, sparse_members=False, manifest=True, output_codec=None):
+    # tar straight into the compressor, the uncompressed .ova is never written
+    output_codec = output_codec or codec.Codec('gzip', level, '.ova.gz')
+    with metrics.stage('package') as stage:
+        try:
+            result = ova.write_ova(image_file_source, ova_image_file, output_codec, threads, block_size,
+                                   sparse_members, manifest)
+        except codec.CodecError as e:
+            print('ERROR:', e)
+            sys.exit(2)
+        except ova.OvaError as e:
+            print('ERROR: Failed to create the ova image:', e)
+            sys.exit(2)
+        stage['bytes_in'], stage['bytes_out'] = result.bytes_in, result.bytes_out
+    print("Packaged", result.bytes_in, "bytes into", result.bytes_out, "bytes in", round(result.seconds, 1), "seconds")
+    for name, digest in result.digests.items():
+        print("SHA256({})= {}".format(name, digest))
+    print("SHA256({})= {}".format(os.path.basename(ova_image_file), result.sha256))
+
+
+def upload_ova_gz(image_file_source, ova_image_file, client, bucket, key, level=pgzip.DEFAULT_LEVEL, threads=None,
+                  block_size=pgzip.BLOCK_SIZE, sparse_members=False, manifest=True, output_codec=None):
+    # Compressed output cut into multipart parts uploaded while the next ones are produced, no local copy
+    output_codec = output_codec or codec.Codec('gzip', level, '.ova.gz')
+    with metrics.stage('package') as stage:
+        try:
+            with multipart.MultipartWriter(client, bucket, key) as upload:
+                result = ova.upload_ova(image_file_source, upload, output_codec, threads, block_size,
+                                        sparse_members, manifest)
+            sidecar = ova.write_checksum_file(ova_image_file, result.sha256)
+            with open(sidecar, 'rb') as f:
+                client.put_object(Bucket=bucket, Key=key + '.sha256', Body=f.read())
+        except codec.CodecError as e:
+            print('ERROR:', e)
+            sys.exit(2)
+        except ova.OvaError as e:
+            print('ERROR: Failed to create the ova image:', e)
+            sys.exit(2)
+        except multipart.UploadError as e:
+            print('ERROR: Failed to upload the ova image:', e)
+            sys.exit(2)
+        stage['bytes_in'], stage['bytes_out'] = result.bytes_in, result.bytes_out
+    print("Packaged and uploaded", result.bytes_in, "bytes into", result.bytes_out, "bytes in",
+          round(result.seconds, 1), "seconds to", bucket + '/' + key)
+    print("Upload: {} parts, {:.1f} MB/s".format(upload.result.parts,
+                                                 upload.result.bytes / multipart.MB / max(upload.result.seconds, 0.001)))
+    for name, digest in result.digests.items():
+        print("SHA256({})= {}".format(name, digest))
+    print("SHA256({})= {}".format(key, result.sha256))
+
+
+def prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPassword, imageDist, package_cache=None,
+                 rpm_dir=None):
     mount_dir = tmpdir + '/' + 'tempMount'
     rhel_bash_file = mount_dir + '/' + 'rhel_bash.sh'
     rhel_cloud_config_file = mount_dir + '/etc/cloud/' + 'cloud.cfg'
     real_root = os.open("/", os.O_RDONLY)
-    os.mkdir(mount_dir)  # Temporary mount directory
+    os.makedirs(mount_dir, exist_ok=True)  # Temporary mount directory
     print("Getting a free loop device ...")
-    cmd = 'losetup --nooverlap  --partscan  -f ' + extracted_raw_file_path
+    # --show prints the device attached to this very file, parallel conversions can't pick up each other's device
+    cmd = ['losetup', '--nooverlap', '--partscan', '--show', '-f', extracted_raw_file_path]
     out, err, ret = exec_cmd(cmd)
     if ret != 0:
         print('ERROR: Failed to get a free loop device:', err)
         sys.exit(2)
-    cmd = 'losetup -l --output NAME,BACK-FILE | grep ' + extracted_raw_file_path + '| awk \'{print $1}\' '
-    out, err, ret = exec_cmd(cmd)
-    if ret != 0:
-        print('ERROR: Getting loop device name failed:', err)
-        sys.exit(2)
 
     loop_device = out.rstrip()
+    extra_mounts = []
+    repo_file = None
 
     print("probing partition table ...")
-    cmd = 'partprobe ' + loop_device
+    cmd = ['partprobe', loop_device]
     out, err, ret = exec_cmd(cmd)
     if ret != 0:
         print('ERROR: Getting loop device name failed:', err)
@@ -319,14 +383,14 @@ def prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPasswo
     try:
         partition_number = "2"
         print("mounting the loop device ...")
-        cmd = 'mount -o nouuid ' + loop_device + 'p' + partition_number + ' ' + mount_dir
+        cmd = ['mount', '-o', 'nouuid', loop_device + 'p' + partition_number, mount_dir]
         out, err, ret = exec_cmd(cmd)
         if ret != 0:
             print('ERROR: Failed mounting the device:', err)
             sys.exit(2)
 
         print("Resizing the partition...")
-        cmd = 'growpart ' + loop_device + ' ' + partition_number
+        cmd = ['growpart', loop_device, partition_number]
         out, err, ret = exec_cmd(cmd)
         if ret != 0:
             print('ERROR: Failed growpart:', err)
@@ -335,7 +399,7 @@ def prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPasswo
         print("Resizing the filesystem...")
 
         # finding the filesystem type
-        cmd = 'blkid ' + loop_device + 'p' + partition_number + ' -o value -s TYPE'
+        cmd = ['blkid', loop_device + 'p' + partition_number, '-o', 'value', '-s', 'TYPE']
         out, err, ret = exec_cmd(cmd)
         if ret != 0:
             print('ERROR: Failed to find a filesystem type for a partition:', err)
@@ -344,9 +408,9 @@ def prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPasswo
         fs_type = out.rstrip()
 
         if fs_type == "xfs":
-            cmd = 'xfs_growfs -d ' + loop_device + 'p' + partition_number
+            cmd = ['xfs_growfs', '-d', loop_device + 'p' + partition_number]
         elif fs_type in ["ext2", "ext3", "ext4"]:
-            cmd = 'resize2fs ' + loop_device + 'p' + partition_number
+            cmd = ['resize2fs', loop_device + 'p' + partition_number]
         else:
             print('ERROR: unknown filesystem, can\'t handle :', fs_type)
             sys.exit(2)
@@ -357,15 +421,35 @@ def prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPasswo
             sys.exit(2)
 
         for sdir in ('/proc', '/dev', '/sys', '/var/run/', '/etc/machine-id'):
-            cmd = 'mount -o bind ' + sdir + ' ' + mount_dir + sdir
+            cmd = ['mount', '-o', 'bind', sdir, mount_dir + sdir]
             out, err, ret = exec_cmd(cmd)
             if ret != 0:
                 print('ERROR: Failed mounting the device:', err)
                 sys.exit(2)
 
+        # Persistent package cache and local RPMs, mounted over the image so they never end up in it
+        mounts = package_cache.mounts() if package_cache else []
+        if rpm_dir:
+            mounts.append((rpm_dir, rpmcache.CHROOT_RPM_DIR))
+        for source, target in mounts:
+            os.makedirs(mount_dir + target, exist_ok=True)
+            options = 'bind,ro' if source == rpm_dir else 'bind'
+            cmd = ['mount', '-o', options, source, mount_dir + target]
+            out, err, ret = exec_cmd(cmd)
+            if ret != 0:
+                print('ERROR: Failed mounting the package cache:', err)
+                sys.exit(2)
+            extra_mounts.append(mount_dir + target)
+        if rpm_dir and rpmcache.is_repository(rpm_dir):
+            repo_file = mount_dir + rpmcache.REPO_FILE
+            with open(repo_file, "w") as stream:
+                stream.write(rpmcache.template_repo)
+
         rhel_bash_template = Template(template_rhel_bash)
         rhel_bash = rhel_bash_template.render(rh_sub_username=rhnUser, rh_sub_password=rhnPassword,
-                                              root_password=osPassword, distribution=imageDist)
+                                              root_password=osPassword, distribution=imageDist,
+                                              yum_opts='--setopt=keepcache=True' if package_cache else '',
+                                              **rpmcache.pinned_sources(rpm_dir))
         with open(rhel_bash_file, "w") as stream:
             stream.write(rhel_bash)
         st = os.stat(rhel_bash_file)
@@ -380,9 +464,9 @@ def prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPasswo
         os.chdir('/')
 
         print("Running script ...")
-        cmd = './rhel_bash.sh'
-        out, err, ret = exec_cmd(cmd)
-        print("shell script :", out)
+        cmd = ['./rhel_bash.sh']
+        # The passwords are rendered into the script, keep them out of the logs
+        out, err, ret = exec_cmd(cmd, redact=[rhnPassword, osPassword])
         if ret != 0:
             print('ERROR: failed to run the script:', err)
             sys.exit(2)
@@ -392,70 +476,151 @@ def prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPasswo
         os.chroot('.')
         os.close(real_root)
         print("Unmounting all")
+        if repo_file and os.path.exists(repo_file):
+            os.unlink(repo_file)
+        for target in reversed(extra_mounts):
+            cmd = ['umount', target]
+            out, err, ret = exec_cmd(cmd)
+            if ret != 0:
+                print('ERROR: Failed to unmount the package cache:', err)
         for sdir in ('/proc', '/dev', '/sys', '/var/run/', '/etc/machine-id'):
-            cmd = 'umount ' + mount_dir + sdir
+            cmd = ['umount', mount_dir + sdir]
             out, err, ret = exec_cmd(cmd)
             if ret != 0:
                 print('ERROR: Failed to unmount the device:', err)
 
-        cmd = 'umount ' + mount_dir
+        cmd = ['umount', mount_dir]
         out, err, ret = exec_cmd(cmd)
         if ret != 0:
             print('ERROR: Failed to unmount device:', err)
 
         print("Freeing up loop device")
-        cmd = 'losetup -d ' + loop_device
+        cmd = ['losetup', '-d', loop_device]
         out, err, ret = exec_cmd(cmd)
         if ret != 0:
             print('ERROR: Failed to release the device:', err)
 
 
-def convert_qcow2_ova(imageUrl, imageSize, imageName, imageDist, rhnUser, rhnPassword, osPassword, tempDir):
+def convert_qcow2_ova(imageUrl, imageSize, imageName, imageDist, rhnUser, rhnPassword, osPassword, tempDir,
+                      imageSha256=None, downloadWorkers=downloader.DEFAULT_WORKERS,
+                      gzipLevel=pgzip.DEFAULT_LEVEL, gzipThreads=None, gzipBlockSize=pgzip.BLOCK_SIZE,
+                      sparseTar=False, noManifest=False, cacheDir=None, cacheSize=cache.DEFAULT_MAX_GB,
+                      workDir=None, resume=False, keepWorkDir=False, keepIntermediates=False, outputCodec=None,
+                      packageCache=None, packageCacheSize=rpmcache.DEFAULT_MAX_GB, rpmDir=None, cosClient=None,
+                      cosBucket=None, cosObject=None):
     current_dir = os.getcwd()
-    tmpdir = os.path.abspath(tempfile.mkdtemp(dir=tempDir))  # Temporary work directory
+    if workDir:
+        tmpdir = named_work_dir(workDir, imageName)  # can be resumed
+        os.makedirs(tmpdir, exist_ok=True)
+    else:
+        tmpdir = os.path.abspath(tempfile.mkdtemp(dir=tempDir))  # Temporary work directory
     image_file_name = get_image_name(imageUrl)  # Get image file name from url
     image_file_path = tmpdir + '/' + image_file_name
     extracted_qcow2_file_path = tmpdir + '/' + remove_extn(image_file_name)
+    local_qcow2 = not ingest.is_remote(imageUrl) and not image_file_name.endswith('.gz')
+    if local_qcow2:
+        extracted_qcow2_file_path = os.path.abspath(imageUrl)  # qemu-img only reads it, use it in place
+    elif not image_file_name.endswith('.gz'):
+        extracted_qcow2_file_path = image_file_path
     converted_images_dir = tmpdir + '/' + "image"
     extracted_raw_file_path = converted_images_dir + '/' + remove_extn(remove_extn(image_file_name))
     meta_data_file = converted_images_dir + '/' + imageName + '.meta'
     ovf_data_file = converted_images_dir + '/' + imageName + '.ovf'
-    ova_image_file = tmpdir + '/' + imageName + '.ova'
-    ova_gz_image_file = tmpdir + '/' + imageName + '.ova.gz'
-
-    try:
-        os.mkdir(converted_images_dir)  # Target directory to keep volume, meta and ovf files
-        if imageUrl.startswith('http://') or imageUrl.startswith('https://'):
-            print("Download image.......")
-            get_image(imageUrl, image_file_path)
-        else:
-            shutil.copyfile(imageUrl, image_file_path)
+    # gzip is what PowerVS imports, other codecs are for staging
+    output_codec = codec.parse(outputCodec) if outputCodec else codec.Codec('gzip', gzipLevel, '.ova.gz')
+    ova_image_file = tmpdir + '/' + imageName + output_codec.extension
+    ova_checksum_file = ova_image_file + '.sha256'
+    cos_object = cosObject or imageName + output_codec.extension
+
+    stage_cache = cache.StageCache(cacheDir, int(cacheSize * cache.GB)) if cacheDir else None
+    cache_key = get_cache_key(imageUrl, imageSha256) if stage_cache else None
+    package_cache = rpmcache.PackageCache(packageCache, int(packageCacheSize * rpmcache.GB)) if packageCache else None
+    rpm_dir = os.path.abspath(rpmDir) if rpmDir else None
+    if stage_cache and cache_key is None:
+        print("Warning: no ETag or sha256 known for", imageUrl, "hence not using the cache")
+        stage_cache = None
+
+    def fetch():
+        if local_qcow2:
+            print("Using local image", extracted_qcow2_file_path, "in place ....")
+            return
+        if stage_cache and stage_cache.contains(cache_key, 'raw'):
+            print("Raw image is cached, skipping the download ....")
+            return
+        download()
+
+    def download():
+        if stage_cache and stage_cache.restore(cache_key, 'qcow2', extracted_qcow2_file_path, link=True):
+            print("Using cached qcow2 image ....")
+            return
         if image_file_path.endswith(".gz"):
-            print("Extracting gz image...")
-            gzip_gunzip(image_file_path, extracted_qcow2_file_path, 65536)
+            print("Downloading and extracting gz image...")
+            get_gunzipped_image(imageUrl, extracted_qcow2_file_path, imageSha256)
         else:
-            extracted_qcow2_file_path = image_file_path
-
+            print("Download image.......")
+            get_image(imageUrl, image_file_path, imageSha256, downloadWorkers)
+        if stage_cache:
+            with metrics.stage('cache_store'):
+                stage_cache.store(cache_key, 'qcow2', extracted_qcow2_file_path, link=True)
+
+    def convert():
+        with metrics.stage('cache_restore') as stage:
+            raw_cached = stage_cache and stage_cache.restore(cache_key, 'raw', extracted_raw_file_path)
+            if raw_cached:
+                stage['bytes_out'] = sparse.sparse_info(extracted_raw_file_path).allocated
+        if raw_cached:
+            print("Using cached raw image ....")
+            return
+        if not os.path.exists(extracted_qcow2_file_path):
+            download()
         print("Converting to raw ....")
-        cmd = 'qemu-img convert -f qcow2 -O raw ' + extracted_qcow2_file_path + '  ' + extracted_raw_file_path
-        out, err, ret = exec_cmd(cmd)
-        if ret != 0:
-            print('ERROR: problem converting file (do you have qemu-img installed?)')
-            sys.exit(2)
+        with metrics.stage('convert') as stage:
+            cmd = ['qemu-img', 'convert', '-f', 'qcow2', '-O', 'raw', extracted_qcow2_file_path,
+                   extracted_raw_file_path]
+            out, err, ret = exec_cmd(cmd)
+            if ret != 0:
+                print('ERROR: problem converting file (do you have qemu-img installed?)')
+                sys.exit(2)
+            stage['bytes_in'] = get_file_size(extracted_qcow2_file_path)
+            stage['bytes_out'] = sparse.sparse_info(extracted_raw_file_path).allocated
+        if stage_cache:
+            with metrics.stage('cache_store'):
+                stage_cache.store(cache_key, 'raw', extracted_raw_file_path)
 
+    def resize():
         print("Resizing image ....")
-        cmd = 'qemu-img resize ' + extracted_raw_file_path + ' ' + imageSize + 'G'
-        out, err, ret = exec_cmd(cmd)
-        if ret != 0:
-            print('ERROR: Resizing failed')
-            sys.exit(2)
-
-        if imageDist == 'rhel' or imageDist == 'centos':
-            print("Preparing ", imageDist, " image...")
-            prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPassword, imageDist)
+        with metrics.stage('resize'):
+            cmd = ['qemu-img', 'resize', extracted_raw_file_path, imageSize + 'G']
+            out, err, ret = exec_cmd(cmd)
+            if ret != 0:
+                print('ERROR: Resizing failed')
+                sys.exit(2)
 
+    def prepare():
+        print("Preparing ", imageDist, " image...")
+        if rpm_dir:
+            try:
+                fetched = rpmcache.seed(rpm_dir)
+                if fetched:
+                    print("Seeded", rpm_dir, "with", ', '.join(fetched))
+            except downloader.DownloadError as e:
+                print("Warning: failed to seed", rpm_dir, "(", e, ") installing the missing pinned RPMs from their URLs")
+        with metrics.stage('prepare_rhel'):
+            if package_cache is None:
+                prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPassword, imageDist,
+                             rpm_dir=rpm_dir)
+                return
+            with package_cache.use():
+                prepare_rhel(extracted_raw_file_path, tmpdir, rhnUser, rhnPassword, osPassword, imageDist,
+                             package_cache, rpm_dir)
+            package_cache.prune()
+
+    def describe():
         print("Getting new image size...")
         volumesize = get_file_size(extracted_raw_file_path)
+        volume_info = sparse.sparse_info(extracted_raw_file_path)
+        print("Volume size:", volume_info.apparent, "bytes, allocated:", volume_info.allocated, "bytes, data:",
+              volume_info.data, "bytes")
 
         print("Preparing meta data file...")
         meta_data_template = Template(template_meta)
@@ -470,28 +635,107 @@ def convert_qcow2_ova(imageUrl, imageSize, imageName, imageDist, rhnUser, rhnPas
         with open(ovf_data_file, "w") as stream:
             stream.write(ovf_data)
 
-        print("Creating ova image...")
-        create_tar(converted_images_dir, ova_image_file)
-
-        print("Compressing ova file...")
-        gzip_gzip(ova_image_file, ova_gz_image_file)
+    def package():
+        print("Creating compressed ova image...")
+        create_ova_gz(converted_images_dir, ova_image_file, gzipLevel, gzipThreads, gzipBlockSize, sparseTar,
+                      not noManifest, output_codec)
+
+    def upload():
+        print("Creating compressed ova image and uploading it to", cosBucket + '/' + cos_object, "...")
+        upload_ova_gz(converted_images_dir, ova_image_file, cosClient, cosBucket, cos_object, gzipLevel, gzipThreads,
+                      gzipBlockSize, sparseTar, not noManifest, output_codec)
+
+    def publish():
+        if not cosBucket:
+            shutil.move(ova_image_file, os.path.join(current_dir, imageName + output_codec.extension))
+        shutil.move(ova_checksum_file, os.path.join(current_dir, imageName + output_codec.extension + '.sha256'))
+
+    # Intermediates (qcow2, raw volume, ...) are removed once their last consumer stage is done
+    pipe = pipeline.Pipeline(tmpdir, resume, reclaim=not keepIntermediates)
+    pipe.add('fetch', fetch, outputs=[extracted_qcow2_file_path], params={'imageUrl': imageUrl, 'imageSha256': imageSha256})
+    pipe.add('convert', convert, inputs=[extracted_qcow2_file_path], outputs=[extracted_raw_file_path])
+    pipe.add('resize', resize, inputs=[extracted_raw_file_path], outputs=[extracted_raw_file_path],
+             params={'imageSize': imageSize})
+    if imageDist == 'rhel' or imageDist == 'centos':
+        pipe.add('prepare', prepare, inputs=[extracted_raw_file_path], outputs=[extracted_raw_file_path],
+                 params={'imageDist': imageDist})
+    pipe.add('describe', describe, inputs=[extracted_raw_file_path], outputs=[meta_data_file, ovf_data_file],
+             params={'imageName': imageName})
+    package_params = {'codec': codec.spec(output_codec), 'gzipBlockSize': gzipBlockSize, 'sparseTar': sparseTar,
+                      'manifest': not noManifest}
+    if cosBucket:
+        # Only the checksum is kept locally, it records the completed upload
+        pipe.add('upload', upload, inputs=[extracted_raw_file_path, meta_data_file, ovf_data_file],
+                 outputs=[ova_checksum_file], params=dict(package_params, bucket=cosBucket, object=cos_object))
+        pipe.add('publish', publish, inputs=[ova_checksum_file])
+    else:
+        pipe.add('package', package, inputs=[extracted_raw_file_path, meta_data_file, ovf_data_file],
+                 outputs=[ova_image_file, ova_checksum_file], params=package_params)
+        pipe.add('publish', publish, inputs=[ova_image_file, ova_checksum_file])
 
-        shutil.move(ova_gz_image_file, current_dir)
+    succeeded = False
+    try:
+        os.makedirs(converted_images_dir, exist_ok=True)  # Target directory to keep volume, meta and ovf files
+        pipe.run()
+        succeeded = True
     finally:
-        shutil.rmtree(tmpdir)
+        if keepWorkDir:
+            print("Keeping the work directory", tmpdir)
+        elif workDir and not succeeded:
+            print("Keeping the work directory", tmpdir, "to --resume the conversion")
+        else:
+            shutil.rmtree(tmpdir)
+        metrics.recorder.write_prometheus()
+
 
+def named_work_dir(workDir, imageName):
+    # Own subdirectory of the named work directory, the only one ever removed
+    return os.path.join(os.path.abspath(workDir), 'convert-' + imageName)
 
-def check_tmp_freespace(imageSize, tempDir):
-    # Add 50GB buffer
-    buffer_gb = 50.0
-    required_gb = float(imageSize) + buffer_gb
 
-    # Calculate freespace in GB.
-    freespace_gb = shutil.disk_usage(tempDir)[2] / (1024 * 1024 * 1024)
+def _allocated(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def check_tmp_freespace(imageUrl, imageSize, imageDist, tempDir, keepIntermediates=False, upload=False, workDir=None,
+                        resume=False):
+    """Exit unless the filesystem of the scratch directory (tempDir, or workDir when given) has room for the pipeline.
+
+    On resume the stages already completed in the work directory are not
+    counted, and neither is the space its files already take.
+    """
+    # Peak scratch usage of the pipeline, derived from the source image
+    try:
+        plan = footprint.plan(imageUrl, imageSize, imageDist, reclaim=not keepIntermediates, upload=upload)
+    except (OSError, footprint.PlanError) as e:
+        print('ERROR: Failed to inspect the image:', e)
+        sys.exit(2)
+    peak = plan.peak
+    if resume and workDir:
+        completed = set(pipeline.completed_stages(workDir))
+        if 'upload' in completed:
+            completed.add('package')  # planned as package
+        remaining = [used for name, used in plan.stages if name not in completed]
+        peak = max(max(remaining, default=0) - _allocated(workDir), 0)
+    required_gb = round(peak / footprint.GB, 1)
+
+    # Calculate freespace in GB, in the first existing directory of the scratch path
+    scratch = os.path.abspath(workDir or tempDir)
+    while not os.path.exists(scratch):
+        scratch = os.path.dirname(scratch)
+    freespace_gb = shutil.disk_usage(scratch)[2] / (1024 * 1024 * 1024)
 
     if freespace_gb < required_gb:
-        print("Minimum ", required_gb, "GB", " space required in ", tempDir)
+        print("Minimum ", required_gb, "GB", " space required in ", scratch)
         sys.exit(2)
+    print("Peak scratch space needed:", required_gb, "GB,", round(freespace_gb, 1), "GB free in", scratch)
 
 
 def check_host_prereqs():
@@ -527,9 +771,45 @@ if __name__ == '__main__':
     parser.add_argument('-U', '--rhnUser', dest='rhnUser', help="RedHat Subscription username. Required when Image distribution is rhel")
     parser.add_argument('-P', '--rhnPassword', dest='rhnPassword',help="RedHat Subscription password. Required when Image distribution is rhel")
     parser.add_argument('-O', '--osPassword', dest='osPassword', help="Root user password. Required when Image distribution is rhel or centos")
+    parser.add_argument('--imageSha256', dest='imageSha256', help="Expected sha256 of the downloaded image, verified while downloading")
+    parser.add_argument('--downloadWorkers', dest='downloadWorkers', type=int, default=downloader.DEFAULT_WORKERS, help="Number of parallel range requests used to download the image. Default is %(default)s")
+    parser.add_argument('--gzipLevel', dest='gzipLevel', type=int, default=pgzip.DEFAULT_LEVEL, choices=range(0, 10), metavar='0-9', help="gzip compression level of the OVA image. Default is %(default)s")
+    parser.add_argument('--codec', dest='codec', help="Compression of the OVA image: gzip[:0-9], zstd[:1-22] (needs the zstandard package) or none. Only gzip images can be imported in PowerVS. Defaults to gzip at --gzipLevel")
+    parser.add_argument('--gzipThreads', dest='gzipThreads', type=int, help="Number of compression threads. Defaults to the number of CPUs")
+    parser.add_argument('--gzipBlockSize', dest='gzipBlockSize', type=int, default=pgzip.BLOCK_SIZE, help="Size in bytes of the blocks compressed in parallel. Default is %(default)s")
+    parser.add_argument('--sparseTar', dest='sparseTar', action='store_true', help="Store the volume as a GNU sparse tar member. Only use when the importing side supports sparse tar members")
+    parser.add_argument('--noManifest', dest='noManifest', action='store_true', help="Don't add the OVF manifest (.mf) with the SHA256 of every member to the OVA image")
+    parser.add_argument('--cacheDir', dest='cacheDir', help="Persistent directory to cache the downloaded and converted images across runs")
+    parser.add_argument('--cacheSize', dest='cacheSize', type=float, default=cache.DEFAULT_MAX_GB, help="Maximum size (in GB) of the cache directory. Default is %(default)s GB")
+    parser.add_argument('--skipSpaceCheck', dest='skipSpaceCheck', action='store_true', help="Don't check the free space in tempDir, used when a scheduler already reserved it")
+    parser.add_argument('--metricsFile', dest='metricsFile', help="Append per stage and per command timing, throughput and rusage records to this JSON lines file")
+    parser.add_argument('--promFile', dest='promFile', help="Write the stage metrics to this file in the Prometheus textfile collector format")
+    parser.add_argument('--commandTimeout', dest='commandTimeout', type=int, help="Kill any external command (qemu-img, the RHEL customization script, ...) running longer than this many seconds")
+    parser.add_argument('-W', '--workDir', dest='workDir', help="Directory for a named work directory (convert-<imageName>) keeping the pipeline state, required for --resume and kept when the conversion fails. Defaults to a new directory in tempDir")
+    parser.add_argument('--resume', dest='resume', action='store_true', help="Skip the stages already completed in workDir whose outputs are intact")
+    parser.add_argument('--packageCache', dest='packageCache', help="Persistent dnf/yum package cache directory mounted into the RHEL/CentOS chroot")
+    parser.add_argument('--packageCacheSize', dest='packageCacheSize', type=float, default=rpmcache.DEFAULT_MAX_GB, help="Maximum size (in GB) of the package cache. Default is %(default)s GB")
+    parser.add_argument('--rpmDir', dest='rpmDir', help="Local RPM directory or repository mirror mounted into the RHEL/CentOS chroot, seeded with the pinned RPMs (cloud-init, ibm-power-repo)")
+    parser.add_argument('--keepIntermediates', dest='keepIntermediates', action='store_true', help="Keep the intermediate qcow2 and raw images until the end of the run instead of removing them as soon as they are consumed")
+    parser.add_argument('--keepWorkDir', '--keep-workdir', dest='keepWorkDir', action='store_true', help="Don't remove the work directory at the end, also after a successful conversion")
+    parser.add_argument('--cosBucket', dest='cosBucket', help="Upload the OVA image to this IBM COS bucket while it is produced, instead of writing it to the current directory")
+    parser.add_argument('--cosRegion', dest='cosRegion', help="Region of the COS bucket (eg. us-south). Required with --cosBucket")
+    parser.add_argument('--cosObject', dest='cosObject', help="Object name of the uploaded OVA image. Defaults to <imageName> with the codec extension (eg. .ova.gz)")
+    parser.add_argument('--cosAccessKey', dest='cosAccessKey', help="COS bucket access key ID")
+    parser.add_argument('--cosSecretKey', dest='cosSecretKey', help="COS bucket secret access key")
+    parser.add_argument('--cosEndpoint', dest='cosEndpoint', help="S3 endpoint URL, defaults to the COS endpoint of --cosRegion")
     parser.add_argument('-T', '--tempDir', dest='tempDir', default=tempfile.gettempdir(), help="Scratch space to use for OVA generation (defaults to system specific temp directory, eg. '/tmp')")
 
     args = parser.parse_args()
+    if args.resume and not args.workDir:
+        parser.error("--resume requires --workDir")
+    if args.codec:
+        try:
+            codec.require(codec.parse(args.codec))
+        except codec.CodecError as e:
+            parser.error(str(e))
+    if args.cosBucket and not args.cosRegion and not args.cosEndpoint:
+        parser.error("--cosBucket requires --cosRegion")
     if args.imageDist == 'rhel' and (not args.rhnUser or not args.rhnPassword):
              print("RedHat subscription username and password are must when using RHEL distribution")
     if (args.imageDist == 'rhel' or args.imageDist == 'centos') and (not args.osPassword):
@@ -538,7 +818,23 @@ if __name__ == '__main__':
     # Check for host pre-reqs
     check_host_prereqs()
 
-    # Check free space in tempDir and if less than imageSize bail out
-    check_tmp_freespace(args.imageSize, args.tempDir)
+    runner.setup_logging()
+    command_timeout = args.commandTimeout
+    metrics.recorder.configure(args.metricsFile, args.promFile, image=args.imageName, distribution=args.imageDist)
 
-    convert_qcow2_ova(args.imageUrl, args.imageSize, args.imageName, args.imageDist, args.rhnUser, args.rhnPassword, args.osPassword, args.tempDir)
+    # Check free space in tempDir and if less than imageSize bail out
+    if not args.skipSpaceCheck:
+        check_tmp_freespace(args.imageUrl, args.imageSize, args.imageDist, args.tempDir, args.keepIntermediates,
+                            upload=bool(args.cosBucket),
+                            workDir=named_work_dir(args.workDir, args.imageName) if args.workDir else None,
+                            resume=args.resume)
+
+    cos_client = None
+    if args.cosBucket:
+        cos_client = multipart.cos_client(args.cosRegion, args.cosAccessKey, args.cosSecretKey, args.cosEndpoint)
+
+    convert_qcow2_ova(args.imageUrl, args.imageSize, args.imageName, args.imageDist, args.rhnUser, args.rhnPassword, args.osPassword, args.tempDir,
+                      args.imageSha256, args.downloadWorkers, args.gzipLevel, args.gzipThreads, args.gzipBlockSize,
+                      args.sparseTar, args.noManifest, args.cacheDir, args.cacheSize, args.workDir, args.resume, args.keepWorkDir,
+                      args.keepIntermediates, args.codec, args.packageCache, args.packageCacheSize, args.rpmDir,
+                      cos_client, args.cosBucket, args.cosObject)
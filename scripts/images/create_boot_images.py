@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
 import yaml
-import subprocess
-import json
+import os
+import shutil
 import sys
 import getopt
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ibmapi
+import inventory
+import jobs
+import runner
 
 help_message = """create_boot_images.py -a <accessKey> -s <secretKey> -i <imageManifestFile> -k <apiKey>
 
@@ -12,68 +20,167 @@ help_message = """create_boot_images.py -a <accessKey> -s <secretKey> -i <imageM
 -s, --secretKey                    IBM Cloud COS Service credential's secretkey
 -i, --imageManifest                default is image-manifest.yaml in the present directory
 -k, --apiKey                       apikey from the IBM Cloud IAM
+-c, --cacheFile                    JSON file keeping the workspaces and images between runs
+-t, --cacheTtl                     seconds a cached inventory is used before it is fetched again, default is 900
+-j, --maxJobs                      number of workspaces imported into in parallel, default is 4
+    --cli                          use the ibmcloud CLI instead of the IBM Cloud REST APIs
+    --apiEndpoint                  base URL replacing the IBM Cloud API endpoints (e.g. a local test server)
+    --deadline                     seconds to wait for the started imports to finish, default is 10800
+    --noWait                       don't wait for the started imports to finish
+
+The exit code is 2 when an import failed to start, failed, didn't finish before the deadline or
+returned no job ID to track it with.
 
 Requirements:
-    - Install ibmcloud CLI - https://cloud.ibm.com/docs/cli?topic=cli-install-ibmcloud-cli
-    - Install power-iaas plugin - https://cloud.ibm.com/docs/power-iaas-cli-plugin?topic=power-iaas-cli-plugin-power-iaas-cli-reference
+    - With --cli:
+      - Install ibmcloud CLI - https://cloud.ibm.com/docs/cli?topic=cli-install-ibmcloud-cli
+      - Install power-iaas plugin - https://cloud.ibm.com/docs/power-iaas-cli-plugin?topic=power-iaas-cli-plugin-power-iaas-cli-reference
     - Create a Service credential in the COS to get the accessKey and the secretKey
 """
 
 
 def exec_cmd(cmd):
-    cp = subprocess.run(cmd, universal_newlines=True,
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return cp.stdout, cp.stderr, cp.returncode
+    # Full output is captured for the JSON parsing, and never echoed since it may carry credentials
+    return runner.exec_cmd(cmd, capture=True, echo=False)
 
 
 def ibmcloud_login(apiKey):
     return exec_cmd(["ibmcloud", "login", "--apikey", apiKey, "--no-region", "-q"])
 
 
-def get_boot_images():
-    images = []
-    out, err, ret = exec_cmd(["ibmcloud", "pi", "images", "--json"])
-    if ret != 0:
-        raise Exception("Failed to get the images")
-    jsonout = json.loads(out)
-    for image in jsonout["Payload"]["images"]:
-        images.append(image["name"])
-    return images
+class WorkspaceResult:
+
+    def __init__(self, name):
+        self.name = name
+        self.imported = []
+        self.skipped = []
+        self.failed = []
+        self.jobs = []
+        self.seconds = 0.0
+
+
+def plan_imports(data, images):
+    """{CRN: (workspace, [manifest images])} in manifest order, the workspaces missing are reported."""
+    plan = {}
+    for image in data:
+        for instance in image["target"]["powerVSInstances"]:
+            resource = images.workspace(instance)
+            if resource is None:
+                print("Warning: PowerVS instance", instance, "not found, skipping it")
+                continue
+            plan.setdefault(resource["CRN"], (resource, []))[1].append(image)
+    return plan
+
 
+def import_images(accessKey, secretKey, resource, entries, session):
+    """Import entries into the workspace resource through session, return a WorkspaceResult."""
+    started = time.time()
+    result = WorkspaceResult(resource["Name"])
+    prefix = "[{}]".format(resource["Name"])
+    for image in entries:
+        name = image["target"]["imageName"]
+        print(prefix, "Importing", name, "from", image["source"])
+        try:
+            if session.has_image(resource["CRN"], name):
+                print(prefix, "Warning: This PowerVS instance already has an image name with ", name,
+                      " hence skipping the image-import")
+                result.skipped.append(name)
+                continue
+        except inventory.InventoryError as e:
+            print(prefix, "Failed to look up the images:", e)
+            result.failed.append(name)
+            continue
+        try:
+            job_id = session.import_image(resource["CRN"], image, accessKey, secretKey)
+        except inventory.InventoryError as e:
+            print(prefix, "Failed to image-import", e)
+            result.failed.append(name)
+            continue
+        print(prefix, "Import of", name, "started, job", job_id)
+        result.imported.append(name)
+        result.jobs.append(jobs.Job(resource["Name"], resource["CRN"], name, job_id))
+    result.seconds = time.time() - started
+    return result
+
+
+def isolated_exec_cmd(home):
+    """exec_cmd running the CLI with its own configuration (login, service target) in home."""
+    env = dict(os.environ, IBMCLOUD_HOME=home)
+
+    def run(cmd):
+        return runner.exec_cmd(cmd, capture=True, echo=False, env=env)
+    return run
+
+
+def import_isolated(accessKey, secretKey, apiKey, resource, entries, images):
+    # Own IBMCLOUD_HOME, so that the service target doesn't clobber the other workers'
+    home = tempfile.mkdtemp(prefix='ibmcloud-')
+    try:
+        plugins = os.path.join(os.environ.get('IBMCLOUD_HOME', os.path.expanduser('~')), '.bluemix', 'plugins')
+        if os.path.isdir(plugins):
+            os.makedirs(os.path.join(home, '.bluemix'))
+            os.symlink(plugins, os.path.join(home, '.bluemix', 'plugins'))  # share the installed power-iaas plugin
+        run = isolated_exec_cmd(home)
+        out, err, ret = run(["ibmcloud", "login", "--apikey", apiKey, "--no-region", "-q"])
+        if ret != 0:
+            print("[{}] Failed to login to IBM cloud".format(resource["Name"]), err)
+            result = WorkspaceResult(resource["Name"])
+            result.failed = [image["target"]["imageName"] for image in entries]
+            return result
+        return import_images(accessKey, secretKey, resource, entries, images.session(inventory.CliBackend(run)))
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
 
-def create_boot_image(accessKey, secretKey, imageManifest):
+
+def print_summary(results, seconds):
+    print("\n{:<30} {:>9} {:>8} {:>7} {:>9}".format("WORKSPACE", "IMPORTED", "SKIPPED", "FAILED", "SECONDS"))
+    for result in results:
+        print("{:<30} {:>9} {:>8} {:>7} {:>9.1f}".format(result.name, len(result.imported), len(result.skipped),
+                                                        len(result.failed), result.seconds))
+        for name in result.failed:
+            print("  failed:", name)
+    print("{} workspaces in {:.1f} seconds".format(len(results), seconds))
+
+
+def wait_for_imports(results, images, deadline=jobs.DEFAULT_DEADLINE):
+    """Poll the import jobs of results until they are done, return them."""
+    started = [job for result in results for job in result.jobs]
+    if not started:
+        return started
+    print("\nWaiting up to {} seconds for {} imports to finish...".format(deadline, len(started)))
+    jobs.track(started, lambda job: images.backend.job_status(job.crn, job.id), deadline)
+    jobs.print_table(started)
+    return started
+
+
+def create_boot_image(accessKey, secretKey, imageManifest, images=None, apiKey=None, maxJobs=1):
+    # Workspaces and their images are looked up in the inventory, fetched once
+    images = images or inventory.Inventory(inventory.CliBackend(exec_cmd))
     with open(imageManifest) as f:
         data = yaml.load(f, Loader=yaml.FullLoader)
-        for image in data:
-            out, err, ret = exec_cmd(
-                ["ibmcloud", "pi", "service-list", "--json"])
-            if ret != 0:
-                print("Failed to get the service-list, exiting!")
-                sys.exit(2)
-            y = json.loads(out)
-            for instance in image["target"]["powerVSInstances"]:
-                for resource in y:
-                    if resource["Name"] == instance:
-                        print("\nImporting...")
-                        print("Source: ", image["source"])
-                        print("PowerVS resource: ", resource["Name"])
-                        print("Boot Image Name: ",
-                              image["target"]["imageName"])
-                        out, err, ret = exec_cmd(
-                            ["ibmcloud", "pi", "service-target", resource["CRN"]])
-                        if ret != 0:
-                            print("Failed to set the service-target for ",
-                                  instance, " skipping to next powerVS resource!")
-                            continue
-                        if image["target"]["imageName"] in get_boot_images():
-                            print("Warning: This PowerVS instance already has an image name with ",
-                                  image["target"]["imageName"], " hence skipping the image-import")
-                            continue
-                        out, err, ret = exec_cmd(["ibmcloud", "pi", "image-import", image["target"]["imageName"], "--image-path", "s3.private."+image["source"]["region"] +
-                                                  ".cloud-object-storage.appdomain.cloud/"+image["source"]["bucket"]+"/"+image["source"]["object"], "--access-key", accessKey, "--secret-key", secretKey])
-                        if ret != 0:
-                            print("Failed to image-import", err)
-                            continue
+    try:
+        images.services()
+    except inventory.InventoryError as e:
+        print("Failed to get the service-list, exiting!", e)
+        sys.exit(2)
+    plan = plan_imports(data, images)
+    started = time.time()
+    if maxJobs <= 1 or len(plan) <= 1:
+        results = [import_images(accessKey, secretKey, resource, entries, images.default)
+                   for resource, entries in plan.values()]
+    elif isinstance(images.backend, inventory.ApiBackend):
+        # The REST client has no target state, the workers share it and its connection pool
+        with ThreadPoolExecutor(max_workers=maxJobs) as executor:
+            results = list(executor.map(
+                lambda item: import_images(accessKey, secretKey, item[0], item[1], images.default), plan.values()))
+    else:
+        with ThreadPoolExecutor(max_workers=maxJobs) as executor:
+            results = list(executor.map(
+                lambda item: import_isolated(accessKey, secretKey, apiKey, item[0], item[1], images), plan.values()))
+    images.save()
+    print_summary(results, time.time() - started)
+    print("{} IBM Cloud calls".format(images.calls))
+    return results
 
 
 def main(argv):
@@ -81,12 +188,26 @@ def main(argv):
     secretKey = ''
     imageManifest = 'image-manifest.yml'
     apiKey = ''
+    cacheFile = None
+    cacheTtl = inventory.DEFAULT_TTL
+    maxJobs = 4
+    useCli = False
+    apiEndpoint = None
+    deadline = jobs.DEFAULT_DEADLINE
+    waitImports = True
     try:
-        (opts, args) = getopt.getopt(argv, 'ha:s:i:k:', [
+        (opts, args) = getopt.getopt(argv, 'ha:s:i:k:c:t:j:', [
             'accessKey=',
             'secretKey=',
             'imageManifest=',
-            'apiKey='
+            'apiKey=',
+            'cacheFile=',
+            'cacheTtl=',
+            'maxJobs=',
+            'cli',
+            'apiEndpoint=',
+            'deadline=',
+            'noWait'
         ])
     except getopt.GetoptError:
         print(help_message)
@@ -103,11 +224,53 @@ def main(argv):
             imageManifest = arg
         elif opt in ('-k', '--apiKey'):
             apiKey = arg
-    out, err, ret = ibmcloud_login(apiKey)
-    if ret != 0:
-        print("Failed to login to IBM cloud", out, err)
+        elif opt in ('-c', '--cacheFile'):
+            cacheFile = arg
+        elif opt in ('-t', '--cacheTtl'):
+            try:
+                cacheTtl = int(arg)
+            except ValueError:
+                print(help_message)
+                sys.exit(2)
+        elif opt in ('-j', '--maxJobs'):
+            try:
+                maxJobs = int(arg)
+            except ValueError:
+                print(help_message)
+                sys.exit(2)
+        elif opt == '--cli':
+            useCli = True
+        elif opt == '--apiEndpoint':
+            apiEndpoint = arg
+        elif opt == '--deadline':
+            try:
+                deadline = int(arg)
+            except ValueError:
+                print(help_message)
+                sys.exit(2)
+        elif opt == '--noWait':
+            waitImports = False
+    if useCli:
+        out, err, ret = ibmcloud_login(apiKey)
+        if ret != 0:
+            print("Failed to login to IBM cloud", out, err)
+            sys.exit(2)
+        backend = inventory.CliBackend(exec_cmd)
+    else:
+        client = ibmapi.Client(apiKey, apiEndpoint)
+        try:
+            client.token()
+        except ibmapi.ApiError as e:
+            print("Failed to login to IBM cloud", e)
+            sys.exit(2)
+        backend = inventory.ApiBackend(client)
+    images = inventory.Inventory(backend, cacheFile, cacheTtl, inventory.account_key(apiKey))
+    results = create_boot_image(accessKey, secretKey, imageManifest, images, apiKey, maxJobs)
+    failed = any(result.failed for result in results)
+    if waitImports:
+        failed = any(job.failed for job in wait_for_imports(results, images, deadline)) or failed
+    if failed:
         sys.exit(2)
-    create_boot_image(accessKey, secretKey, imageManifest)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""Streaming, resumable and parallel HTTP(S) downloader.
+
+The image is never held in memory: data is streamed to disk in CHUNK_SIZE
+pieces. When the server honours HTTP Range requests the file is split into
+RANGE_SIZE ranges which are fetched in parallel over pooled keep-alive
+connections. Progress is persisted next to the partial file so an
+interrupted download only refetches the ranges that did not complete.
+Dropped connections, throttled (429) and failed (5xx) requests are retried
+with an exponential backoff, or after the delay of their Retry-After.
+"""
+
+import email.utils
+import hashlib
+import http.client
+import json
+import os
+import ssl
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from urllib.parse import urljoin, urlsplit
+
+CHUNK_SIZE = 1024 * 1024
+RANGE_SIZE = 64 * 1024 * 1024
+DEFAULT_WORKERS = 4
+MAX_RETRIES = 5
+MAX_REDIRECTS = 5
+TIMEOUT = 60
+# Longest Retry-After honoured, in seconds
+MAX_RETRY_AFTER = 300
+
+DownloadResult = namedtuple('DownloadResult', ['size', 'etag', 'sha256', 'seconds'])
+RemoteInfo = namedtuple('RemoteInfo', ['url', 'size', 'etag', 'ranges'])
+
+
+class DownloadError(Exception):
+    pass
+
+
+class RetryableStatus(http.client.HTTPException):
+    """A throttled (429) or failed (5xx) request, retried like a dropped connection."""
+
+    def __init__(self, url, resp):
+        super().__init__("{} returned HTTP {} {}".format(url, resp.status, resp.reason))
+        self.status = resp.status
+        self.retry_after = _retry_after(resp)
+
+
+def _retry_after(resp):
+    value = (resp.getheader('Retry-After') or '').strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _check_retryable(pool, url, resp):
+    """Raise RetryableStatus, dropping the connection, when resp is worth retrying."""
+    if resp.status == 429 or resp.status >= 500:
+        pool.discard(resp)
+        raise RetryableStatus(url, resp)
+
+
+def _backoff(attempt, error):
+    retry_after = getattr(error, 'retry_after', None)
+    time.sleep(min(retry_after, MAX_RETRY_AFTER) if retry_after is not None else min(2 ** attempt, 30))
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections shared between download workers."""
+
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout, context=self._ssl_context)
+        if scheme == 'http':
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise DownloadError("unsupported URL scheme: " + scheme)
+
+    def request(self, method, url, headers=None, body=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self._lock:
+            idle = self._idle.get(key, [])
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if conn is None:
+            conn = self._connect(parts.scheme, parts.netloc)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+            # The server closed an idle keep-alive connection, retry on a fresh one
+            conn = self._connect(parts.scheme, parts.netloc)
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+        resp.pool_key = key
+        resp.pool_conn = conn
+        return resp
+
+    def release(self, resp):
+        """Return the connection behind a fully consumed response to the pool."""
+        if resp.will_close or not resp.isclosed():
+            resp.pool_conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault(resp.pool_key, []).append(resp.pool_conn)
+
+    def discard(self, resp):
+        resp.pool_conn.close()
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+def probe(url, pool):
+    """Follow redirects and find out the size, ETag and Range support of url."""
+    attempt = 0
+    while True:
+        try:
+            return _probe(url, pool)
+        except (OSError, http.client.HTTPException) as e:
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                raise DownloadError("cannot reach {}: {}".format(url, e))
+            _backoff(attempt, e)
+
+
+def _probe(url, pool):
+    for _ in range(MAX_REDIRECTS + 1):
+        resp = pool.request('GET', url, {'Range': 'bytes=0-0'})
+        _check_retryable(pool, url, resp)
+        if resp.status in (301, 302, 303, 307, 308):
+            location = resp.getheader('Location')
+            resp.read()
+            pool.release(resp)
+            if not location:
+                raise DownloadError("redirect without Location from " + url)
+            url = urljoin(url, location)
+            continue
+        etag = resp.getheader('ETag')
+        if resp.status == 206:
+            content_range = resp.getheader('Content-Range', '')
+            resp.read()
+            pool.release(resp)
+            total = content_range.rpartition('/')[2]
+            size = int(total) if total.isdigit() else None
+            return RemoteInfo(url, size, etag, size is not None)
+        if resp.status == 200:
+            length = resp.getheader('Content-Length')
+            # Don't pull the whole body just to probe, drop the connection instead
+            pool.discard(resp)
+            return RemoteInfo(url, int(length) if length else None, etag, False)
+        pool.discard(resp)
+        raise DownloadError("GET {} failed with HTTP {} {}".format(url, resp.status, resp.reason))
+    raise DownloadError("too many redirects for " + url)
+
+
+def read_range(pool, info, start, end):
+    """Return bytes [start, end) of a remote file whose server supports Range requests."""
+    if not info.ranges:
+        raise DownloadError("{} does not support range requests".format(info.url))
+    headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+    resp = pool.request('GET', info.url, headers)
+    if resp.status != 206:
+        pool.discard(resp)
+        raise DownloadError("range request for {} returned HTTP {}".format(info.url, resp.status))
+    data = resp.read()
+    pool.release(resp)
+    return data
+
+
+class _State:
+    """Completed ranges of a partial download, persisted as JSON."""
+
+    def __init__(self, path, info, range_size):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        self.data = {'url': info.url, 'size': info.size, 'etag': info.etag, 'range_size': range_size}
+
+    def load(self, part_file):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not os.path.exists(part_file):
+            return
+        # Only trust saved progress when the remote object is unchanged
+        if all(saved.get(k) == v for k, v in self.data.items()) and self.data['etag']:
+            self.done = set(saved.get('done', []))
+
+    def mark(self, index):
+        with self.lock:
+            self.done.add(index)
+            data = dict(self.data, done=sorted(self.done))
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _PrefixHasher:
+    """Hash the contiguous completed prefix of the file while ranges arrive.
+
+    Ranges finish out of order, so each completed range is read back (from the
+    page cache) as soon as every range before it is also complete.
+    """
+
+    def __init__(self, fd, ranges):
+        self.fd = fd
+        self.ranges = ranges
+        self.sha = hashlib.sha256()
+        self.next = 0
+        self.finished = set()
+        self.lock = threading.Lock()
+
+    def complete(self, index):
+        with self.lock:
+            self.finished.add(index)
+            while self.next in self.finished:
+                start, end = self.ranges[self.next]
+                offset = start
+                while offset < end:
+                    block = os.pread(self.fd, min(CHUNK_SIZE, end - offset), offset)
+                    if not block:
+                        raise DownloadError("short read while hashing at offset {}".format(offset))
+                    self.sha.update(block)
+                    offset += len(block)
+                self.next += 1
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+def _fetch_range(pool, info, fd, start, end):
+    """Fetch bytes [start, end) into fd, retrying from the last written offset."""
+    offset = start
+    attempt = 0
+    while offset < end:
+        headers = {'Range': 'bytes={}-{}'.format(offset, end - 1)}
+        if info.etag:
+            headers['If-Range'] = info.etag
+        resp = None
+        try:
+            resp = pool.request('GET', info.url, headers)
+            _check_retryable(pool, info.url, resp)
+            if resp.status != 206:
+                pool.discard(resp)
+                raise DownloadError("range request for {} returned HTTP {}".format(info.url, resp.status))
+            if info.etag and resp.getheader('ETag', info.etag) != info.etag:
+                pool.discard(resp)
+                raise DownloadError("ETag of {} changed during download".format(info.url))
+            while offset < end:
+                block = resp.read(min(CHUNK_SIZE, end - offset))
+                if not block:
+                    raise http.client.IncompleteRead(b'')
+                os.pwrite(fd, block, offset)
+                offset += len(block)
+            resp.read()
+            pool.release(resp)
+        except DownloadError:
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            if resp is not None:
+                pool.discard(resp)
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                raise DownloadError("giving up on bytes {}-{} of {}: {}".format(offset, end - 1, info.url, e))
+            _backoff(attempt, e)
+
+
+def _download_ranges(pool, info, part_file, state_file, workers, range_size):
+    ranges = [(s, min(s + range_size, info.size)) for s in range(0, info.size, range_size)]
+    state = _State(state_file, info, range_size)
+    state.load(part_file)
+    if state.done:
+        print("Resuming download, {} of {} ranges already present".format(len(state.done), len(ranges)))
+    fd = os.open(part_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, info.size)
+        hasher = _PrefixHasher(fd, ranges)
+        for index in sorted(state.done):
+            hasher.complete(index)
+
+        def worker(index):
+            start, end = ranges[index]
+            _fetch_range(pool, info, fd, start, end)
+            state.mark(index)
+            hasher.complete(index)
+
+        pending = [i for i in range(len(ranges)) if i not in state.done]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(worker, i) for i in pending]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            # Stop at the first failed range instead of downloading the rest of the file first
+            for future in not_done:
+                future.cancel()
+            for future in done:
+                future.result()
+        os.fsync(fd)
+        return hasher.hexdigest()
+    finally:
+        os.close(fd)
+
+
+def _download_stream(pool, info, part_file):
+    """Sequential download for servers without Range support or a known size."""
+    attempt = 0
+    while True:
+        sha = hashlib.sha256()
+        size = 0
+        resp = None
+        try:
+            resp = pool.request('GET', info.url)
+            _check_retryable(pool, info.url, resp)
+            if resp.status != 200:
+                raise DownloadError("GET {} failed with HTTP {} {}".format(info.url, resp.status, resp.reason))
+            with open(part_file, 'wb') as out:
+                while True:
+                    block = resp.read(CHUNK_SIZE)
+                    if not block:
+                        break
+                    sha.update(block)
+                    out.write(block)
+                    size += len(block)
+            pool.release(resp)
+            if info.size is not None and size != info.size:
+                raise http.client.IncompleteRead(b'', info.size - size)
+            return sha.hexdigest()
+        except (OSError, http.client.HTTPException) as e:
+            if resp is not None:
+                pool.discard(resp)
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                raise DownloadError("giving up on {}: {}".format(info.url, e))
+            _backoff(attempt, e)
+
+
+class HTTPStream:
+    """Sequential, file-like reader over url that resumes after dropped connections.
+
+    When the server supports Range requests a failed read is retried from the
+    current offset, so the consumer never sees the interruption.
+    """
+
+    def __init__(self, url, pool=None):
+        self._own_pool = pool is None
+        self.pool = pool or ConnectionPool()
+        self.info = probe(url, self.pool)
+        self.offset = 0
+        self.resp = None
+        self.attempt = 0
+
+    def _open(self):
+        headers = {}
+        if self.offset:
+            if not self.info.ranges:
+                raise DownloadError("connection to {} dropped and the server does not support resuming".format(self.info.url))
+            headers['Range'] = 'bytes={}-'.format(self.offset)
+            if self.info.etag:
+                headers['If-Range'] = self.info.etag
+        resp = self.pool.request('GET', self.info.url, headers)
+        _check_retryable(self.pool, self.info.url, resp)
+        if resp.status != (206 if self.offset else 200):
+            self.pool.discard(resp)
+            raise DownloadError("GET {} failed with HTTP {} {}".format(self.info.url, resp.status, resp.reason))
+        self.resp = resp
+
+    def read(self, size=CHUNK_SIZE):
+        while True:
+            try:
+                if self.resp is None:
+                    self._open()
+                block = self.resp.read(size)
+                if not block and self.info.size is not None and self.offset < self.info.size:
+                    raise http.client.IncompleteRead(b'', self.info.size - self.offset)
+            except (OSError, http.client.HTTPException) as e:
+                if self.resp is not None:
+                    self.pool.discard(self.resp)
+                    self.resp = None
+                self.attempt += 1
+                if self.attempt > MAX_RETRIES:
+                    raise DownloadError("giving up on {} at offset {}: {}".format(self.info.url, self.offset, e))
+                _backoff(self.attempt, e)
+                continue
+            self.attempt = 0  # the retries are counted per failure, not over the whole stream
+            self.offset += len(block)
+            return block
+
+    def close(self):
+        if self.resp is not None:
+            self.pool.discard(self.resp)
+            self.resp = None
+        if self._own_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def download(url, dest, workers=DEFAULT_WORKERS, range_size=RANGE_SIZE, sha256=None, pool=None):
+    """Download url to dest and return a DownloadResult.
+
+    Data is written to dest + '.part' and renamed into place only after the
+    size (and sha256, if given) have been verified, so a failed run can be
+    restarted and will resume from the ranges already on disk.
+    """
+    started = time.time()
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool()
+    part_file = dest + '.part'
+    state_file = part_file + '.json'
+    try:
+        info = probe(url, pool)
+        if info.ranges and info.size > 0:
+            digest = _download_ranges(pool, info, part_file, state_file, max(1, workers), range_size)
+        else:
+            digest = _download_stream(pool, info, part_file)
+        size = os.path.getsize(part_file)
+        if info.size is not None and size != info.size:
+            raise DownloadError("size mismatch for {}: expected {} bytes, got {}".format(url, info.size, size))
+        if sha256 and digest != sha256.lower():
+            os.unlink(part_file)
+            _State(state_file, info, range_size).remove()
+            raise DownloadError("sha256 mismatch for {}: expected {}, got {}".format(url, sha256, digest))
+        os.replace(part_file, dest)
+        _State(state_file, info, range_size).remove()
+        return DownloadResult(size, info.etag, digest, time.time() - started)
+    finally:
+        if own_pool:
+            pool.close()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Peak scratch space planner for a conversion.
+
+The scratch usage of every pipeline stage is derived from the source itself
+rather than guessed from the target size:
+
+- the qcow2 size: the download size, or the gzip ISIZE trailer for gzipped
+  sources (nothing for a local plain qcow2, which is read in place)
+- the allocation of the raw volume: the data clusters reported by
+  `qemu-img map` when the qcow2 is local, else its virtual size read from the
+  qcow2 header, an upper bound since qemu-img writes the raw volume sparse
+- the compressed OVA: at most its data plus the deflate overhead, the holes
+  of the resized volume compress more than 1000:1, nothing when it is
+  uploaded while it is produced
+
+The intermediates are removed as soon as their last consumer finished, so
+the peak is the largest sum of the files alive at the same time.
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import zlib
+from collections import namedtuple
+
+import downloader
+import ingest
+import runner
+
+GB = 1024 * 1024 * 1024
+MB = 1024 * 1024
+HEAD_SIZE = 64 * 1024
+# Growth of the raw volume while the RHEL/CentOS image is customized (yum update, ...)
+PREPARE_GB = 10
+QCOW2_MAGIC = b'QFI\xfb'
+
+SourceInfo = namedtuple('SourceInfo', ['size', 'gzipped', 'qcow2_size', 'virtual_size'])
+Plan = namedtuple('Plan', ['peak', 'stages', 'qcow2_size', 'virtual_size', 'raw_allocated'])
+
+
+class PlanError(Exception):
+    pass
+
+
+def _virtual_size(head, source):
+    if head[:4] != QCOW2_MAGIC or len(head) < 32:
+        raise PlanError("{} is not a qcow2 image".format(source))
+    return struct.unpack('>Q', head[24:32])[0]
+
+
+def _gunzip_head(data, source):
+    try:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data, HEAD_SIZE)
+    except zlib.error as e:
+        raise PlanError("{} is not a gzip file: {}".format(source, e))
+
+
+def _qcow2_upper_bound(virtual_size):
+    # Fully allocated qcow2: the data, 8 bytes of L2 table per 64 KiB cluster, refcounts and headers
+    return virtual_size + virtual_size // 4096 + 16 * MB
+
+
+def _gunzipped_size(isize, compressed, virtual_size):
+    """Safe estimate of the size of the qcow2 in a .gz of compressed bytes whose ISIZE trailer is isize.
+
+    ISIZE is the size modulo 2^32 and a qcow2 can compress to much less than
+    its size, so only the bounds pin it down: it is not much smaller than the
+    .gz (stored blocks add 5 bytes per 64 KiB) nor bigger than a fully
+    allocated qcow2. The largest size matching ISIZE within the bounds is
+    never below the real one.
+    """
+    upper = _qcow2_upper_bound(virtual_size)
+    if upper < isize:
+        return upper
+    size = isize + (upper - isize) // (1 << 32) * (1 << 32)
+    return max(size, compressed - compressed // 1000 - 1024)
+
+
+def inspect_source(source, pool=None):
+    """Size of the source, and size and virtual size of the qcow2 it contains."""
+    gzipped = source.endswith('.gz')
+    trailer = None
+    if ingest.is_remote(source):
+        own_pool = pool is None
+        pool = pool or downloader.ConnectionPool()
+        try:
+            info = downloader.probe(source, pool)
+            size = info.size
+            if info.ranges:
+                head = downloader.read_range(pool, info, 0, min(HEAD_SIZE, size))
+                if gzipped:
+                    trailer = downloader.read_range(pool, info, size - 4, size)
+            else:
+                with downloader.HTTPStream(source, pool) as stream:
+                    head = stream.read(HEAD_SIZE)
+        except downloader.DownloadError as e:
+            raise PlanError("cannot inspect {}: {}".format(source, e))
+        finally:
+            if own_pool:
+                pool.close()
+    else:
+        with open(source, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            head = f.read(HEAD_SIZE)
+            if gzipped:
+                f.seek(-4, os.SEEK_END)
+                trailer = f.read(4)
+    if gzipped:
+        virtual_size = _virtual_size(_gunzip_head(head, source), source)
+        if trailer is not None and size is not None:
+            qcow2_size = _gunzipped_size(struct.unpack('<I', trailer)[0], size, virtual_size)
+        else:
+            qcow2_size = _qcow2_upper_bound(virtual_size)
+    else:
+        virtual_size = _virtual_size(head, source)
+        qcow2_size = size if size is not None else _qcow2_upper_bound(virtual_size)
+    return SourceInfo(size, gzipped, qcow2_size, virtual_size)
+
+
+def raw_allocation(qcow2_path):
+    """Bytes qemu-img convert writes for qcow2_path, None when qemu-img can't tell."""
+    result = runner.run(['qemu-img', 'map', '--output=json', '-f', 'qcow2', qcow2_path], capture=True, echo=False)
+    if result.returncode != 0:
+        return None
+    try:
+        extents = json.loads(result.stdout)
+    except ValueError:
+        return None
+    return sum(e['length'] for e in extents if e.get('data') and not e.get('zero'))
+
+
+def compute(info, image_size, dist, in_place=False, reclaim=True, raw_allocated=None, upload=False):
+    """Plan the scratch usage of a conversion from what is known about its source."""
+    qcow2 = 0 if in_place else info.qcow2_size
+    raw = raw_allocated if raw_allocated is not None else info.virtual_size
+    target = max(int(float(image_size) * GB), info.virtual_size)
+    growth = PREPARE_GB * GB if dist in ('rhel', 'centos') else 0
+    ova_gz = 0 if upload else raw + growth + (raw + growth) // 1000 + target // 1000 + MB
+    kept = 0 if reclaim else qcow2
+    stages = [('fetch', qcow2), ('convert', qcow2 + raw), ('resize', kept + raw)]
+    if growth:
+        stages.append(('prepare', kept + raw + growth))
+    stages.append(('package', kept + raw + growth + ova_gz))
+    return Plan(max(used for _, used in stages), stages, info.qcow2_size, info.virtual_size, raw)
+
+
+def plan(source, image_size, dist, reclaim=True, pool=None, upload=False):
+    """Peak scratch requirement in bytes (Plan.peak) of converting source."""
+    info = inspect_source(source, pool)
+    in_place = not ingest.is_remote(source) and not info.gzipped
+    raw_allocated = raw_allocation(source) if in_place else None
+    return compute(info, image_size, dist, in_place, reclaim, raw_allocated, upload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the peak scratch space a conversion needs")
+    parser.add_argument('-u', '--imageUrl', dest='imageUrl', required=True, help="URL or absolute local file path to the <QCOW2>.gz image")
+    parser.add_argument('-s', '--imageSize', dest='imageSize', default='120', help="Size (in GB) of the resultant OVA image. Default size is 120 GB")
+    parser.add_argument('-d', '--imageDist', dest='imageDist', required=True, choices=['coreos', 'rhel', 'centos'], help="Image distribution: coreos|rhel|centos")
+    parser.add_argument('--keepIntermediates', dest='keepIntermediates', action='store_true', help="Plan for a conversion keeping its intermediate files")
+    parser.add_argument('--upload', dest='upload', action='store_true', help="Plan for a conversion uploading the OVA while it is produced")
+    parser.add_argument('--json', dest='json', action='store_true', help="Print the plan as JSON")
+    args = parser.parse_args()
+
+    try:
+        result = plan(args.imageUrl, args.imageSize, args.imageDist, reclaim=not args.keepIntermediates, upload=args.upload)
+    except (OSError, PlanError) as e:
+        print("ERROR:", e)
+        sys.exit(2)
+    if args.json:
+        print(json.dumps(result._asdict(), indent=2))
+        return
+    for name, used in result.stages:
+        print("{:<10} {:>10.1f} GB".format(name, used / GB))
+    print("Peak scratch space: {} bytes ({:.1f} GB)".format(result.peak, result.peak / GB))
+
+
+if __name__ == '__main__':
+    main()
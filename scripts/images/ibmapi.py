@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""Minimal IBM Cloud REST client for the PowerVS and access-control scripts.
+
+Replaces one `ibmcloud` process per call (CLI startup, plugin loading,
+config re-read, JSON re-parsed from stdout) with requests over pooled
+keep-alive connections:
+
+- the IAM token obtained from the API key is reused until shortly before it
+  expires, the account ID is read from its claims; a request rejected with
+  401 is sent once more with a new token
+- throttled requests (429) are sent again after their Retry-After
+- paginated lists (next_url, next.href) are followed transparently
+- only the operations the scripts use are covered: PowerVS workspaces
+  (resource controller), their images and COS imports (pcloud API), account
+  users and invites (user management), access groups and their members
+
+Every service URL can be pointed to another base URL (private endpoints, a
+local stand-in server for testing).
+"""
+
+import base64
+import json
+import threading
+import time
+from urllib.parse import urlencode, urljoin
+
+import downloader
+
+IAM_URL = 'https://iam.cloud.ibm.com'
+RESOURCE_CONTROLLER_URL = 'https://resource-controller.cloud.ibm.com'
+USER_MANAGEMENT_URL = 'https://user-management.cloud.ibm.com'
+ACCESS_GROUPS_URL = 'https://iam.cloud.ibm.com'
+POWER_URL = 'https://{region}.power-iaas.cloud.ibm.com'
+# Resource ID of the Power Systems Virtual Server service in the catalog
+POWER_RESOURCE_ID = 'abd259f0-9990-11e8-acc8-b9f54a8f1661'
+PAGE_SIZE = 100
+# Renew the token this many seconds before it expires
+TOKEN_MARGIN = 60
+# PowerVS zone (CRN location) to API region
+ZONE_REGIONS = {
+    'dal': 'us-south', 'us-south': 'us-south', 'wdc': 'us-east', 'us-east': 'us-east',
+    'fra': 'eu-de', 'eu-de': 'eu-de', 'lon': 'lon', 'syd': 'syd', 'tok': 'tok', 'osa': 'osa',
+    'tor': 'tor', 'mon': 'mon', 'sao': 'sao', 'mad': 'mad', 'che': 'che',
+}
+
+
+class ApiError(Exception):
+
+    def __init__(self, message, status=None, body=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+
+def _claims(token):
+    payload = token.split('.')[1]
+    return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+
+
+def crn_region(crn):
+    """API region of a PowerVS workspace CRN (crn:v1:bluemix:public:power-iaas:<zone>:a/<account>:<guid>::)."""
+    zone = crn.split(':')[5]
+    prefix = zone.rstrip('0123456789').rstrip('-')  # dal12 -> dal, eu-de-1 -> eu-de
+    return ZONE_REGIONS.get(zone) or ZONE_REGIONS.get(prefix) or prefix
+
+
+def crn_guid(crn):
+    return crn.split(':')[7]
+
+
+class Client:
+
+    def __init__(self, api_key, endpoint=None, timeout=downloader.TIMEOUT):
+        """endpoint, when set, replaces the base URL of every service."""
+        self.api_key = api_key
+        self.endpoint = endpoint.rstrip('/') if endpoint else None
+        self.pool = downloader.ConnectionPool(timeout)
+        self._token = None
+        self._expires = 0
+        self._account = None
+        self._lock = threading.Lock()
+        self._groups = None
+        self.requests = 0
+
+    def close(self):
+        self.pool.close()
+
+    def _url(self, base, path, query=None):
+        url = (self.endpoint or base) + path
+        return url + '?' + urlencode(query) if query else url
+
+    def _send(self, method, url, headers, body=None):
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                resp = self.pool.request(method, url, headers, body)
+                data = resp.read()
+            except OSError as e:
+                raise ApiError("{} {} failed: {}".format(method, url, e))
+            self.pool.release(resp)
+            if resp.status < 400:
+                return json.loads(data) if data else {}
+            error = ApiError("{} {} failed with HTTP {}: {}".format(method, url, resp.status,
+                                                                    data.decode(errors='replace')[:500]),
+                             resp.status, data, downloader._retry_after(resp))
+            # A throttled request wasn't processed, even a POST can be sent again
+            if resp.status != 429 or attempt >= downloader.MAX_RETRIES:
+                raise error
+            attempt += 1
+            downloader._backoff(attempt, error)
+
+    def token(self):
+        """IAM access token, renewed when it is about to expire."""
+        with self._lock:
+            if self._token is None or time.time() > self._expires - TOKEN_MARGIN:
+                body = urlencode({'grant_type': 'urn:ibm:params:oauth:grant-type:apikey', 'apikey': self.api_key})
+                resp = self._send('POST', self._url(IAM_URL, '/identity/token'),
+                                  {'Content-Type': 'application/x-www-form-urlencoded',
+                                   'Accept': 'application/json'}, body)
+                self._token = resp['access_token']
+                self._expires = resp.get('expiration') or time.time() + resp.get('expires_in', 3600)
+                self._account = _claims(self._token).get('account', {}).get('bss')
+            return self._token
+
+    @property
+    def account(self):
+        self.token()
+        return self._account
+
+    def _expire(self, token):
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def call(self, method, url, body=None, headers=None):
+        if body is not None:
+            body = json.dumps(body)
+        for renewed in (False, True):
+            token = self.token()
+            all_headers = {'Authorization': 'Bearer ' + token, 'Accept': 'application/json'}
+            if body is not None:
+                all_headers['Content-Type'] = 'application/json'
+            all_headers.update(headers or {})
+            try:
+                return self._send(method, url, all_headers, body)
+            except ApiError as e:
+                if e.status != 401 or renewed:
+                    raise
+                self._expire(token)  # revoked or expired early, get a new one
+
+    def pages(self, url, key, headers=None):
+        """Items under key of every page of a list, following next_url or next.href."""
+        while url:
+            resp = self.call('GET', url, headers=headers)
+            for item in resp.get(key) or []:
+                yield item
+            following = resp.get('next_url') or (resp.get('next') or {}).get('href')
+            url = urljoin(url, following) if following else None
+
+    # PowerVS
+
+    def power_workspaces(self):
+        """PowerVS workspaces (resource instances) of the account."""
+        return list(self.pages(self._url(RESOURCE_CONTROLLER_URL, '/v2/resource_instances',
+                                         {'resource_id': POWER_RESOURCE_ID, 'limit': PAGE_SIZE}), 'resources'))
+
+    def _power_url(self, crn, path):
+        return self._url(POWER_URL.format(region=crn_region(crn)),
+                         '/pcloud/v1/cloud-instances/{}{}'.format(crn_guid(crn), path))
+
+    def images(self, crn):
+        """Boot images of the workspace crn."""
+        return self.call('GET', self._power_url(crn, '/images'), headers={'CRN': crn}).get('images', [])
+
+    def import_image(self, crn, name, region, bucket, key, access_key, secret_key):
+        """Start the import of a COS object as image name, return the job reference."""
+        url = self._power_url(crn, '/cos-images')
+        body = {'imageName': name, 'bucketName': bucket, 'imageFilename': key, 'region': region,
+                'accessKey': access_key, 'secretKey': secret_key, 'bucketAccess': 'private'}
+        return self.call('POST', url, body, headers={'CRN': crn})
+
+    def job(self, crn, job_id):
+        return self.call('GET', self._power_url(crn, '/jobs/' + job_id), headers={'CRN': crn})
+
+    # Account users and access groups
+
+    def users(self):
+        return list(self.pages(self._url(USER_MANAGEMENT_URL, '/v2/accounts/{}/users'.format(self.account),
+                                         {'limit': PAGE_SIZE}), 'resources'))
+
+    def invite_user(self, email):
+        url = self._url(USER_MANAGEMENT_URL, '/v2/accounts/{}/users'.format(self.account))
+        return self.call('POST', url, {'users': [{'email': email, 'account_role': 'Member'}]})
+
+    def access_groups(self):
+        """{name: group ID} of the access groups of the account."""
+        with self._lock:
+            groups = self._groups
+        if groups is None:
+            groups = {g['name']: g['id'] for g in self.pages(
+                self._url(ACCESS_GROUPS_URL, '/v2/groups', {'account_id': self.account, 'limit': PAGE_SIZE}),
+                'groups')}
+            with self._lock:
+                self._groups = groups
+        return groups
+
+    def _group_id(self, name):
+        groups = self.access_groups()
+        if name not in groups:
+            raise ApiError("access group {} not found".format(name), 404)
+        return groups[name]
+
+    def group_members(self, group):
+        return list(self.pages(self._url(ACCESS_GROUPS_URL, '/v2/groups/{}/members'.format(self._group_id(group)),
+                                         {'limit': PAGE_SIZE}), 'members'))
+
+    def add_group_members(self, group, iam_ids):
+        url = self._url(ACCESS_GROUPS_URL, '/v2/groups/{}/members'.format(self._group_id(group)))
+        return self.call('PUT', url, {'members': [{'iam_id': iam_id, 'type': 'user'} for iam_id in iam_ids]})
+
+    def remove_group_member(self, group, iam_id):
+        url = self._url(ACCESS_GROUPS_URL, '/v2/groups/{}/members/{}'.format(self._group_id(group), iam_id))
+        return self.call('DELETE', url)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Streaming ingest of (gzipped) source images.
+
+The compressed image is decompressed while it is read, from HTTP(S) or from a
+local path, so only the decompressed qcow2 is ever written to scratch space.
+Reading runs on its own thread and hands chunks to the decompressor through a
+bounded queue, so network (or disk) reads overlap with inflate.
+"""
+
+import hashlib
+import queue
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+import downloader
+
+CHUNK_SIZE = downloader.CHUNK_SIZE
+QUEUE_DEPTH = 16
+
+IngestResult = namedtuple('IngestResult', ['bytes_in', 'bytes_out', 'sha256', 'seconds'])
+
+
+class IngestError(Exception):
+    pass
+
+
+def is_remote(source):
+    return source.startswith('http://') or source.startswith('https://')
+
+
+def open_source(source, pool=None):
+    """Return a readable binary stream for a URL or a local file path."""
+    if is_remote(source):
+        return downloader.HTTPStream(source, pool)
+    return open(source, 'rb')
+
+
+def _reader(stream, chunks, errors, stop):
+    try:
+        while not stop.is_set():
+            block = stream.read(CHUNK_SIZE)
+            chunks.put(block)
+            if not block:
+                return
+    except Exception as e:
+        errors.append(e)
+        chunks.put(None)
+
+
+def stream_gunzip(source, dest, sha256=None, pool=None):
+    """Decompress the gzip stream at source (URL or path) into dest.
+
+    Multi-member gzip files are handled like gzip(1) does. sha256, if given,
+    is checked against the compressed input as it is read.
+    """
+    started = time.time()
+    digest = hashlib.sha256()
+    chunks = queue.Queue(maxsize=QUEUE_DEPTH)
+    errors = []
+    stop = threading.Event()
+    bytes_in = bytes_out = 0
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_started = False
+
+    with open_source(source, pool) as stream, open(dest, 'wb') as out:
+        reader = threading.Thread(target=_reader, args=(stream, chunks, errors, stop), daemon=True)
+        reader.start()
+        try:
+            while True:
+                block = chunks.get()
+                if block is None:
+                    raise IngestError("failed to read {}: {}".format(source, errors[0]))
+                if not block:
+                    break
+                bytes_in += len(block)
+                digest.update(block)
+                while block:
+                    data = inflater.decompress(block)
+                    member_started = True
+                    out.write(data)
+                    bytes_out += len(data)
+                    if not inflater.eof:
+                        break
+                    # Concatenated gzip members, start a new inflater on the remainder
+                    block = inflater.unused_data
+                    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    member_started = False
+            if member_started and not inflater.eof:
+                raise IngestError("{} is truncated: unexpected end of gzip stream".format(source))
+        except zlib.error as e:
+            raise IngestError("failed to decompress {}: {}".format(source, e))
+        finally:
+            stop.set()
+            # Unblock the reader if it is waiting on a full queue
+            while reader.is_alive():
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    reader.join(0.1)
+
+    if sha256 and digest.hexdigest() != sha256.lower():
+        raise IngestError("sha256 mismatch for {}: expected {}, got {}".format(source, sha256, digest.hexdigest()))
+    return IngestResult(bytes_in, bytes_out, digest.hexdigest(), time.time() - started)
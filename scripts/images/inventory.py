@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""Snapshot of the PowerVS workspaces and of their boot images.
+
+Every `ibmcloud pi` call costs seconds of CLI startup and authentication, so
+the service list is fetched once and the image list once per workspace, and
+both are indexed in memory: workspaces by name and CRN, images by name.
+The snapshot can be saved to a JSON file and reused by the next runs while
+it is younger than its TTL.
+
+Only an import changes what the snapshot holds; the imported image is added
+to the index right away and its workspace is refetched by the next run, the
+other workspaces are not fetched again.
+
+The lookups and imports go through a backend: the ibmcloud CLI, or the REST
+API (ibmapi). `ibmcloud pi images` lists the images of the targeted
+workspace, and the target is state of the CLI configuration, so every
+worker gets its own backend, bound to its own IBMCLOUD_HOME; Sessions of
+different backends run in parallel over the same inventory.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import ibmapi
+
+DEFAULT_TTL = 900
+
+
+class InventoryError(Exception):
+    pass
+
+
+def _json(exec_cmd, cmd, what):
+    out, err, ret = exec_cmd(cmd)
+    if ret != 0:
+        raise InventoryError("failed to get the {}: {}".format(what, err.strip()))
+    try:
+        return json.loads(out)
+    except ValueError as e:
+        raise InventoryError("failed to parse the {}: {}".format(what, e))
+
+
+def list_services(exec_cmd):
+    """PowerVS workspaces of the account, as returned by `ibmcloud pi service-list`."""
+    return _json(exec_cmd, ["ibmcloud", "pi", "service-list", "--json"], "service-list")
+
+
+def list_images(exec_cmd):
+    """{name: image ID} of the boot images of the targeted workspace."""
+    payload = _json(exec_cmd, ["ibmcloud", "pi", "images", "--json"], "images")
+    return {image["name"]: image.get("imageID") for image in payload["Payload"]["images"]}
+
+
+def parse_job_id(out):
+    """Job ID in the output of `ibmcloud pi image-import`, None when there is none."""
+    try:
+        answer = json.loads(out)
+        if isinstance(answer, dict) and answer.get("id"):
+            return answer["id"]
+    except ValueError:
+        pass
+    match = re.search(r"[Jj]ob(?:\s*ID)?\W+([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})", out)
+    return match.group(1) if match else None
+
+
+def job_state(job):
+    """(state, message) of a PowerVS job document."""
+    status = job.get("status") or {}
+    return (status.get("state") or "unknown").lower(), status.get("message") or ""
+
+
+def account_key(api_key):
+    # Tells apart the snapshots of different accounts without storing the key
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16] if api_key else None
+
+
+class CliBackend:
+    """Workspaces, images and imports through the ibmcloud CLI."""
+
+    def __init__(self, exec_cmd):
+        self.exec_cmd = exec_cmd
+        self.target_crn = None
+        self.calls = 0
+        # A target and the command using it must not interleave with another thread's
+        self.lock = threading.RLock()
+
+    def services(self):
+        self.calls += 1
+        return list_services(self.exec_cmd)
+
+    def target(self, crn):
+        """Make crn the target of the following `ibmcloud pi` commands."""
+        if self.target_crn == crn:
+            return
+        self.calls += 1
+        out, err, ret = self.exec_cmd(["ibmcloud", "pi", "service-target", crn])
+        if ret != 0:
+            self.target_crn = None
+            raise InventoryError("failed to set the service-target {}: {}".format(crn, err.strip()))
+        self.target_crn = crn
+
+    def images(self, crn):
+        with self.lock:
+            self.target(crn)
+            self.calls += 1
+            return list_images(self.exec_cmd)
+
+    def import_image(self, crn, name, source, access_key, secret_key):
+        """Start the import, return its job ID (None when the CLI didn't print it)."""
+        with self.lock:
+            self.target(crn)
+            self.calls += 1
+            out, err, ret = self.exec_cmd(["ibmcloud", "pi", "image-import", name, "--image-path", "s3.private." + source["region"] +
+                                           ".cloud-object-storage.appdomain.cloud/" + source["bucket"] + "/" + source["object"],
+                                           "--access-key", access_key, "--secret-key", secret_key])
+        if ret != 0:
+            raise InventoryError("failed to image-import: {}".format(err.strip()))
+        return parse_job_id(out)
+
+    def job_status(self, crn, job_id):
+        with self.lock:
+            self.target(crn)
+            self.calls += 1
+            return job_state(_json(self.exec_cmd, ["ibmcloud", "pi", "job", job_id, "--json"], "job " + job_id))
+
+
+class ApiBackend:
+    """Workspaces, images and imports through the REST API, safe to share between workers."""
+
+    def __init__(self, client):
+        self.client = client
+
+    @property
+    def calls(self):
+        return self.client.requests
+
+    def _call(self, func, *args):
+        try:
+            return func(*args)
+        except ibmapi.ApiError as e:
+            raise InventoryError(str(e))
+
+    def services(self):
+        # Same fields as `ibmcloud pi service-list --json`
+        return [{"Name": r["name"], "CRN": r["crn"]} for r in self._call(self.client.power_workspaces)]
+
+    def images(self, crn):
+        return {image["name"]: image.get("imageID") for image in self._call(self.client.images, crn)}
+
+    def import_image(self, crn, name, source, access_key, secret_key):
+        """Start the import, return its job ID."""
+        return self._call(self.client.import_image, crn, name, source["region"], source["bucket"], source["object"],
+                          access_key, secret_key).get("id")
+
+    def job_status(self, crn, job_id):
+        return job_state(self._call(self.client.job, crn, job_id))
+
+
+class Session:
+    """Image lookups and imports of one backend over the shared inventory."""
+
+    def __init__(self, inventory, backend):
+        self.inventory = inventory
+        self.backend = backend
+
+    def image_names(self, crn):
+        """{name: image ID} of the boot images of workspace crn."""
+        inventory = self.inventory
+        with inventory.lock:
+            entry = inventory.images.get(crn)
+        if entry is None:
+            names = self.backend.images(crn)
+            with inventory.lock:
+                entry = inventory.images.setdefault(crn, (time.time(), names))
+        return entry[1]
+
+    def has_image(self, crn, name):
+        return name in self.image_names(crn)
+
+    def import_image(self, crn, image, access_key, secret_key):
+        """Start the import of a manifest image into workspace crn, return its job ID."""
+        name = image["target"]["imageName"]
+        job_id = self.backend.import_image(crn, name, image["source"], access_key, secret_key)
+        self.imported(crn, name)
+        return job_id
+
+    def imported(self, crn, name, image_id=None):
+        """Record a successful import of name into workspace crn."""
+        names = self.image_names(crn)
+        with self.inventory.lock:
+            names[name] = image_id
+            self.inventory.stale.add(crn)
+
+
+class Inventory:
+
+    def __init__(self, backend, cache_file=None, ttl=DEFAULT_TTL, account=None):
+        self.backend = backend
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.account = account
+        self.services_fetched = None
+        self.by_name = None
+        self.by_crn = None
+        self.images = {}  # CRN: (fetched, {name: image ID})
+        self.stale = set()  # CRNs changed by an import, not saved
+        self.lock = threading.Lock()
+        self.backends = [backend]
+        self.default = Session(self, backend)
+        self._load()
+
+    @property
+    def calls(self):
+        """Calls made by the backends (CLI commands or HTTP requests)."""
+        return sum(backend.calls for backend in set(self.backends))
+
+    def session(self, backend):
+        """Session of another backend, e.g. a CLI with its own IBMCLOUD_HOME."""
+        with self.lock:
+            self.backends.append(backend)
+        return Session(self, backend)
+
+    def _fresh(self, fetched):
+        return fetched is not None and time.time() - fetched < self.ttl
+
+    def _index(self, services, fetched):
+        self.services_fetched = fetched
+        self.by_name = {s["Name"]: s for s in services}
+        self.by_crn = {s["CRN"]: s for s in services}
+
+    def _load(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return
+        if snapshot.get("account") != self.account:
+            return
+        if self._fresh(snapshot.get("services_fetched")):
+            self._index(snapshot["services"], snapshot["services_fetched"])
+        for crn, entry in snapshot.get("images", {}).items():
+            if self._fresh(entry["fetched"]):
+                self.images[crn] = (entry["fetched"], entry["names"])
+
+    def save(self):
+        """Write the snapshot to the cache file, without the workspaces changed by an import."""
+        if not self.cache_file or self.by_name is None:
+            return
+        snapshot = {
+            "account": self.account,
+            "services_fetched": self.services_fetched,
+            "services": list(self.by_name.values()),
+            "images": {crn: {"fetched": fetched, "names": names}
+                       for crn, (fetched, names) in self.images.items() if crn not in self.stale},
+        }
+        tmp = self.cache_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, self.cache_file)
+
+    def services(self):
+        """Workspaces of the account, fetched on first use."""
+        if self.by_name is None:
+            self._index(self.backend.services(), time.time())
+        return list(self.by_name.values())
+
+    def workspace(self, name_or_crn):
+        """Workspace (a service-list entry) by name or CRN, None when the account has none."""
+        self.services()
+        return self.by_name.get(name_or_crn) or self.by_crn.get(name_or_crn)
+
+    def image_names(self, crn):
+        return self.default.image_names(crn)
+
+    def has_image(self, crn, name):
+        return self.default.has_image(crn, name)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Tracking of asynchronous PowerVS jobs (image imports).
+
+All the jobs are polled concurrently until they complete, fail or a global
+deadline passes. The delay between two polls of a job starts at
+INITIAL_DELAY and doubles up to MAX_DELAY, with jitter so that the polls of
+jobs started together don't keep hitting the API at the same instant.
+"""
+
+import heapq
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+INITIAL_DELAY = 15
+MAX_DELAY = 300
+DEFAULT_DEADLINE = 3 * 3600
+POLLERS = 8
+DONE_STATES = ('completed', 'failed')
+
+
+class Job:
+
+    def __init__(self, workspace, crn, image, job_id):
+        self.workspace = workspace
+        self.crn = crn
+        self.image = image
+        self.id = job_id
+        self.state = 'queued' if job_id else 'unknown'
+        self.message = '' if job_id else 'no job ID returned, not tracked'
+        self.started = time.time()
+        self.finished = None
+        self.polls = 0
+
+    @property
+    def failed(self):
+        # An import whose job can't be tracked is not known to have succeeded
+        return self.state in ('failed', 'timeout', 'unknown')
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+
+def _jittered(delay):
+    return random.uniform(delay / 2, delay)
+
+
+def track(jobs, status, deadline=DEFAULT_DEADLINE, workers=POLLERS, initial=INITIAL_DELAY, max_delay=MAX_DELAY):
+    """Poll status(job) -> (state, message) for every job with an ID until all are done or deadline seconds passed.
+
+    The jobs still running at the deadline end in the 'timeout' state.
+    """
+    end = time.time() + deadline
+    pending = [(time.time() + _jittered(initial), index, initial) for index, job in enumerate(jobs) if job.id]
+    heapq.heapify(pending)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            now = time.time()
+            if now >= end:
+                break
+            while pending and pending[0][0] <= now:
+                _, index, delay = heapq.heappop(pending)
+                running[executor.submit(status, jobs[index])] = (index, delay)
+            timeout = min(pending[0][0] if pending else end, end) - now
+            if not running:
+                time.sleep(max(timeout, 0))
+                continue
+            done, _ = wait(running, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                index, delay = running.pop(future)
+                job = jobs[index]
+                job.polls += 1
+                try:
+                    job.state, job.message = future.result()
+                except Exception as e:  # a failed poll is retried, only the deadline gives up
+                    job.message = 'poll failed: {}'.format(e)
+                if job.state in DONE_STATES:
+                    job.finished = time.time()
+                    continue
+                delay = min(delay * 2, max_delay)
+                heapq.heappush(pending, (time.time() + _jittered(delay), index, delay))
+    for job in jobs:
+        if job.id and job.state not in DONE_STATES:
+            job.state = 'timeout'
+            job.finished = time.time()
+    return jobs
+
+
+def print_table(jobs):
+    print("\n{:<24} {:<24} {:<38} {:<10} {:>9} {}".format("WORKSPACE", "IMAGE", "JOB", "STATE", "SECONDS",
+                                                          "MESSAGE"))
+    for job in jobs:
+        print("{:<24} {:<24} {:<38} {:<10} {:>9.0f} {}".format(job.workspace, job.image, job.id or '-', job.state,
+                                                              job.seconds, job.message))
+    failed = sum(1 for job in jobs if job.failed)
+    print("{} imports, {} completed, {} failed, timed out or untracked".format(
+        len(jobs), sum(1 for job in jobs if job.state == 'completed'), failed))
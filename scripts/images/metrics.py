@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Per stage timing, throughput and resource instrumentation.
+
+Every stage and every external command records its wall time, bytes in/out,
+throughput and the CPU time and peak RSS from getrusage(2). Records are
+appended to a JSON lines file as they complete, and a summary is written in
+the Prometheus textfile collector format at the end of the run.
+
+The children CPU time of a stage is the RUSAGE_CHILDREN delta over the stage.
+RUSAGE_CHILDREN ru_maxrss is the peak of any child since the start of the
+run though, so the child usage of a command comes from its own wait4(2)
+rusage, and the children peak RSS of a stage is the largest of its commands.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import time
+
+PREFIX = 'image_pipeline'
+
+
+def _rusage():
+    return resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def _usage_delta(before, after):
+    self_before, children_before = before
+    self_after, children_after = after
+    return {
+        'cpu_user_seconds': round(self_after.ru_utime - self_before.ru_utime, 3),
+        'cpu_system_seconds': round(self_after.ru_stime - self_before.ru_stime, 3),
+        'children_cpu_user_seconds': round(children_after.ru_utime - children_before.ru_utime, 3),
+        'children_cpu_system_seconds': round(children_after.ru_stime - children_before.ru_stime, 3),
+        # ru_maxrss is in KiB on Linux and a high-water mark, not a delta
+        'max_rss_bytes': self_after.ru_maxrss * 1024,
+    }
+
+
+def _child_usage(usage):
+    """Usage of one reaped command, as returned by wait4(2)."""
+    return {
+        'children_cpu_user_seconds': round(usage.ru_utime, 3),
+        'children_cpu_system_seconds': round(usage.ru_stime, 3),
+        'children_max_rss_bytes': usage.ru_maxrss * 1024,
+    }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Recorder:
+
+    def __init__(self, jsonl_path=None, prom_path=None, labels=None):
+        self.jsonl = None
+        self.prom_path = None
+        self.labels = {}
+        self.stages = []
+        self.commands = []
+        self.configure(jsonl_path, prom_path, **(labels or {}))
+
+    def configure(self, jsonl_path=None, prom_path=None, **labels):
+        # Keep the JSON lines file open: commands also run chroot'ed into the image
+        if jsonl_path:
+            self.jsonl = open(jsonl_path, 'a', buffering=1)
+        self.prom_path = os.path.abspath(prom_path) if prom_path else None
+        self.labels.update(labels)
+
+    def _emit(self, record):
+        if self.jsonl:
+            self.jsonl.write(json.dumps(dict(self.labels, **record), sort_keys=True) + '\n')
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the enclosed block; set 'bytes_in'/'bytes_out' on the yielded dict."""
+        record = {'type': 'stage', 'stage': name, 'bytes_in': 0, 'bytes_out': 0, 'status': 'ok'}
+        first = len(self.commands)
+        before = _rusage()
+        started = time.time()
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            peak = max((command['children_max_rss_bytes'] for command in self.commands[first:]), default=0)
+            self._finish(record, started, before, {'children_max_rss_bytes': peak})
+            self.stages.append(record)
+
+    def command(self, argv, returncode, started, before, usage=None):
+        """Record an external command which ran between started and now, usage is its wait4(2) rusage."""
+        record = {'type': 'command', 'command': argv, 'returncode': returncode, 'bytes_in': 0, 'bytes_out': 0,
+                  'status': 'ok' if returncode == 0 else 'failed'}
+        # Without a rusage (the command didn't start) the RUSAGE_CHILDREN delta is kept
+        self._finish(record, started, before, _child_usage(usage) if usage else {'children_max_rss_bytes': 0})
+        self.commands.append(record)
+
+    def _finish(self, record, started, before, children):
+        seconds = time.time() - started
+        record['started'] = round(started, 3)
+        record['seconds'] = round(seconds, 3)
+        record.update(_usage_delta(before, _rusage()))
+        record.update(children)
+        moved = max(record['bytes_in'], record['bytes_out'])
+        record['mb_per_second'] = round(moved / (1024 * 1024) / seconds, 2) if seconds > 0 else 0.0
+        self._emit(record)
+
+    def write_prometheus(self):
+        """Write the stage metrics atomically for the node_exporter textfile collector."""
+        if not self.prom_path:
+            return
+        base = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in sorted(self.labels.items()))
+        metrics = (
+            ('stage_seconds', 'seconds', 'Wall time of the stage in seconds'),
+            ('stage_bytes_in', 'bytes_in', 'Bytes read by the stage'),
+            ('stage_bytes_out', 'bytes_out', 'Bytes written by the stage'),
+            ('stage_throughput_bytes_per_second', None, 'Throughput of the stage in bytes per second'),
+            ('stage_cpu_seconds', None, 'CPU time spent in the stage, including child processes'),
+            ('stage_children_max_rss_bytes', 'children_max_rss_bytes', 'Peak RSS of the largest command run by the stage'),
+            ('stage_success', None, '1 if the stage succeeded, 0 otherwise'),
+        )
+        lines = []
+        for metric, key, help_text in metrics:
+            name = '{}_{}'.format(PREFIX, metric)
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for record in self.stages:
+                labels = (base + ',' if base else '') + 'stage="{}"'.format(_escape(record['stage']))
+                if metric == 'stage_cpu_seconds':
+                    value = round(record['cpu_user_seconds'] + record['cpu_system_seconds']
+                                  + record['children_cpu_user_seconds'] + record['children_cpu_system_seconds'], 3)
+                elif metric == 'stage_throughput_bytes_per_second':
+                    value = int(record['mb_per_second'] * 1024 * 1024)
+                elif metric == 'stage_success':
+                    value = 1 if record['status'] == 'ok' else 0
+                else:
+                    value = record[key]
+                lines.append('{}{{{}}} {}'.format(name, labels, value))
+        name = '{}_commands_seconds_total'.format(PREFIX)
+        lines.append('# HELP {} Wall time spent in external commands'.format(name))
+        lines.append('# TYPE {} counter'.format(name))
+        totals = {}
+        for record in self.commands:
+            program = os.path.basename(record['command'][0]) if record['command'] else ''
+            totals[program] = totals.get(program, 0.0) + record['seconds']
+        for program, seconds in sorted(totals.items()):
+            labels = (base + ',' if base else '') + 'command="{}"'.format(_escape(program))
+            lines.append('{}{{{}}} {}'.format(name, labels, round(seconds, 3)))
+        tmp = self.prom_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prom_path)
+
+
+# Process wide recorder used by the conversion pipeline
+recorder = Recorder()
+
+
+def stage(name):
+    return recorder.stage(name)
+
+
+def snapshot():
+    """State to pass to record_command() once a command has finished."""
+    return time.time(), _rusage()
+
+
+def record_command(argv, returncode, snap, usage=None):
+    started, before = snap
+    recorder.command(argv, returncode, started, before, usage)
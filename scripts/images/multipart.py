@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""Resumable, self-tuning S3 multipart uploads.
+
+Works with any boto3 compatible S3 client (IBM COS, AWS, MinIO, ...):
+
+- the part size is derived from the file size so that large images use few,
+  large parts while staying within the 10000 parts limit
+- the number of parts in flight starts low and is tuned while uploading: it
+  grows as long as the measured throughput grows, and backs off when it drops
+- the upload ID and the ETag of every completed part are saved to a state
+  file, so an interrupted upload is resumed where it stopped; the parts are
+  checked against the server before they are skipped
+- the progress and the live throughput are printed periodically
+
+MultipartWriter uploads a stream of unknown length instead, typically the
+output of the OVA compressor: parts are cut from what is written and uploaded
+while the next ones are produced. write() blocks once a bounded number of
+parts is in flight, so the compressor runs at the pace of the upload and the
+memory used stays bounded. A stream can't be resumed, a failed upload is
+aborted.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 8 * MB
+MAX_PART_SIZE = 512 * MB
+MAX_PARTS = 10000
+# Aim for this many parts, fewer parts mean fewer requests but coarser resume points
+TARGET_PARTS = 1000
+MIN_CONCURRENCY = 2
+MAX_CONCURRENCY = 32
+# Memory held by the parts in flight
+MAX_BUFFER = 1024 * MB
+TUNE_SECONDS = 10
+PROGRESS_SECONDS = 5
+MAX_RETRIES = 5
+# Part size of a stream whose size isn't known in advance, allows objects up to 640 GiB
+STREAM_PART_SIZE = 64 * MB
+STREAM_CONCURRENCY = 8
+
+UploadResult = namedtuple('UploadResult', ['bytes', 'seconds', 'parts', 'resumed_bytes', 'concurrency'])
+
+
+class UploadError(Exception):
+    pass
+
+
+def choose_part_size(size):
+    """Part size for an object of size bytes, a multiple of 1 MiB."""
+    part = max(MIN_PART_SIZE, -(-size // TARGET_PARTS))
+    part = min(MAX_PART_SIZE, -(-part // MB) * MB)
+    if -(-size // part) > MAX_PARTS:
+        part = -(-size // MAX_PARTS // MB) * MB + MB
+    return part
+
+
+def state_path_for(path):
+    return path + '.upload.json'
+
+
+def cos_client(region, access_key, secret_key, endpoint=None, max_connections=MAX_CONCURRENCY):
+    """boto3 S3 client of the COS endpoint of region, or of endpoint (a local S3 compatible server, ...)."""
+    import boto3
+    from botocore.config import Config
+    return boto3.client('s3',
+                        endpoint_url=endpoint or 'https://s3.' + region + '.cloud-object-storage.appdomain.cloud/',
+                        region_name=region,
+                        aws_access_key_id=access_key,
+                        aws_secret_access_key=secret_key,
+                        config=Config(max_pool_connections=max_connections))
+
+
+class _Tuner:
+    """Hill climbing on the number of parts in flight from the measured throughput."""
+
+    def __init__(self, start, low, high):
+        self.concurrency = start
+        self.low = low
+        self.high = high
+        self.direction = 1
+        self.last_rate = None
+        self.window_start = time.time()
+        self.window_bytes = 0
+
+    def record(self, count):
+        self.window_bytes += count
+        elapsed = time.time() - self.window_start
+        if elapsed < TUNE_SECONDS:
+            return
+        rate = self.window_bytes / elapsed
+        if self.last_rate is not None and rate < self.last_rate * 0.95:
+            self.direction = -self.direction  # the last move did not pay off, go back
+        self.concurrency = max(self.low, min(self.high, self.concurrency + self.direction))
+        self.last_rate = rate
+        self.window_start = time.time()
+        self.window_bytes = 0
+
+
+class _Progress:
+
+    def __init__(self, total, label, enabled=True):
+        self.total = total
+        self.label = label
+        self.enabled = enabled
+        self.done = 0
+        self.started = time.time()
+        self.last_time = self.started
+        self.last_done = 0
+        self.lock = threading.Lock()
+
+    def add(self, count, in_flight=0):
+        with self.lock:
+            self.done += count
+            now = time.time()
+            if not self.enabled or now - self.last_time < PROGRESS_SECONDS:
+                return
+            rate = (self.done - self.last_done) / (now - self.last_time)
+            self.last_time, self.last_done = now, self.done
+        total = " of {:.0f} MB ({:.0%})".format(self.total / MB, self.done / self.total) if self.total else ""
+        print("{}: {:.0f} MB{} at {:.1f} MB/s, {} parts in flight".format(
+            self.label, self.done / MB, total, rate / MB, in_flight), flush=True)
+
+
+def _retry(func, what):
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:  # the client raises many unrelated exception types
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                raise UploadError("{} failed: {}".format(what, e))
+            time.sleep(min(2 ** attempt, 30))
+
+
+class MultipartUploader:
+
+    def __init__(self, client, bucket, key, part_size=None, concurrency=None, max_concurrency=MAX_CONCURRENCY,
+                 metadata=None, state_path=None, progress=True):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.metadata = metadata or {}
+        self.state_path = state_path
+        self.progress = progress
+
+    def _create(self):
+        resp = _retry(lambda: self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                                   Metadata=self.metadata),
+                      "creating the multipart upload of " + self.key)
+        return resp['UploadId']
+
+    def _server_parts(self, upload_id):
+        parts = {}
+        marker = 0
+        while True:
+            resp = self.client.list_parts(Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                                          PartNumberMarker=marker)
+            for part in resp.get('Parts', []):
+                parts[part['PartNumber']] = (part['ETag'], part['Size'])
+            if not resp.get('IsTruncated'):
+                return parts
+            marker = resp['NextPartNumberMarker']
+
+    def _load_state(self, identity):
+        """Resume a matching upload from the state file, return (upload_id, {part: etag})."""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None, {}
+        if {k: state.get(k) for k in identity} != identity:
+            print("Ignoring", self.state_path, "it belongs to another upload")
+            return None, {}
+        try:
+            server = self._server_parts(state['upload_id'])
+        except Exception as e:
+            print("Cannot resume upload", state['upload_id'], ":", e)
+            return None, {}
+        parts = {}
+        for number, etag in state['parts'].items():
+            if server.get(int(number), (None, None))[0] == etag:
+                parts[int(number)] = etag
+        return state['upload_id'], parts
+
+    def _save_state(self, identity, upload_id, parts):
+        if not self.state_path:
+            return
+        state = dict(identity, upload_id=upload_id, parts={str(n): etag for n, etag in sorted(parts.items())})
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def _upload_part(self, upload_id, number, read):
+        def put():
+            data = read()
+            return self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                                           PartNumber=number, Body=data)['ETag'], len(data)
+        return _retry(put, "uploading part {} of {}".format(number, self.key))
+
+    def _complete(self, upload_id, parts):
+        layout = {'Parts': [{'PartNumber': n, 'ETag': etag} for n, etag in sorted(parts.items())]}
+        _retry(lambda: self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                                                             MultipartUpload=layout),
+               "completing the upload of " + self.key)
+
+    def upload_file(self, path):
+        """Upload path, resuming a previous attempt recorded in the state file."""
+        started = time.time()
+        st = os.stat(path)
+        size = st.st_size
+        part_size = self.part_size or choose_part_size(size)
+        count = max(1, -(-size // part_size))
+        identity = {'bucket': self.bucket, 'key': self.key, 'size': size, 'mtime_ns': st.st_mtime_ns,
+                    'part_size': part_size}
+        upload_id, parts = self._load_state(identity) if self.state_path else (None, {})
+        if upload_id is None:
+            upload_id = self._create()
+            parts = {}
+        resumed = sum(min(part_size, size - (n - 1) * part_size) for n in parts)
+        if resumed:
+            print("Resuming upload of {}: {} of {} parts already uploaded".format(self.key, len(parts), count))
+        self._save_state(identity, upload_id, parts)
+
+        high = max(1, min(self.max_concurrency, MAX_BUFFER // part_size))
+        tuner = _Tuner(min(self.concurrency or MIN_CONCURRENCY, high), min(MIN_CONCURRENCY, high), high)
+        if self.concurrency:
+            tuner.low = tuner.high = tuner.concurrency  # fixed
+        progress = _Progress(size, "Uploading " + self.key, self.progress)
+        progress.done = resumed
+        pending = [n for n in range(1, count + 1) if n not in parts]
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=high) as executor:
+                running = {}
+                while pending or running:
+                    while pending and len(running) < tuner.concurrency:
+                        number = pending.pop(0)
+                        offset = (number - 1) * part_size
+
+                        def read(offset=offset):
+                            return os.pread(fd, min(part_size, size - offset), offset)
+                        running[executor.submit(self._upload_part, upload_id, number, read)] = number
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        number = running.pop(future)
+                        etag, length = future.result()
+                        parts[number] = etag
+                        self._save_state(identity, upload_id, parts)
+                        tuner.record(length)
+                        progress.add(length, len(running))
+        finally:
+            os.close(fd)
+        self._complete(upload_id, parts)
+        if self.state_path and os.path.exists(self.state_path):
+            os.unlink(self.state_path)
+        return UploadResult(size, time.time() - started, count, resumed, tuner.concurrency)
+
+
+class MultipartWriter(MultipartUploader):
+    """Write-only file object uploading what is written as a multipart upload.
+
+    close() uploads the last part and completes the upload, abort() (or
+    leaving the with block on an exception) discards it.
+    """
+
+    def __init__(self, client, bucket, key, part_size=STREAM_PART_SIZE, concurrency=STREAM_CONCURRENCY,
+                 metadata=None, progress=True):
+        super().__init__(client, bucket, key, part_size, concurrency, concurrency, metadata, None, progress)
+        self.buffer = bytearray()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.executor = None
+        self.upload_id = None
+        self.futures = {}
+        self.parts = {}
+        self.number = 0
+        self.bytes = 0
+        self.started = None
+        self.closed = False
+        self.result = None
+        self._progress = _Progress(None, "Uploading " + key, progress)
+
+    def _start(self):
+        self.started = time.time()
+        self.upload_id = self._create()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def _collect(self, block=False):
+        for future in [f for f in self.futures if block or f.done()]:
+            number = self.futures.pop(future)
+            etag, length = future.result()  # raises UploadError of a failed part
+            self.parts[number] = etag
+            self._progress.add(length, len(self.futures))
+
+    def _release(self, future):
+        self.slots.release()
+
+    def _submit(self, data):
+        self.slots.acquire()  # backpressure: wait for a part to finish
+        self._collect()
+        self.number += 1
+        future = self.executor.submit(self._upload_part, self.upload_id, self.number, lambda: data)
+        future.add_done_callback(self._release)
+        self.futures[future] = self.number
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to a closed MultipartWriter")
+        if self.upload_id is None:
+            self._start()
+        self.buffer += data
+        self.bytes += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def write_zeros(self, count):
+        zeros = bytes(min(count, MB))
+        while count:
+            size = min(count, MB)
+            self.write(zeros[:size])
+            count -= size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Upload the last part and complete the upload, return an UploadResult."""
+        if self.closed:
+            return self.result
+        if self.upload_id is None:
+            self._start()
+        if self.buffer or not self.number:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        try:
+            self._collect(block=True)
+            self._complete(self.upload_id, self.parts)
+        except Exception:
+            self.abort()
+            raise
+        self.executor.shutdown()
+        self.closed = True
+        self.result = UploadResult(self.bytes, time.time() - self.started, self.number, 0, self.concurrency)
+        return self.result
+
+    def abort(self):
+        """Discard the parts uploaded so far."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            return
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print("Warning: failed to abort the upload", self.upload_id, "of", self.key, ":", e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
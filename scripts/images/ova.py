@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""Single pass OVA packaging.
+
+The OVA tar stream is produced on a separate thread and handed through a
+bounded in-memory queue to the compressor, so the uncompressed .ova never
+exists on disk and reading the volume overlaps with compressing it. Only the
+data extents of the (mostly sparse) raw volume are read, holes are passed on
+as zero runs which the compressor handles without deflating them again.
+
+The SHA-256 of every member is computed while it is archived and written to
+an OVF manifest (.mf) at the end of the archive, and the SHA-256 of the
+compressed output while it is written, so checking the integrity of an OVA
+never needs another read of it. A member's digest covers the zeros of its
+holes too. SHA-256 has no shortcut for them, but they are hashed from a zero
+buffer in memory instead of being read, on a thread of its own per member so
+that hashing overlaps with reading and compressing the data.
+"""
+
+import copy
+import hashlib
+import io
+import os
+import queue
+import tarfile
+import threading
+import time
+from collections import namedtuple
+
+import codec
+import pgzip
+import sparse
+
+CHUNK_SIZE = 4 * 1024 * 1024
+QUEUE_DEPTH = 8
+HASH_QUEUE_DEPTH = 16
+
+OvaResult = namedtuple('OvaResult', ['bytes_in', 'bytes_out', 'seconds', 'sha256', 'digests'])
+ZEROS = bytes(CHUNK_SIZE)
+
+
+class OvaError(Exception):
+    pass
+
+
+def ova_members(image_dir):
+    """Names of the files to archive, the OVF descriptor first as the OVF spec asks."""
+    names = sorted(os.listdir(image_dir))
+    return sorted(names, key=lambda name: not name.endswith('.ovf'))
+
+
+def manifest_name(image_dir):
+    """The manifest shares its base name with the OVF descriptor."""
+    for name in ova_members(image_dir):
+        if name.endswith('.ovf'):
+            return name[:-len('.ovf')] + '.mf'
+    raise OvaError("no OVF descriptor in {}".format(image_dir))
+
+
+def manifest(digests):
+    """OVF manifest text for a {member name: sha256} mapping."""
+    return ''.join('SHA256({})= {}\n'.format(name, digest) for name, digest in digests.items())
+
+
+class _NoHash:
+    """Stands in for a hash object when no manifest is written."""
+
+    def update(self, data):
+        pass
+
+    def hexdigest(self):
+        return None
+
+
+def _update_zeros(sha, count):
+    zeros = memoryview(ZEROS)
+    while count:
+        size = min(count, CHUNK_SIZE)
+        sha.update(zeros[:size])
+        count -= size
+
+
+class _Hasher:
+    """SHA-256 computed on a separate thread from bytes and runs of zeros.
+
+    hashlib releases the GIL on large buffers, so hashing runs in parallel
+    with the producer; the bounded queue keeps at most HASH_QUEUE_DEPTH
+    chunks in flight.
+    """
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+        self.pieces = queue.Queue(HASH_QUEUE_DEPTH)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            piece = self.pieces.get()
+            if piece is None:
+                return
+            if isinstance(piece, int):
+                _update_zeros(self.sha, piece)
+            else:
+                self.sha.update(piece)
+
+    def update(self, data):
+        self.pieces.put(data)
+
+    def zeros(self, count):
+        if count:
+            self.pieces.put(count)
+
+    def hexdigest(self):
+        self.pieces.put(None)
+        self.thread.join()
+        return self.sha.hexdigest()
+
+    def close(self):
+        """Stop the thread when the member is abandoned."""
+        if self.thread.is_alive():
+            self.pieces.put(None)
+            self.thread.join()
+
+
+def _hash_zeros(sha, count):
+    if not isinstance(sha, _NoHash):
+        sha.zeros(count)
+
+
+def sha256_sparse(path):
+    """SHA-256 of path as the manifest computes it, holes included."""
+    sha = hashlib.sha256()
+    for piece in sparse.read_sparse(path, CHUNK_SIZE):
+        if isinstance(piece, int):
+            _update_zeros(sha, piece)
+        else:
+            sha.update(piece)
+    return sha.hexdigest()
+
+
+class _QueueWriter:
+    """File object whose writes are cut into chunks and put on a bounded queue.
+
+    Runs of zeros are queued as an int count instead of bytes.
+    """
+
+    def __init__(self, chunks, abort):
+        self.chunks = chunks
+        self.abort = abort
+        self.buf = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        self.buf += data
+        self.offset += len(data)
+        while len(self.buf) >= CHUNK_SIZE:
+            self._put(bytes(self.buf[:CHUNK_SIZE]))
+            del self.buf[:CHUNK_SIZE]
+        return len(data)
+
+    def write_zeros(self, count):
+        if count < CHUNK_SIZE:
+            self.write(bytes(count))
+            return
+        self.close()
+        self._put(count)
+        self.offset += count
+
+    def _put(self, chunk):
+        while True:
+            if self.abort.is_set():
+                raise OvaError("consumer stopped")
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        if self.buf:
+            self._put(bytes(self.buf))
+            self.buf = bytearray()
+
+
+def _write_data(pipe, path, sha):
+    for piece in sparse.read_sparse(path, CHUNK_SIZE):
+        if isinstance(piece, int):
+            _hash_zeros(sha, piece)
+            pipe.write_zeros(piece)
+        else:
+            sha.update(piece)
+            pipe.write(piece)
+
+
+def _write_sparse_member(pipe, path, info, sha):
+    """Write path as a GNU sparse 1.0 (PAX) member holding only its data extents."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        extents = list(sparse.data_extents(fd, info.size))
+    finally:
+        os.close(fd)
+    if extents and extents[-1].offset + extents[-1].length == info.size:
+        sparse_map = extents
+    else:
+        # A trailing hole is recorded as an empty extent at the end of the file
+        sparse_map = extents + [sparse.Extent(info.size, 0)]
+    map_text = '{}\n'.format(len(sparse_map)) + ''.join(
+        '{}\n{}\n'.format(extent.offset, extent.length) for extent in sparse_map)
+    map_block = map_text.encode('ascii')
+    map_block += bytes(-len(map_block) % tarfile.BLOCKSIZE)
+    data_size = sum(extent.length for extent in extents)
+
+    member = copy.copy(info)
+    member.name = '{}/GNUSparseFile.0/{}'.format(os.path.dirname(info.name) or '.', os.path.basename(info.name))
+    member.size = len(map_block) + data_size
+    member.pax_headers = {
+        'GNU.sparse.major': '1',
+        'GNU.sparse.minor': '0',
+        'GNU.sparse.name': info.name,
+        'GNU.sparse.realsize': str(info.size),
+    }
+    pipe.write(member.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+    pipe.write(map_block)
+    with open(path, 'rb') as f:
+        offset = 0
+        for extent in extents:
+            _hash_zeros(sha, extent.offset - offset)
+            offset = extent.offset + extent.length
+            f.seek(extent.offset)
+            remaining = extent.length
+            while remaining:
+                block = f.read(min(CHUNK_SIZE, remaining))
+                if not block:
+                    raise OvaError("{} shrank while archiving".format(path))
+                sha.update(block)
+                pipe.write(block)
+                remaining -= len(block)
+        _hash_zeros(sha, info.size - offset)
+    return member.size
+
+
+def write_tar_stream(pipe, image_dir, sparse_members=False, with_manifest=True):
+    """Write the OVA tar archive of image_dir to pipe, return the member digests.
+
+    Holes of sparse files are never read: they are emitted as runs of zeros,
+    or, with sparse_members, left out entirely using GNU sparse members. Only
+    use sparse_members when the importing side understands them. The OVF
+    manifest is the last member, as its digests are only known by then;
+    without it the members are not hashed and no digests are returned.
+    """
+    lookup = tarfile.TarFile(fileobj=io.BytesIO(), mode='w')
+    digests = {}
+    info = None
+    for name in ova_members(image_dir):
+        path = os.path.join(image_dir, name)
+        info = lookup.gettarinfo(path, arcname=name)
+        if not info.isreg():
+            raise OvaError("{} is not a regular file".format(path))
+        sha = _Hasher() if with_manifest else _NoHash()
+        try:
+            if sparse_members:
+                size = _write_sparse_member(pipe, path, info, sha)
+            else:
+                pipe.write(info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+                _write_data(pipe, path, sha)
+                size = info.size
+        except BaseException:
+            if with_manifest:
+                sha.close()
+            raise
+        pipe.write_zeros(-size % tarfile.BLOCKSIZE)
+        if with_manifest:
+            digests[name] = sha.hexdigest()
+    if with_manifest:
+        data = manifest(digests).encode('ascii')
+        member = copy.copy(info)
+        member.name = manifest_name(image_dir)
+        member.size = len(data)
+        member.mtime = int(time.time())
+        pipe.write(member.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+        pipe.write(data)
+        pipe.write_zeros(-len(data) % tarfile.BLOCKSIZE)
+    # End of archive marker, padded to a full record like tarfile does
+    pipe.write_zeros(2 * tarfile.BLOCKSIZE)
+    pipe.write_zeros(-pipe.offset % tarfile.RECORDSIZE)
+    return digests
+
+
+def _produce(image_dir, chunks, abort, errors, sparse_members, with_manifest, digests):
+    pipe = _QueueWriter(chunks, abort)
+    try:
+        digests.update(write_tar_stream(pipe, image_dir, sparse_members, with_manifest))
+        pipe.close()
+        pipe._put(b'')
+    except Exception as e:
+        errors.append(e)
+        try:
+            pipe._put(None)
+        except OvaError:
+            pass
+
+
+def stream_ova(image_dir, sink, sparse_members=False, with_manifest=True):
+    """Write the OVA tar stream of image_dir into the writable sink, return the member digests."""
+    chunks = queue.Queue(maxsize=QUEUE_DEPTH)
+    abort = threading.Event()
+    errors = []
+    digests = {}
+    producer = threading.Thread(target=_produce, daemon=True,
+                                args=(image_dir, chunks, abort, errors, sparse_members, with_manifest, digests))
+    producer.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                raise OvaError("failed to archive {}: {}".format(image_dir, errors[0]))
+            if isinstance(chunk, int):
+                if hasattr(sink, 'write_zeros'):
+                    sink.write_zeros(chunk)
+                else:
+                    while chunk:
+                        sink.write(bytes(min(chunk, CHUNK_SIZE)))
+                        chunk -= min(chunk, CHUNK_SIZE)
+                continue
+            if not chunk:
+                break
+            sink.write(chunk)
+    finally:
+        abort.set()
+        producer.join()
+    return digests
+
+
+class _HashingFile:
+    """Pass writes through to fileobj, hashing them on the way.
+
+    Zero runs of uncompressed output are skipped over, leaving holes, unless
+    fileobj handles them itself.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+
+    def write(self, data):
+        self.sha.update(data)
+        return self.fileobj.write(data)
+
+    def write_zeros(self, count):
+        _update_zeros(self.sha, count)
+        if hasattr(self.fileobj, 'write_zeros'):
+            self.fileobj.write_zeros(count)
+        else:
+            self.fileobj.seek(count, os.SEEK_CUR)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def write_checksum_file(path, digest):
+    """Write a sha256sum compatible sidecar file next to path, return its name."""
+    sidecar = path + '.sha256'
+    with open(sidecar, 'w') as f:
+        f.write('{}  {}\n'.format(digest, os.path.basename(path)))
+    return sidecar
+
+
+def write_ova(image_dir, dest, output_codec, threads=None, block_size=pgzip.BLOCK_SIZE, sparse_members=False,
+              with_manifest=True):
+    """Archive image_dir as an OVA and compress it with output_codec into dest in a single pass.
+
+    The sha256 of dest is written to dest + '.sha256'.
+    """
+    started = time.time()
+    with open(dest, 'wb') as out:
+        hashed = _HashingFile(out)
+        with codec.open_writer(output_codec, hashed, threads, block_size) as writer:
+            digests = stream_ova(image_dir, writer, sparse_members, with_manifest)
+        out.truncate()  # extend over a trailing hole
+    write_checksum_file(dest, hashed.sha.hexdigest())
+    return OvaResult(writer.bytes_in, writer.bytes_out, time.time() - started, hashed.sha.hexdigest(), digests)
+
+
+def upload_ova(image_dir, upload, output_codec, threads=None, block_size=pgzip.BLOCK_SIZE, sparse_members=False,
+               with_manifest=True):
+    """Archive image_dir as an OVA and compress it with output_codec into upload, a multipart.MultipartWriter.
+
+    Nothing is written locally, the caller completes the upload.
+    """
+    started = time.time()
+    hashed = _HashingFile(upload)
+    with codec.open_writer(output_codec, hashed, threads, block_size) as writer:
+        digests = stream_ova(image_dir, writer, sparse_members, with_manifest)
+    return OvaResult(writer.bytes_in, writer.bytes_out, time.time() - started, hashed.sha.hexdigest(), digests)
+
+
+def write_ova_gz(image_dir, dest, level=pgzip.DEFAULT_LEVEL, threads=None, block_size=pgzip.BLOCK_SIZE,
+                 sparse_members=False, with_manifest=True):
+    """Archive image_dir as an OVA and gzip it into dest in a single pass."""
+    return write_ova(image_dir, dest, codec.Codec('gzip', level, '.ova.gz'), threads, block_size, sparse_members,
+                     with_manifest)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Multi-threaded gzip compression, compatible with pigz.
+
+The input is cut into fixed size blocks which are deflated independently on a
+thread pool (zlib releases the GIL while compressing). Each block is primed
+with the last 32 KiB of the previous block as its dictionary and ends with a
+sync flush, so the concatenated blocks form a single standard deflate stream
+inside one gzip member, exactly like pigz produces. The output only depends
+on the level and block size, never on the number of threads.
+"""
+
+import functools
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_LEVEL = 6
+DICT_SIZE = 32 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+_GF2_DIM = 32
+
+
+def _gf2_matrix_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(_GF2_DIM)]
+
+
+@functools.lru_cache(maxsize=8)
+def _crc32_shift_operator(length):
+    """GF(2) matrix appending length zero bytes to a crc32, as in zlib's crc32_combine."""
+    # Operator for one zero bit
+    odd = [0xedb88320] + [1 << n for n in range(_GF2_DIM - 1)]
+    even = _gf2_matrix_square(odd)  # two zero bits
+    odd = _gf2_matrix_square(even)  # four zero bits
+    result = None
+    while length:
+        even = _gf2_matrix_square(odd)
+        if length & 1:
+            result = even if result is None else [_gf2_matrix_times(even, row) for row in result]
+        length >>= 1
+        if not length:
+            break
+        odd = _gf2_matrix_square(even)
+        if length & 1:
+            result = odd if result is None else [_gf2_matrix_times(odd, row) for row in result]
+        length >>= 1
+    return result
+
+
+def crc32_combine(crc1, crc2, len2):
+    """Return the crc32 of A+B given crc32(A), crc32(B) and len(B).
+
+    The operator for a given length is cached, so combining the equally sized
+    blocks of a stream costs a single 32x32 GF(2) matrix product.
+    """
+    if len2 <= 0:
+        return crc1
+    return _gf2_matrix_times(_crc32_shift_operator(len2), crc1) ^ crc2
+
+
+def _deflate_block(block, zdict, level, last):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    data = compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data, zlib.crc32(block), len(block)
+
+
+class ParallelGzipWriter:
+    """Write-only file object producing a gzip stream on fileobj."""
+
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, threads=None, block_size=BLOCK_SIZE):
+        if not 0 <= level <= 9:
+            raise ValueError("gzip level must be between 0 and 9")
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.time()
+        self.seconds = 0.0
+        self.closed = False
+        self._crc = 0
+        self._buf = bytearray()
+        self._zdict = b''
+        self._zero_block = bytes(block_size)
+        self._zero_deflated = None
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        xfl = 2 if level == 9 else 4 if level == 1 else 0
+        # No name and a zero mtime keep the output reproducible; OS is Unix
+        self._write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, xfl, 3))
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def _submit(self, block, last=False):
+        if not last and block == self._zero_block and self._zdict == self._zero_block[-DICT_SIZE:]:
+            # A zero block following zeros always deflates to the same bytes
+            if self._zero_deflated is None:
+                self._zero_deflated = _deflate_block(block, self._zdict, self.level, False)
+            future = Future()
+            future.set_result(self._zero_deflated)
+            self._pending.append(future)
+        else:
+            self._pending.append(self._executor.submit(_deflate_block, block, self._zdict, self.level, last))
+            self._zdict = block[-DICT_SIZE:]
+        # Bound the memory held by blocks in flight
+        while len(self._pending) > 2 * self.threads:
+            self._drain_one()
+
+    def _drain_one(self):
+        data, crc, length = self._pending.popleft().result()
+        self._write(data)
+        self._crc = crc32_combine(self._crc, crc, length)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed ParallelGzipWriter")
+        self._buf += data
+        self.bytes_in += len(data)
+        while len(self._buf) >= self.block_size:
+            block = bytes(self._buf[:self.block_size])
+            del self._buf[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def write_zeros(self, count):
+        """Append count zero bytes without materialising them block by block.
+
+        Runs of zeros (the holes of a sparse volume) reuse one cached deflated
+        block, so they cost almost nothing to compress.
+        """
+        if self.closed:
+            raise ValueError("write to closed ParallelGzipWriter")
+        self.bytes_in += count
+        head = min(count, (self.block_size - len(self._buf)) % self.block_size)
+        if head:
+            self._buf += self._zero_block[:head]
+            count -= head
+            if len(self._buf) == self.block_size:
+                block = bytes(self._buf)
+                self._buf = bytearray()
+                self._submit(block)
+        while count >= self.block_size:
+            self._submit(self._zero_block)
+            count -= self.block_size
+        self._buf += self._zero_block[:count]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buf), last=True)
+            self._buf = bytearray()
+            while self._pending:
+                self._drain_one()
+            self._write(struct.pack('<II', self._crc, self.bytes_in & 0xffffffff))
+        finally:
+            self.closed = True
+            self._executor.shutdown(wait=True)
+            self.seconds = time.time() - self.started
+
+    @property
+    def rate(self):
+        """Uncompressed bytes per second."""
+        elapsed = self.seconds or (time.time() - self.started)
+        return self.bytes_in / elapsed if elapsed > 0 else 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            self._executor.shutdown(wait=True)
+
+
+def compress_file(sfile, dfile, level=DEFAULT_LEVEL, threads=None, block_size=BLOCK_SIZE):
+    """gzip sfile into dfile and return the writer for its statistics."""
+    with open(sfile, 'rb') as s_file, open(dfile, 'wb') as d_file:
+        writer = ParallelGzipWriter(d_file, level=level, threads=threads, block_size=block_size)
+        with writer:
+            while True:
+                block = s_file.read(READ_SIZE)
+                if not block:
+                    break
+                writer.write(block)
+    return writer
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Checkpointed, resumable stage runner.
+
+A pipeline is a list of named stages with declared input and output files.
+After each stage the fingerprints of its outputs (size and mtime, plus the
+sha256 of small files) and the parameters it ran with are saved to a state
+file in the work directory. On resume, the completed stages are skipped as
+long as the files the remaining stages read still match the fingerprints
+they had when the last skipped stage finished. Stages that modify a file in
+place (resize, RHEL preparation) therefore never run twice on the same file:
+the pipeline steps back to the stage that produced the unmodified version.
+
+With reclaim, an intermediate file in the work directory is removed as soon
+as the last stage reading it has finished and produced all its outputs. The
+state keeps its fingerprint, so a resume that needs it again steps back to
+the stage producing it.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+
+STATE_FILE = 'pipeline-state.json'
+HASH_LIMIT = 64 * 1024 * 1024
+
+Stage = namedtuple('Stage', ['name', 'func', 'inputs', 'outputs', 'params'])
+
+
+def fingerprint(path):
+    st = os.stat(path)
+    result = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if st.st_size <= HASH_LIMIT:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        result['sha256'] = sha.hexdigest()
+    return result
+
+
+def completed_stages(workdir):
+    """Names of the stages recorded as completed in the state of workdir."""
+    try:
+        with open(os.path.join(workdir, STATE_FILE)) as f:
+            return [record.get('name') for record in json.load(f).get('completed', [])]
+    except (OSError, ValueError):
+        return []
+
+
+def verify(path, expected):
+    try:
+        return fingerprint(path) == expected
+    except FileNotFoundError:
+        return False
+
+
+class Pipeline:
+
+    def __init__(self, workdir, resume=False, reclaim=False):
+        self.workdir = os.path.abspath(workdir)
+        self.state_file = os.path.join(self.workdir, STATE_FILE)
+        self.resume = resume
+        self.reclaim = reclaim
+        self.stages = []
+
+    def add(self, name, func, inputs=(), outputs=(), params=None):
+        """Append a stage. params are compared on resume; a change reruns the stage."""
+        self.stages.append(Stage(name, func, list(inputs), list(outputs), params or {}))
+
+    def _rel(self, path):
+        return os.path.relpath(os.path.abspath(path), self.workdir)
+
+    def _load(self):
+        if self.resume:
+            try:
+                with open(self.state_file) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                print("No usable pipeline state in", self.workdir, "starting from the first stage")
+        return {'completed': []}
+
+    def _save(self, state):
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.state_file)
+
+    def _resume_point(self, state):
+        done = 0
+        for stage, record in zip(self.stages, state['completed']):
+            if record.get('name') != stage.name or record.get('params') != stage.params:
+                break
+            done += 1
+        # Step back until every file the remaining stages read is as the skipped stages left it
+        while done > 0:
+            expected = {}
+            for record in state['completed'][:done]:
+                expected.update(record.get('outputs', {}))
+            needed = set()
+            produced = set()
+            for stage in self.stages[done:]:
+                needed.update(self._rel(p) for p in stage.inputs if self._rel(p) not in produced)
+                produced.update(self._rel(p) for p in stage.outputs)
+            if all(name not in expected or verify(os.path.join(self.workdir, name), expected[name])
+                   for name in needed):
+                break
+            done -= 1
+        return done
+
+    def _release(self, index):
+        """Remove the intermediates no stage after index reads, return their names."""
+        stage = self.stages[index]
+        if not all(os.path.exists(p) for p in stage.outputs):
+            return []
+        read_later = set()
+        for later in self.stages[index + 1:]:
+            read_later.update(self._rel(p) for p in later.inputs)
+        released = []
+        for path in stage.inputs:
+            name = self._rel(path)
+            if name in read_later or name.startswith(os.pardir + os.sep) or not os.path.exists(path):
+                continue  # still needed, or not ours to remove
+            print("Removing intermediate", name)
+            os.unlink(path)
+            released.append(name)
+        return released
+
+    def run(self):
+        state = self._load()
+        start = self._resume_point(state)
+        for stage in self.stages[:start]:
+            print("Skipping stage", stage.name, "(already completed)")
+        state['completed'] = state['completed'][:start]
+        for index, stage in enumerate(self.stages[start:], start):
+            print("Running stage", stage.name, "...")
+            started = time.time()
+            stage.func()
+            outputs = {self._rel(p): fingerprint(p) for p in stage.outputs if os.path.exists(p)}
+            state['completed'].append({'name': stage.name, 'params': stage.params, 'outputs': outputs,
+                                       'seconds': round(time.time() - started, 3)})
+            if self.reclaim:
+                state['completed'][-1]['released'] = self._release(index)
+            self._save(state)
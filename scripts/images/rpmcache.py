@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Package caches for the RHEL/CentOS customization chroot.
+
+- a persistent, size bounded dnf/yum cache directory bind-mounted over the
+  cache directories of the image, so packages downloaded by one conversion
+  are reused by the next ones; it never ends up inside the image
+- a local RPM directory, bind-mounted read-only into the chroot: the pinned
+  RPMs (cloud-init, ibm-power-repo) are installed from it when present, and
+  when it holds repodata (a mirror, or createrepo output) it is also used as
+  a yum repository
+
+    python3 rpmcache.py seed -r <rpmDir>
+    python3 rpmcache.py prune -c <packageCache> --maxGb 20
+
+seeds the local RPM directory with the pinned RPMs, or trims the package
+cache to its size bound.
+"""
+
+import argparse
+import contextlib
+import fcntl
+import os
+import sys
+
+import downloader
+
+GB = 1024 * 1024 * 1024
+DEFAULT_MAX_GB = 20
+PINNED_RPMS = {
+    'cloud_init': 'http://public.dhe.ibm.com/systems/virtualization/powervc/rhel8_cloud_init/cloud-init-19.1-8.ibm.el8.noarch.rpm',
+    'power_repo': 'http://public.dhe.ibm.com/software/server/POWER/Linux/yum/download/ibm-power-repo-latest.noarch.rpm',
+}
+# Where the caches appear inside the chroot
+CACHE_DIRS = ('/var/cache/dnf', '/var/cache/yum')
+CHROOT_RPM_DIR = '/var/local/rpms'
+REPO_FILE = '/etc/yum.repos.d/local-rpms.repo'
+
+template_repo = """[local-rpms]
+name=Local RPMs
+baseurl=file://{}
+enabled=1
+gpgcheck=0
+priority=1
+""".format(CHROOT_RPM_DIR)
+
+
+def rpm_name(url):
+    return url.rsplit('/', 1)[-1]
+
+
+def seed(rpm_dir, pool=None):
+    """Download the pinned RPMs missing from rpm_dir, return the names fetched."""
+    os.makedirs(rpm_dir, exist_ok=True)
+    fetched = []
+    for url in PINNED_RPMS.values():
+        dest = os.path.join(rpm_dir, rpm_name(url))
+        if os.path.exists(dest):
+            continue
+        downloader.download(url, dest, pool=pool)
+        fetched.append(rpm_name(url))
+    return fetched
+
+
+def pinned_sources(rpm_dir=None):
+    """Template variables of the pinned RPMs: their path in the chroot when seeded, else their URL."""
+    sources = {}
+    for key, url in PINNED_RPMS.items():
+        if rpm_dir and os.path.exists(os.path.join(rpm_dir, rpm_name(url))):
+            sources[key] = CHROOT_RPM_DIR + '/' + rpm_name(url)
+        else:
+            sources[key] = url
+    return sources
+
+
+def is_repository(rpm_dir):
+    return os.path.isfile(os.path.join(rpm_dir, 'repodata', 'repomd.xml'))
+
+
+class PackageCache:
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_GB * GB):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        for path in CACHE_DIRS:
+            os.makedirs(self.host_dir(path), exist_ok=True)
+
+    def host_dir(self, chroot_dir):
+        return os.path.join(self.root, os.path.basename(chroot_dir))
+
+    def mounts(self):
+        """(host directory, chroot directory) pairs to bind-mount."""
+        return [(self.host_dir(path), path) for path in CACHE_DIRS]
+
+    @contextlib.contextmanager
+    def use(self):
+        """Hold a shared lock while a chroot uses the cache, prune() skips it meanwhile."""
+        with open(os.path.join(self.root, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                yield self
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def prune(self):
+        """Remove the least recently used packages above max_bytes, return the size left.
+
+        Nothing is removed while another conversion uses the cache.
+        """
+        with open(os.path.join(self.root, '.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+            try:
+                files = []
+                total = 0
+                for top, _, names in os.walk(self.root):
+                    for name in names:
+                        path = os.path.join(top, name)
+                        st = os.lstat(path)
+                        total += st.st_blocks * 512
+                        if name.endswith('.rpm'):
+                            files.append((max(st.st_atime, st.st_mtime), st.st_blocks * 512, path))
+                for _, size, path in sorted(files):
+                    if total <= self.max_bytes:
+                        break
+                    os.unlink(path)
+                    total -= size
+                return total
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the package caches of the RHEL/CentOS customization")
+    sub = parser.add_subparsers(dest='command')
+    seed_parser = sub.add_parser('seed', help="Download the pinned RPMs into a local RPM directory")
+    seed_parser.add_argument('-r', '--rpmDir', dest='rpmDir', required=True, help="Local RPM directory")
+    prune_parser = sub.add_parser('prune', help="Trim the package cache to its size bound")
+    prune_parser.add_argument('-c', '--packageCache', dest='packageCache', required=True, help="Package cache directory")
+    prune_parser.add_argument('--maxGb', dest='maxGb', type=float, default=DEFAULT_MAX_GB, help="Maximum size (in GB) of the cache. Default is %(default)s GB")
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        try:
+            fetched = seed(args.rpmDir)
+        except downloader.DownloadError as e:
+            print("ERROR: Failed to download the pinned RPMs:", e)
+            sys.exit(2)
+        print("Downloaded:", ', '.join(fetched) if fetched else "nothing, all pinned RPMs are present")
+    elif args.command == 'prune':
+        left = PackageCache(args.packageCache, int(args.maxGb * GB)).prune()
+        if left is None:
+            print("Package cache is in use, not pruning it")
+        else:
+            print("Package cache size:", round(left / GB, 2), "GB")
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Subprocess execution with streamed output.
+
+Commands are given as argv lists (never through a shell). Their stdout and
+stderr are read line by line while they run and handed to a logger in real
+time; only a bounded tail of each stream is kept in memory for error
+reporting, unless the caller asks to capture the full output (e.g. to parse
+JSON). Commands can be given a timeout after which their whole process group
+is killed. The command is reaped with wait4(2), so the Result carries the
+resource usage of that command alone (with the descendants it waited for),
+not the cumulative RUSAGE_CHILDREN of the whole run.
+
+Secrets (passwords rendered into a script, API keys in an argv) given as
+redact are masked in the logged command, in the logged lines and in the
+returned output.
+"""
+
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+TAIL_LINES = 200
+KILL_GRACE = 10
+MASK = '******'
+
+logger = logging.getLogger('runner')
+
+Result = namedtuple('Result', ['stdout', 'stderr', 'returncode', 'seconds', 'timed_out', 'rusage'],
+                    defaults=[None])
+
+
+def redactor(secrets):
+    """Function masking every non-empty secret in a string."""
+    secrets = sorted((s for s in secrets or () if s), key=len, reverse=True)
+
+    def redact(text):
+        for secret in secrets:
+            text = text.replace(secret, MASK)
+        return text
+    return redact
+
+
+def _pump(stream, sink, log, prefix, redact):
+    for line in stream:
+        line = redact(line)
+        sink.append(line)
+        if log:
+            logger.info('%s%s', prefix, line.rstrip('\n'))
+    stream.close()
+
+
+def _exitcode(status):
+    # Same convention as Popen.returncode: -N when killed by signal N
+    return -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+
+def _wait4(process, timeout=None):
+    """Reap process like Popen.wait() and return its rusage, raise TimeoutExpired after timeout seconds."""
+    if process.returncode is not None:
+        return None  # already reaped
+    if timeout is None:
+        pid, status, usage = os.wait4(process.pid, 0)
+    else:
+        end = time.time() + timeout
+        delay = 0.0005
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            remaining = end - time.time()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+    process.returncode = _exitcode(status)
+    return usage
+
+
+def _kill_group(process):
+    """Kill the process group of process and reap process, return its rusage."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        return _wait4(process, KILL_GRACE)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    return _wait4(process)
+
+
+def run(argv, timeout=None, capture=False, echo=True, tail_lines=TAIL_LINES, env=None, cwd=None, redact=None):
+    """Run argv and return a Result.
+
+    echo logs the command and each output line as it arrives. Without capture
+    only the last tail_lines lines of stdout and stderr are returned. redact
+    lists the secrets to mask in what is logged and returned.
+    """
+    if isinstance(argv, str):
+        raise TypeError("run() takes an argv list, not a shell string")
+    redact = redactor(redact)
+    if echo:
+        logger.info('command: %s', redact(' '.join(argv)))
+    started = time.time()
+    try:
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                                   universal_newlines=True, env=env, cwd=cwd, start_new_session=True)
+    except OSError as e:
+        return Result('', redact('{}: {}\n'.format(argv[0], e)), 127, time.time() - started, False)
+
+    out = [] if capture else deque(maxlen=tail_lines)
+    err = [] if capture else deque(maxlen=tail_lines)
+    prefix = os.path.basename(argv[0]) + ': '
+    pumps = [threading.Thread(target=_pump, args=(process.stdout, out, echo, prefix, redact), daemon=True),
+             threading.Thread(target=_pump, args=(process.stderr, err, echo, prefix, redact), daemon=True)]
+    for pump in pumps:
+        pump.start()
+    timed_out = False
+    usage = None
+    try:
+        usage = _wait4(process, timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        usage = _kill_group(process)
+    finally:
+        if process.returncode is None:
+            _kill_group(process)
+    for pump in pumps:
+        pump.join()
+    if timed_out:
+        err.append('{} timed out after {} seconds\n'.format(argv[0], timeout))
+        logger.error('%s timed out after %s seconds', argv[0], timeout)
+    returncode = process.returncode
+    if timed_out and not returncode:
+        returncode = 124  # what timeout(1) returns
+    return Result(''.join(out), ''.join(err), returncode, time.time() - started, timed_out, usage)
+
+
+def exec_cmd(cmd, timeout=None, capture=False, echo=True, env=None, redact=None):
+    """run() returning the (stdout, stderr, returncode) triple the scripts use."""
+    result = run(cmd, timeout=timeout, capture=capture, echo=echo, env=env, redact=redact)
+    return result.stdout, result.stderr, result.returncode
+
+
+def setup_logging(level=logging.INFO):
+    """Send runner output to stdout unless the application configured logging."""
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=level, format='%(message)s', stream=sys.stdout)
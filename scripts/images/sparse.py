@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Helpers for sparse raw volumes.
+
+After `qemu-img resize` most of the raw volume is holes. These helpers find
+the allocated data extents with SEEK_DATA/SEEK_HOLE so the packaging code only
+reads the real data and can emit the holes as cheap runs of zeros.
+"""
+
+import errno
+import fcntl
+import os
+from collections import namedtuple
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+COPY_CHUNK = 64 * 1024 * 1024
+
+Extent = namedtuple('Extent', ['offset', 'length'])
+SparseInfo = namedtuple('SparseInfo', ['apparent', 'allocated', 'data'])
+
+
+def data_extents(fd, size=None):
+    """Yield the data extents of the open file fd.
+
+    Falls back to a single extent covering the whole file when the filesystem
+    does not support SEEK_DATA/SEEK_HOLE.
+    """
+    if size is None:
+        size = os.fstat(fd).st_size
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield Extent(0, size)
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return  # only a hole is left
+            if e.errno == errno.EINVAL and offset == 0:
+                yield Extent(0, size)
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if end > start:
+            yield Extent(start, end - start)
+        offset = end
+
+
+def sparse_info(path):
+    """Apparent size, allocated size and size of the data extents of path."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        data = sum(extent.length for extent in data_extents(fd, st.st_size))
+    finally:
+        os.close(fd)
+    return SparseInfo(st.st_size, st.st_blocks * 512, data)
+
+
+def read_sparse(path, chunk_size):
+    """Yield the contents of path as bytes chunks and int runs of zeros for holes."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        offset = 0
+        for extent in data_extents(fd, size):
+            if extent.offset > offset:
+                yield extent.offset - offset
+            end = extent.offset + extent.length
+            pos = extent.offset
+            while pos < end:
+                block = os.pread(fd, min(chunk_size, end - pos), pos)
+                if not block:
+                    raise OSError(errno.EIO, "{} shrank while reading at offset {}".format(path, pos))
+                yield block
+                pos += len(block)
+            offset = end
+        if size > offset:
+            yield size - offset
+    finally:
+        os.close(fd)
+
+
+def _reflink(src_fd, dst_fd):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    end = offset + length
+    while offset < end:
+        count = min(COPY_CHUNK, end - offset)
+        if hasattr(os, 'copy_file_range'):
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                copied = os.pwrite(dst_fd, os.pread(src_fd, count, offset), offset)
+        else:
+            copied = os.pwrite(dst_fd, os.pread(src_fd, count, offset), offset)
+        if copied <= 0:
+            raise OSError(errno.EIO, "short copy at offset {}".format(offset))
+        offset += copied
+
+
+def clone(src, dst, link=False):
+    """Copy src to dst keeping holes, sharing blocks with a reflink when possible.
+
+    With link, a hard link is tried before falling back to a copy; only use it
+    when neither side is ever modified in place. Returns 'reflink', 'link' or
+    'copy' depending on how the data was duplicated.
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if _reflink(src_fd, dst_fd):
+                return 'reflink'
+            if link:
+                try:
+                    os.unlink(dst)
+                    os.link(src, dst)
+                    return 'link'
+                except OSError:
+                    os.close(dst_fd)
+                    dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            size = os.fstat(src_fd).st_size
+            for extent in data_extents(src_fd, size):
+                _copy_range(src_fd, dst_fd, extent.offset, extent.length)
+            os.ftruncate(dst_fd, size)
+            return 'copy'
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
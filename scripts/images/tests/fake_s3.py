@@ -0,0 +1,126 @@
+"""In-memory stand-in for the boto3 S3 client calls of multipart.py and upload_image.py.
+
+list_parts returns at most max_parts parts per page, so the pagination of the
+callers is exercised. fail_part(number, attempt) can make an upload_part
+call raise.
+"""
+
+import hashlib
+import io
+import threading
+import time
+
+
+class ClientError(Exception):
+    """Carries the response dict of a botocore ClientError."""
+
+    def __init__(self, code, message=''):
+        super().__init__(message or code)
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class FakeS3:
+
+    def __init__(self, max_parts=2, part_delay=0.0):
+        self.max_parts = max_parts
+        self.part_delay = part_delay
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+        self.fail_part = lambda number, attempt: False
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self._attempts = {}
+        self._next_id = 0
+
+    def _call(self, name, **kwargs):
+        with self.lock:
+            self.calls.append((name, kwargs))
+
+    def count(self, name):
+        return sum(1 for call, _ in self.calls if call == name)
+
+    def put(self, key, data, metadata=None):
+        self.objects[key] = (bytes(data), dict(metadata or {}))
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None):
+        self._call('create_multipart_upload', Key=Key)
+        with self.lock:
+            self._next_id += 1
+            upload_id = 'upload-{}'.format(self._next_id)
+        self.uploads[upload_id] = {'key': Key, 'parts': {}, 'metadata': dict(Metadata or {})}
+        return {'UploadId': upload_id}
+
+    def _upload(self, key, upload_id):
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload['key'] != key:
+            raise ClientError('NoSuchUpload')
+        return upload
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._call('upload_part', PartNumber=PartNumber)
+        upload = self._upload(Key, UploadId)
+        with self.lock:
+            attempt = self._attempts.get(PartNumber, 0) + 1
+            self._attempts[PartNumber] = attempt
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.part_delay)
+            if self.fail_part(PartNumber, attempt):
+                raise ClientError('InternalError', 'part {} failed'.format(PartNumber))
+            data = bytes(Body)
+            etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+            upload['parts'][PartNumber] = (etag, data)
+            return {'ETag': etag}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        self._call('list_parts', PartNumberMarker=PartNumberMarker)
+        upload = self._upload(Key, UploadId)
+        numbers = sorted(n for n in upload['parts'] if n > PartNumberMarker)
+        page = numbers[:self.max_parts]
+        resp = {'Parts': [{'PartNumber': n, 'ETag': upload['parts'][n][0], 'Size': len(upload['parts'][n][1])}
+                          for n in page],
+                'IsTruncated': len(numbers) > len(page)}
+        if resp['IsTruncated']:
+            resp['NextPartNumberMarker'] = page[-1]
+        return resp
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._call('complete_multipart_upload', Key=Key)
+        upload = self._upload(Key, UploadId)
+        data = io.BytesIO()
+        for part in MultipartUpload['Parts']:
+            etag, body = upload['parts'][part['PartNumber']]
+            if etag != part['ETag']:
+                raise ClientError('InvalidPart')
+            data.write(body)
+        self.put(Key, data.getvalue(), upload['metadata'])
+        del self.uploads[UploadId]
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._call('abort_multipart_upload', Key=Key)
+        self.uploads.pop(UploadId, None)
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        self._call('put_object', Key=Key)
+        self.put(Key, Body, Metadata)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        self._call('head_object', Key=Key)
+        if Key not in self.objects:
+            raise ClientError('404')
+        data, metadata = self.objects[Key]
+        return {'ContentLength': len(data), 'Metadata': metadata}
+
+    def get_object(self, Bucket, Key):
+        self._call('get_object', Key=Key)
+        if Key not in self.objects:
+            raise ClientError('NoSuchKey')
+        return {'Body': io.BytesIO(self.objects[Key][0])}
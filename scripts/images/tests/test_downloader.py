@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import downloader  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+RANGE_SIZE = 64 * 1024
+DATA = os.urandom(5 * RANGE_SIZE + 1234)
+ETAG = '"v1"'
+
+
+class FileServer:
+    """Serves DATA, with Range support unless ranges is False; fail(start) can make a range request fail."""
+
+    def __init__(self, ranges=True):
+        self.ranges = ranges
+        self.lock = threading.Lock()
+        self.fetched = []
+        self.fail = lambda start: None
+
+    def __call__(self, method, path, headers, body):
+        match = re.match(r'bytes=(\d+)-(\d*)', headers.get('Range') or '')
+        if not match or not self.ranges:
+            return 200, {'ETag': ETAG}, DATA
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(DATA) - 1
+        if (start, end) != (0, 0):
+            with self.lock:
+                self.fetched.append(start)
+            failure = self.fail(start)
+            if failure:
+                return failure
+        return 206, {'ETag': ETAG, 'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(DATA))}, \
+            DATA[start:end + 1]
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.dir.name, 'image')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def download(self, url, **kwargs):
+        return downloader.download(url + '/image', self.dest, workers=3, range_size=RANGE_SIZE, **kwargs)
+
+    def test_ranged_download(self):
+        files = FileServer()
+        with StubServer(files) as server:
+            result = self.download(server.url, sha256=hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(result.size, len(DATA))
+        self.assertEqual(result.sha256, hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(sorted(files.fetched), list(range(0, len(DATA), RANGE_SIZE)))
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertFalse(os.path.exists(self.dest + '.part.json'))
+
+    def test_sha256_mismatch(self):
+        with StubServer(FileServer()) as server:
+            with self.assertRaises(downloader.DownloadError):
+                self.download(server.url, sha256='0' * 64)
+        self.assertFalse(os.path.exists(self.dest))
+
+    def test_resume_from_state_file(self):
+        files = FileServer()
+        files.fail = lambda start: (403, {}, b'') if start == 3 * RANGE_SIZE else None
+        with StubServer(files) as server:
+            with self.assertRaises(downloader.DownloadError):
+                self.download(server.url)
+            with open(self.dest + '.part.json') as f:
+                done = json.load(f)['done']
+            self.assertTrue(done)
+            self.assertNotIn(3, done)
+            files.fail = lambda start: None
+            files.fetched = []
+            result = self.download(server.url)
+        self.assertEqual(result.sha256, hashlib.sha256(DATA).hexdigest())
+        self.assertFalse(set(files.fetched) & set(index * RANGE_SIZE for index in done))
+        self.assertIn(3 * RANGE_SIZE, files.fetched)
+
+    def test_stream_without_range_support(self):
+        with StubServer(FileServer(ranges=False)) as server:
+            result = self.download(server.url)
+        self.assertEqual(result.sha256, hashlib.sha256(DATA).hexdigest())
+        self.assertFalse(os.path.exists(self.dest + '.part.json'))
+
+    def test_transient_failure_is_retried(self):
+        files = FileServer()
+        failures = []
+
+        def fail_once(start):
+            if start == RANGE_SIZE and not failures:
+                failures.append(start)
+                return 503, {'Retry-After': '0'}, b''
+        files.fail = fail_once
+        with StubServer(files) as server:
+            result = self.download(server.url)
+        self.assertEqual(failures, [RANGE_SIZE])
+        self.assertEqual(files.fetched.count(RANGE_SIZE), 2)
+        self.assertEqual(result.sha256, hashlib.sha256(DATA).hexdigest())
+
+    def test_unreachable_server(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with mock.patch.object(downloader, '_backoff') as backoff:
+            with self.assertRaises(downloader.DownloadError):
+                self.download('http://127.0.0.1:{}'.format(port))
+        self.assertEqual(backoff.call_count, downloader.MAX_RETRIES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import base64
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import downloader  # noqa: E402
+import ibmapi  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+ACCOUNT = 'acc1'
+CRN = 'crn:v1:bluemix:public:power-iaas:dal12:a/acc1:ws1::'
+
+
+def make_token(serial):
+    claims = base64.urlsafe_b64encode(json.dumps({'account': {'bss': ACCOUNT}, 'n': serial}).encode())
+    return 'h.{}.s'.format(claims.decode().rstrip('='))
+
+
+class CloudStub:
+    """IAM, user management and access groups, with the tokens it accepts and injected failures."""
+
+    def __init__(self, expires_in=3600):
+        self.expires_in = expires_in
+        self.issued = []
+        self.revoked = set()
+        self.throttle = 0
+
+    def __call__(self, method, path, headers, body):
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        if url.path == '/identity/token':
+            self.assertion(parse_qs(body.decode())['apikey'] == ['K'])
+            token = make_token(len(self.issued))
+            self.issued.append(token)
+            return 200, {}, json.dumps({'access_token': token, 'expires_in': self.expires_in}).encode()
+        token = (headers.get('Authorization') or '').replace('Bearer ', '')
+        if token not in self.issued or token in self.revoked:
+            return 401, {}, b'{"errorCode": "BXNIM0407E"}'
+        if self.throttle:
+            self.throttle -= 1
+            return 429, {'Retry-After': '0'}, b'{"message": "rate limited"}'
+        if url.path == '/v2/accounts/{}/users'.format(ACCOUNT):
+            start = int(query.get('start', ['0'])[0])
+            page = {'resources': [{'email': 'u{}@x.com'.format(n)} for n in range(start, min(start + 2, 5))]}
+            if start + 2 < 5:
+                page['next_url'] = '/v2/accounts/{}/users?limit=2&start={}'.format(ACCOUNT, start + 2)
+            return 200, {}, json.dumps(page).encode()
+        if url.path == '/v2/groups':
+            offset = int(query.get('offset', ['0'])[0])
+            page = {'groups': [{'name': 'g{}'.format(offset), 'id': 'id{}'.format(offset)}]}
+            if offset < 2:
+                page['next'] = {'href': '{}?account_id={}&offset={}'.format(self.base, ACCOUNT, offset + 1)}
+            return 200, {}, json.dumps(page).encode()
+        if url.path == '/pcloud/v1/cloud-instances/ws1/images':
+            return 200, {}, json.dumps({'images': [{'name': 'rhcos'}]}).encode()
+        if url.path.startswith('/v2/groups/id0/members/'):
+            return 204, {}, b''
+        return 404, {}, b'{}'
+
+    @staticmethod
+    def assertion(condition):
+        if not condition:
+            raise AssertionError("unexpected request")
+
+
+class ClientTest(unittest.TestCase):
+
+    def serve(self, stub):
+        server = StubServer(stub).__enter__()
+        self.addCleanup(server.__exit__)
+        stub.base = server.url + '/v2/groups'
+        self.server = server
+        client = ibmapi.Client('K', server.url)
+        self.addCleanup(client.close)
+        return client
+
+    def token_requests(self):
+        return sum(1 for request in self.server.requests if request[1] == '/identity/token')
+
+    def test_token_is_cached(self):
+        client = self.serve(CloudStub())
+        self.assertEqual(client.account, ACCOUNT)
+        client.images(CRN)
+        client.images(CRN)
+        self.assertEqual(self.token_requests(), 1)
+
+    def test_token_is_renewed_before_it_expires(self):
+        client = self.serve(CloudStub(expires_in=ibmapi.TOKEN_MARGIN - 1))
+        client.images(CRN)
+        client.images(CRN)
+        self.assertEqual(self.token_requests(), 2)
+
+    def test_pagination(self):
+        client = self.serve(CloudStub())
+        self.assertEqual([u['email'] for u in client.users()], ['u{}@x.com'.format(n) for n in range(5)])
+        self.assertEqual(client.access_groups(), {'g0': 'id0', 'g1': 'id1', 'g2': 'id2'})
+
+    def test_no_content(self):
+        client = self.serve(CloudStub())
+        self.assertEqual(client.remove_group_member('g0', 'IBMid-1'), {})
+
+    def test_rejected_token_is_renewed_once(self):
+        stub = CloudStub()
+        client = self.serve(stub)
+        client.token()
+        stub.revoked.add(stub.issued[0])
+        self.assertEqual(client.images(CRN), [{'name': 'rhcos'}])
+        self.assertEqual(self.token_requests(), 2)
+
+        stub.revoked.update(make_token(n) for n in range(10))
+        with self.assertRaises(ibmapi.ApiError) as raised:
+            client.images(CRN)
+        self.assertEqual(raised.exception.status, 401)
+        self.assertEqual(self.token_requests(), 3)
+
+    def test_throttled_request_is_retried(self):
+        stub = CloudStub()
+        client = self.serve(stub)
+        client.token()
+        stub.throttle = 2
+        with mock.patch.object(downloader, '_backoff') as backoff:
+            self.assertEqual(client.images(CRN), [{'name': 'rhcos'}])
+        self.assertEqual(backoff.call_count, 2)
+        self.assertEqual(backoff.call_args[0][1].retry_after, 0)
+
+    def test_throttling_gives_up(self):
+        stub = CloudStub()
+        client = self.serve(stub)
+        client.token()
+        stub.throttle = downloader.MAX_RETRIES + 1
+        with mock.patch.object(downloader, '_backoff') as backoff:
+            with self.assertRaises(ibmapi.ApiError) as raised:
+                client.images(CRN)
+        self.assertEqual(raised.exception.status, 429)
+        self.assertEqual(backoff.call_count, downloader.MAX_RETRIES)
+
+    def test_crn_region(self):
+        self.assertEqual(ibmapi.crn_region(CRN), 'us-south')
+        self.assertEqual(ibmapi.crn_region(CRN.replace('dal12', 'eu-de-1')), 'eu-de')
+        self.assertEqual(ibmapi.crn_region(CRN.replace('dal12', 'mad04')), 'mad')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import io
+import json
+import os
+import stat
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import create_boot_images  # noqa: E402
+import inventory  # noqa: E402
+import jobs  # noqa: E402
+
+# Stand-in for the ibmcloud CLI with the power-iaas plugin. The images of every
+# workspace are kept in $FAKE_IBMCLOUD/images.json, every call is appended to
+# $FAKE_IBMCLOUD/calls with the IBMCLOUD_HOME it ran with.
+FAKE_IBMCLOUD = r'''#!{python}
+import fcntl, json, os, sys
+root = os.environ['FAKE_IBMCLOUD']
+home = os.environ.get('IBMCLOUD_HOME', root)
+args = sys.argv[1:]
+lock = open(os.path.join(root, 'lock'), 'a')
+fcntl.flock(lock, fcntl.LOCK_EX)
+with open(os.path.join(root, 'calls'), 'a') as f:
+    f.write(json.dumps([home] + args[:2]) + '\n')
+db = os.path.join(root, 'images.json')
+images = json.load(open(db)) if os.path.exists(db) else {{}}
+if args[0] == 'login':
+    os.makedirs(home, exist_ok=True)
+    open(os.path.join(home, 'token'), 'w').close()
+    sys.exit(0)
+if not os.path.exists(os.path.join(home, 'token')):
+    sys.exit('not logged in')
+if args[:2] == ['pi', 'service-list']:
+    print(json.dumps([{{'Name': 'ws%d' % n, 'CRN': 'crn:ws%d' % n}} for n in range(3)]))
+    sys.exit(0)
+if args[:2] == ['pi', 'service-target']:
+    open(os.path.join(home, 'target'), 'w').write(args[2])
+    sys.exit(0)
+target = open(os.path.join(home, 'target')).read()
+if args[:2] == ['pi', 'images']:
+    print(json.dumps({{'Payload': {{'images': [{{'name': n, 'imageID': n + '-id'}} for n in images.get(target, [])]}}}}))
+elif args[:2] == ['pi', 'image-import']:
+    if args[2] == 'refused':
+        sys.exit('import refused')
+    images.setdefault(target, []).append(args[2])
+    json.dump(images, open(db, 'w'))
+    print(json.dumps({{'id': 'job-' + args[2]}}))
+elif args[:2] == ['pi', 'job']:
+    print(json.dumps({{'id': args[2], 'status': {{'state': 'completed'}}}}))
+else:
+    sys.exit('unknown command')
+'''
+
+MANIFEST = """
+- source: {bucket: images, object: rhcos.ova.gz, region: us-south}
+  target: {imageName: rhcos, powerVSInstances: [ws0, ws1, missing]}
+- source: {bucket: images, object: rhel.ova.gz, region: us-south}
+  target: {imageName: rhel, powerVSInstances: [ws1]}
+"""
+
+
+class FakeCliTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.root = self.dir.name
+        bin_dir = os.path.join(self.root, 'bin')
+        os.mkdir(bin_dir)
+        cli = os.path.join(bin_dir, 'ibmcloud')
+        with open(cli, 'w') as f:
+            f.write(FAKE_IBMCLOUD.format(python=sys.executable))
+        os.chmod(cli, os.stat(cli).st_mode | stat.S_IXUSR)
+        home = os.path.join(self.root, 'home')
+        env = mock.patch.dict(os.environ, {'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+                                           'FAKE_IBMCLOUD': self.root, 'IBMCLOUD_HOME': home})
+        env.start()
+        self.addCleanup(env.stop)
+        create_boot_images.ibmcloud_login('K')
+        self.cache = os.path.join(self.root, 'inventory.json')
+        self.manifest = os.path.join(self.root, 'manifest.yaml')
+        with open(self.manifest, 'w') as f:
+            f.write(MANIFEST)
+
+    def set_images(self, images):
+        with open(os.path.join(self.root, 'images.json'), 'w') as f:
+            json.dump(images, f)
+
+    def calls(self):
+        try:
+            with open(os.path.join(self.root, 'calls')) as f:
+                calls = [json.loads(line) for line in f]
+        except FileNotFoundError:
+            return []
+        os.unlink(os.path.join(self.root, 'calls'))
+        return calls
+
+    def commands(self, calls):
+        return [' '.join(call[1:]) for call in calls]
+
+    def inventory(self, ttl=inventory.DEFAULT_TTL, account='acc'):
+        return inventory.Inventory(inventory.CliBackend(create_boot_images.exec_cmd), self.cache, ttl, account)
+
+
+class InventoryTest(FakeCliTest):
+
+    def test_lookups_are_fetched_once(self):
+        self.set_images({'crn:ws1': ['rhcos']})
+        self.calls()
+        images = self.inventory()
+        self.assertEqual(images.workspace('ws1')['CRN'], 'crn:ws1')
+        self.assertEqual(images.workspace('crn:ws2')['Name'], 'ws2')
+        self.assertIsNone(images.workspace('missing'))
+        self.assertTrue(images.has_image('crn:ws1', 'rhcos'))
+        self.assertFalse(images.has_image('crn:ws1', 'rhel'))
+        self.assertEqual(self.commands(self.calls()), ['pi service-list', 'pi service-target', 'pi images'])
+        self.assertEqual(images.calls, 3)
+
+    def test_snapshot_is_reused_within_the_ttl(self):
+        self.set_images({'crn:ws1': ['rhcos']})
+        images = self.inventory()
+        images.workspace('ws1')
+        images.has_image('crn:ws1', 'rhcos')
+        images.save()
+        self.calls()
+
+        images = self.inventory()
+        self.assertEqual(images.workspace('ws1')['CRN'], 'crn:ws1')
+        self.assertTrue(images.has_image('crn:ws1', 'rhcos'))
+        self.assertEqual(self.calls(), [])
+
+        with mock.patch.object(inventory.time, 'time', return_value=images.services_fetched + 1000):
+            images = self.inventory(ttl=900)
+            images.workspace('ws1')
+            images.has_image('crn:ws1', 'rhcos')
+        self.assertEqual(self.commands(self.calls()), ['pi service-list', 'pi service-target', 'pi images'])
+
+    def test_snapshot_of_another_account_is_ignored(self):
+        images = self.inventory()
+        images.services()
+        images.save()
+        self.calls()
+        self.inventory(account='other').services()
+        self.assertEqual(self.commands(self.calls()), ['pi service-list'])
+
+    def test_imported_workspace_is_stale(self):
+        images = self.inventory()
+        images.services()
+        images.has_image('crn:ws0', 'rhcos')
+        images.has_image('crn:ws1', 'rhcos')
+        image = {'source': {'bucket': 'images', 'object': 'rhcos.ova.gz', 'region': 'us-south'},
+                 'target': {'imageName': 'rhcos'}}
+        self.assertEqual(images.default.import_image('crn:ws1', image, 'A', 'S'), 'job-rhcos')
+        self.assertTrue(images.has_image('crn:ws1', 'rhcos'))  # indexed right away
+        self.assertEqual(images.stale, {'crn:ws1'})
+        images.save()
+        with open(self.cache) as f:
+            self.assertEqual(sorted(json.load(f)['images']), ['crn:ws0'])
+        self.calls()
+
+        images = self.inventory()
+        self.assertFalse(images.has_image('crn:ws0', 'rhcos'))
+        self.assertEqual(self.calls(), [])
+        self.assertTrue(images.has_image('crn:ws1', 'rhcos'))
+        self.assertEqual(self.commands(self.calls()), ['pi service-target', 'pi images'])
+
+
+class CreateBootImagesTest(FakeCliTest):
+
+    def main(self, *args):
+        output = io.StringIO()
+        code = 0
+        with redirect_stdout(output), mock.patch.object(jobs, '_jittered', return_value=0):
+            try:
+                create_boot_images.main(['-a', 'A', '-s', 'S', '-k', 'K', '-i', self.manifest, '-c', self.cache,
+                                         '--cli'] + list(args))
+            except SystemExit as e:
+                code = e.code
+        return code, output.getvalue()
+
+    def test_parallel_imports_in_isolated_sessions(self):
+        self.calls()
+        code, output = self.main('-j', '2')
+        self.assertEqual(code, 0, output)
+        with open(os.path.join(self.root, 'images.json')) as f:
+            self.assertEqual(json.load(f), {'crn:ws0': ['rhcos'], 'crn:ws1': ['rhcos', 'rhel']})
+        self.assertIn('missing not found', output)
+        calls = self.calls()
+        homes = {call[0] for call in calls if call[1:] == ['pi', 'image-import']}
+        self.assertEqual(len(homes), 2)  # one IBMCLOUD_HOME per worker
+        self.assertNotIn(os.environ['IBMCLOUD_HOME'], homes)
+        self.assertEqual(self.commands(calls).count('pi job'), 3)
+
+        # The imported workspaces are fetched again, so the images are found
+        code, output = self.main('-j', '2')
+        self.assertEqual(code, 0, output)
+        self.assertEqual(output.count('hence skipping the image-import'), 3)
+        commands = self.commands(self.calls())
+        self.assertNotIn('pi service-list', commands)
+        self.assertNotIn('pi image-import', commands)
+
+    def test_failed_import_exits_2(self):
+        with open(self.manifest, 'w') as f:
+            f.write(MANIFEST.replace('imageName: rhel', 'imageName: refused'))
+        code, output = self.main('-j', '1', '--noWait')
+        self.assertEqual(code, 2)
+        self.assertIn('failed: refused', output)
+        self.assertNotIn('pi job', self.commands(self.calls()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import metrics  # noqa: E402
+import runner  # noqa: E402
+
+MB = 1024 * 1024
+# Touches 200 MB, so its peak RSS stands out from a bare interpreter
+BIG = [sys.executable, '-c', 'data = bytearray(200 * 1024 * 1024)']
+SMALL = [sys.executable, '-c', 'pass']
+
+
+class RunnerUsageTest(unittest.TestCase):
+
+    def test_rusage_of_the_command(self):
+        result = runner.run(BIG, echo=False)
+        self.assertEqual(result.returncode, 0)
+        self.assertGreater(result.rusage.ru_maxrss * 1024, 150 * MB)
+        result = runner.run(SMALL, echo=False)
+        self.assertLess(result.rusage.ru_maxrss * 1024, 150 * MB)
+
+    def test_exit_code_and_signal(self):
+        self.assertEqual(runner.run([sys.executable, '-c', 'raise SystemExit(3)'], echo=False).returncode, 3)
+        result = runner.run([sys.executable, '-c', 'import os; os.kill(os.getpid(), 9)'], echo=False)
+        self.assertEqual(result.returncode, -9)
+
+    def test_timeout_kills_and_reaps(self):
+        result = runner.run([sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.5, echo=False)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncode, -15)
+        self.assertIsNotNone(result.rusage)
+        self.assertLess(result.seconds, 10)
+
+    def test_command_not_found(self):
+        result = runner.run(['/nonexistent/command'], echo=False)
+        self.assertEqual(result.returncode, 127)
+        self.assertIsNone(result.rusage)
+
+
+class RecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'metrics.jsonl')
+        self.recorder = metrics.Recorder(self.path, os.path.join(self.dir.name, 'metrics.prom'))
+
+    def run_command(self, argv):
+        snap = metrics.snapshot()
+        result = runner.run(argv, echo=False)
+        self.recorder.command(argv, result.returncode, snap[0], snap[1], result.rusage)
+
+    def test_peak_rss_is_per_command_and_per_stage(self):
+        with self.recorder.stage('big'):
+            self.run_command(BIG)
+        with self.recorder.stage('small'):
+            self.run_command(SMALL)
+        self.recorder.write_prometheus()
+        self.recorder.jsonl.close()
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+        commands = [r for r in records if r['type'] == 'command']
+        stages = {r['stage']: r for r in records if r['type'] == 'stage'}
+        self.assertGreater(commands[0]['children_max_rss_bytes'], 150 * MB)
+        # RUSAGE_CHILDREN would still report the 200 MB of the first command here
+        self.assertLess(commands[1]['children_max_rss_bytes'], 150 * MB)
+        self.assertEqual(stages['big']['children_max_rss_bytes'], commands[0]['children_max_rss_bytes'])
+        self.assertEqual(stages['small']['children_max_rss_bytes'], commands[1]['children_max_rss_bytes'])
+        self.assertGreater(stages['big']['children_cpu_user_seconds'] + stages['big']['children_cpu_system_seconds'],
+                           0)
+
+    def test_stage_without_commands(self):
+        with self.recorder.stage('inline'):
+            pass
+        self.assertEqual(self.recorder.stages[0]['children_max_rss_bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
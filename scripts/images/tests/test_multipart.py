@@ -0,0 +1,173 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import multipart  # noqa: E402
+from fake_s3 import FakeS3  # noqa: E402
+
+PART_SIZE = 64 * 1024
+DATA = os.urandom(10 * PART_SIZE + 4321)
+PARTS = 11
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class PartSizeTest(unittest.TestCase):
+
+    def test_bounds(self):
+        for size in (0, 1, multipart.MIN_PART_SIZE * 3, 100 * 1024 ** 3, 5 * 1024 ** 4):
+            part = multipart.choose_part_size(size)
+            self.assertEqual(part % multipart.MB, 0)
+            self.assertGreaterEqual(part, multipart.MIN_PART_SIZE)
+            self.assertLessEqual(-(-size // part), multipart.MAX_PARTS)
+
+
+class TunerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(multipart, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def window(self, tuner, count):
+        self.clock.now += multipart.TUNE_SECONDS
+        tuner.record(count)
+
+    def test_grows_while_the_rate_grows_within_bounds(self):
+        tuner = multipart._Tuner(2, 2, 5)
+        for count in range(1, 10):
+            self.window(tuner, count * multipart.MB)
+            self.assertLessEqual(tuner.concurrency, 5)
+        self.assertEqual(tuner.concurrency, 5)
+
+    def test_backs_off_when_the_rate_drops(self):
+        tuner = multipart._Tuner(4, 2, 8)
+        self.window(tuner, 10 * multipart.MB)
+        self.assertEqual(tuner.concurrency, 5)
+        self.window(tuner, 5 * multipart.MB)
+        self.assertEqual(tuner.concurrency, 4)
+        for _ in range(5):
+            self.window(tuner, 5 * multipart.MB)
+        self.assertEqual(tuner.concurrency, 2)
+
+    def test_waits_for_a_full_window(self):
+        tuner = multipart._Tuner(3, 2, 8)
+        self.clock.now += multipart.TUNE_SECONDS / 2
+        tuner.record(multipart.MB)
+        self.assertEqual(tuner.concurrency, 3)
+
+
+class UploadFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'image.ova.gz')
+        with open(self.path, 'wb') as f:
+            f.write(DATA)
+        self.state = multipart.state_path_for(self.path)
+        self.s3 = FakeS3()
+
+    def uploader(self, **kwargs):
+        kwargs.setdefault('state_path', self.state)
+        return multipart.MultipartUploader(self.s3, 'bucket', 'image.ova.gz', part_size=PART_SIZE,
+                                           metadata={'sha256': 'x'}, progress=False, **kwargs)
+
+    def test_upload(self):
+        result = self.uploader().upload_file(self.path)
+        self.assertEqual(self.s3.objects['image.ova.gz'], (DATA, {'sha256': 'x'}))
+        self.assertEqual((result.bytes, result.parts, result.resumed_bytes), (len(DATA), PARTS, 0))
+        self.assertFalse(os.path.exists(self.state))
+
+    def test_parts_in_flight_stay_within_max_concurrency(self):
+        self.s3.part_delay = 0.02
+        with mock.patch.object(multipart, 'TUNE_SECONDS', 0):
+            result = self.uploader(max_concurrency=3).upload_file(self.path)
+        self.assertLessEqual(self.s3.max_in_flight, 3)
+        self.assertLessEqual(result.concurrency, 3)
+        self.assertEqual(self.s3.objects['image.ova.gz'][0], DATA)
+
+    def test_resume_from_state_file(self):
+        self.s3.fail_part = lambda number, attempt: number == 7
+        with mock.patch.object(multipart, 'MAX_RETRIES', 0):
+            with self.assertRaises(multipart.UploadError):
+                self.uploader().upload_file(self.path)
+        with open(self.state) as f:
+            state = json.load(f)
+        done = sorted(int(n) for n in state['parts'])
+        self.assertTrue(done)
+        self.assertNotIn(7, done)
+        # A part the server doesn't have with that ETag is uploaded again
+        state['parts'][str(done[0])] = '"stale"'
+        with open(self.state, 'w') as f:
+            json.dump(state, f)
+
+        self.s3.fail_part = lambda number, attempt: False
+        self.s3.calls = []
+        result = self.uploader().upload_file(self.path)
+        self.assertEqual(self.s3.count('create_multipart_upload'), 0)
+        uploaded = sorted(kwargs['PartNumber'] for name, kwargs in self.s3.calls if name == 'upload_part')
+        self.assertEqual(uploaded, sorted(set(range(1, PARTS + 1)) - set(done[1:])))
+        self.assertGreater(self.s3.count('list_parts'), 1)  # paginated
+        self.assertEqual(result.resumed_bytes, len(done[1:]) * PART_SIZE)
+        self.assertEqual(self.s3.objects['image.ova.gz'][0], DATA)
+        self.assertFalse(os.path.exists(self.state))
+
+    def test_state_of_a_changed_file_is_ignored(self):
+        self.s3.fail_part = lambda number, attempt: number == 3
+        with mock.patch.object(multipart, 'MAX_RETRIES', 0):
+            with self.assertRaises(multipart.UploadError):
+                self.uploader().upload_file(self.path)
+        self.s3.fail_part = lambda number, attempt: False
+        os.utime(self.path, ns=(0, 0))
+        self.s3.calls = []
+        result = self.uploader().upload_file(self.path)
+        self.assertEqual(self.s3.count('create_multipart_upload'), 1)
+        self.assertEqual(result.resumed_bytes, 0)
+        self.assertEqual(self.s3.objects['image.ova.gz'][0], DATA)
+
+    def test_transient_part_failure_is_retried(self):
+        self.s3.fail_part = lambda number, attempt: number == 2 and attempt == 1
+        with mock.patch.object(multipart.time, 'sleep'):
+            self.uploader(state_path=None).upload_file(self.path)
+        self.assertEqual(self.s3.objects['image.ova.gz'][0], DATA)
+
+
+class MultipartWriterTest(unittest.TestCase):
+
+    def test_stream(self):
+        s3 = FakeS3()
+        with multipart.MultipartWriter(s3, 'bucket', 'stream', part_size=PART_SIZE, concurrency=2,
+                                       progress=False) as writer:
+            writer.write(DATA[:1000])
+            writer.write_zeros(3 * PART_SIZE)
+            writer.write(DATA[1000:])
+        expected = DATA[:1000] + bytes(3 * PART_SIZE) + DATA[1000:]
+        self.assertEqual(s3.objects['stream'][0], expected)
+        self.assertEqual(writer.result.parts, -(-len(expected) // PART_SIZE))
+
+    def test_failure_aborts(self):
+        s3 = FakeS3()
+        with self.assertRaises(RuntimeError):
+            with multipart.MultipartWriter(s3, 'bucket', 'stream', part_size=PART_SIZE, progress=False) as writer:
+                writer.write(DATA)
+                raise RuntimeError("compressor failed")
+        self.assertEqual(s3.count('abort_multipart_upload'), 1)
+        self.assertNotIn('stream', s3.objects)
+        self.assertFalse(s3.uploads)
+
+
+if __name__ == '__main__':
+    unittest.main()
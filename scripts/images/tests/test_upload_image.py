@@ -0,0 +1,106 @@
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import upload_image  # noqa: E402
+from fake_s3 import FakeS3  # noqa: E402
+
+DATA = os.urandom(300 * 1024)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class UploadOneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'image.ova.gz')
+        with open(self.path, 'wb') as f:
+            f.write(DATA)
+        self.s3 = FakeS3()
+        self.args = argparse.Namespace(force=False, partSize=None, concurrency=None, noResume=False)
+        local_sha256 = upload_image.local_sha256
+
+        def hashing(*args):
+            self.s3.calls.append(('hash', {'background': len(args) > 1}))
+            return local_sha256(*args)
+        patcher = mock.patch.object(upload_image, 'local_sha256', side_effect=hashing)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self):
+        item = upload_image.Upload(self.path, 'image.ova.gz')
+        return upload_image.upload_one(self.s3, 'bucket', item, self.args, 4)
+
+    def calls(self, *names):
+        return [(name, kwargs) for name, kwargs in self.s3.calls if name in names]
+
+    def write_sidecar(self, digest):
+        with open(self.path + '.sha256', 'w') as f:
+            f.write(digest + '  image.ova.gz\n')
+
+    def test_missing_object_is_hashed_while_uploading(self):
+        self.assertEqual(self.upload().status, 'uploaded')
+        self.assertEqual(self.s3.objects['image.ova.gz'], (DATA, {}))
+        self.assertEqual(self.s3.objects['image.ova.gz.sha256'][0], (SHA256 + '  image.ova.gz\n').encode())
+        self.assertEqual(self.calls('head_object', 'hash')[0][0], 'head_object')
+        self.assertEqual(self.calls('hash'), [('hash', {'background': True})])
+
+    def test_sidecar_is_stored_in_the_metadata(self):
+        self.write_sidecar(SHA256)
+        self.assertEqual(self.upload().status, 'uploaded')
+        self.assertEqual(self.s3.objects['image.ova.gz'], (DATA, {'sha256': SHA256}))
+        self.assertNotIn('image.ova.gz.sha256', self.s3.objects)
+        self.assertEqual(self.calls('hash'), [])
+
+    def test_identical_object_is_skipped(self):
+        self.s3.put('image.ova.gz', DATA, {'sha256': SHA256})
+        self.assertEqual(self.upload().status, 'skipped')
+        self.assertEqual(self.s3.count('create_multipart_upload'), 0)
+        self.assertEqual([name for name, _ in self.calls('head_object', 'hash')], ['head_object', 'hash'])
+
+    def test_checksum_object_of_a_streamed_upload(self):
+        self.s3.put('image.ova.gz', DATA)
+        self.s3.put('image.ova.gz.sha256', (SHA256 + '  image.ova.gz\n').encode())
+        self.assertEqual(self.upload().status, 'skipped')
+
+    def test_other_size_is_uploaded_without_reading_the_file_first(self):
+        self.s3.put('image.ova.gz', DATA[:1000], {'sha256': '0' * 64})
+        self.s3.put('image.ova.gz.sha256', b'0' * 64)
+        self.assertEqual(self.upload().status, 'uploaded')
+        self.assertEqual(self.calls('get_object'), [])
+        self.assertEqual(self.calls('hash'), [('hash', {'background': True})])
+        self.assertEqual(self.s3.objects['image.ova.gz'][0], DATA)
+
+    def test_other_sha256_is_uploaded(self):
+        self.s3.put('image.ova.gz', DATA, {'sha256': '0' * 64})
+        self.assertEqual(self.upload().status, 'uploaded')
+        self.assertEqual(self.s3.objects['image.ova.gz'][1], {'sha256': SHA256})
+
+    def test_object_without_sha256_is_not_hashed_before_the_upload(self):
+        self.s3.put('image.ova.gz', DATA)
+        self.assertEqual(self.upload().status, 'uploaded')
+        self.assertEqual(self.calls('hash'), [('hash', {'background': True})])
+
+    def test_failed_upload_stops_the_hashing(self):
+        self.s3.fail_part = lambda number, attempt: True
+        with mock.patch.object(upload_image.multipart, 'MAX_RETRIES', 0):
+            item = self.upload()
+        self.assertEqual(item.status, 'failed')
+        self.assertNotIn('image.ova.gz.sha256', self.s3.objects)
+
+    def test_force(self):
+        self.s3.put('image.ova.gz', DATA, {'sha256': SHA256})
+        self.write_sidecar(SHA256)
+        self.args.force = True
+        self.assertEqual(self.upload().status, 'uploaded')
+        self.assertEqual(self.s3.count('head_object'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import hashlib
+import os
 import platform
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import multipart
+
+HASH_CHUNK = 8 * 1024 * 1024
+
+help_epilog = """Example manifest file (-m), object defaults to the file name:
+---
+- file: rhcos-454-ppc64le.ova.gz
+  object: rhcos-454-ppc64le.ova.gz
+- file: /data/rhel-82u2-ppc64le.ova.gz
+"""
 
 
 def upload_object_aspera(cos, bucket, file_name, object_name):
@@ -19,9 +35,172 @@ def upload_object_aspera(cos, bucket, file_name, object_name):
         future.result()
 
 
+def upload_object(s3, bucket, file_name, object_name, part_size=None, concurrency=None,
+                  max_concurrency=multipart.MAX_CONCURRENCY, resume=True, metadata=None):
+    # Tuned multipart upload, resumable through a state file next to the image
+    state_path = multipart.state_path_for(file_name) if resume else None
+    uploader = multipart.MultipartUploader(s3, bucket, object_name, part_size=part_size, concurrency=concurrency,
+                                           max_concurrency=max_concurrency, metadata=metadata,
+                                           state_path=state_path)
+    return uploader.upload_file(file_name)
+
+
+def sidecar_sha256(file_name):
+    """sha256 of file_name from its up to date <file>.sha256 sidecar, None when there is none."""
+    sidecar = file_name + '.sha256'
+    try:
+        if os.stat(sidecar).st_mtime >= os.stat(file_name).st_mtime:
+            with open(sidecar) as f:
+                digest = f.read().split()[0].lower()
+            if len(digest) == 64:
+                return digest
+    except (OSError, IndexError):
+        pass
+    return None
+
+
+def local_sha256(file_name, stop=None):
+    """sha256 of file_name, read from its up to date <file>.sha256 sidecar when there is one.
+
+    Returns None when the stop event is set before the whole file is read.
+    """
+    digest = sidecar_sha256(file_name)
+    if digest:
+        return digest
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            if stop is not None and stop.is_set():
+                return None
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _not_found(e):
+    # botocore raises a ClientError carrying the HTTP status for a missing object
+    return getattr(e, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def remote_sha256(s3, bucket, object_name, size=None):
+    """(size, sha256) of an object, sha256 is None when unknown, None when there is no object.
+
+    When the object isn't size bytes long its sha256 isn't looked up.
+    """
+    try:
+        head = s3.head_object(Bucket=bucket, Key=object_name)
+    except Exception as e:
+        if _not_found(e):
+            return None
+        raise
+    digest = head.get('Metadata', {}).get('sha256')
+    if digest is None and size in (None, head['ContentLength']):
+        # Images uploaded while they were produced have their checksum in a <object>.sha256 object
+        try:
+            body = s3.get_object(Bucket=bucket, Key=object_name + '.sha256')['Body'].read()
+            digest = body.decode().split()[0].lower()
+        except Exception as e:
+            if not _not_found(e):
+                raise
+    return head['ContentLength'], digest
+
+
+class Upload:
+
+    def __init__(self, file_name, object_name):
+        self.file = file_name
+        self.object = object_name
+        self.size = 0
+        self.status = 'pending'
+        self.seconds = 0.0
+        self.error = None
+
+
+def upload_one(s3, bucket, item, args, max_concurrency):
+    started = time.time()
+    try:
+        item.size = os.path.getsize(item.file)
+        digest = sidecar_sha256(item.file)
+        if not args.force:
+            # The file is only read to compare it with an object of its size and known sha256
+            remote = remote_sha256(s3, bucket, item.object, item.size)
+            if remote and remote[0] == item.size and remote[1]:
+                digest = digest or local_sha256(item.file)
+                if remote[1] == digest:
+                    print("Skipping", item.file, ":", item.object, "is identical (sha256", digest + ")")
+                    item.status = 'skipped'
+                    return item
+        part_size = args.partSize * multipart.MB if args.partSize else None
+        if digest:
+            upload_object(s3, bucket, item.file, item.object, part_size, args.concurrency, max_concurrency,
+                          not args.noResume, {'sha256': digest})
+        else:
+            # Hashed while the parts are uploaded, recorded in <object>.sha256 like a streamed upload
+            stop = threading.Event()
+            with ThreadPoolExecutor(max_workers=1) as hasher:
+                hashing = hasher.submit(local_sha256, item.file, stop)
+                try:
+                    upload_object(s3, bucket, item.file, item.object, part_size, args.concurrency,
+                                  max_concurrency, not args.noResume)
+                except BaseException:
+                    stop.set()
+                    raise
+                digest = hashing.result()
+            s3.put_object(Bucket=bucket, Key=item.object + '.sha256',
+                          Body='{}  {}\n'.format(digest, os.path.basename(item.file)).encode())
+        item.status = 'uploaded'
+    except Exception as e:  # boto3 raises many unrelated exception types, keep uploading the other files
+        print("ERROR: Failed to upload", item.file, ":", e)
+        if isinstance(e, multipart.UploadError) and not args.noResume:
+            print("Run the same command again to resume the upload")
+        item.status = 'failed'
+        item.error = str(e)
+    finally:
+        item.seconds = time.time() - started
+    return item
+
+
+def upload_files(s3, bucket, items, args):
+    """Upload items with up to args.maxJobs files in flight, sharing the parts in flight of the client."""
+    jobs = max(1, min(args.maxJobs, len(items)))
+    max_concurrency = max(multipart.MIN_CONCURRENCY, args.maxConcurrency // jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(lambda item: upload_one(s3, bucket, item, args, max_concurrency), items))
+
+
+def load_manifest(manifest):
+    import yaml
+    with open(manifest) as f:
+        data = yaml.load(f, Loader=yaml.FullLoader)
+    if not isinstance(data, list):
+        raise ValueError("{} must hold a list of files".format(manifest))
+    items = []
+    for entry in data:
+        if not isinstance(entry, dict) or 'file' not in entry:
+            raise ValueError("every entry of {} needs a file".format(manifest))
+        items.append(Upload(entry['file'], entry.get('object', os.path.basename(entry['file']))))
+    return items
+
+
+def print_summary(items, seconds):
+    print("\n{:<40} {:>9} {:>12} {:>10} {:>10}".format("OBJECT", "STATUS", "SIZE(MB)", "SECONDS", "MB/s"))
+    totals = {'uploaded': [0, 0], 'skipped': [0, 0], 'failed': [0, 0]}
+    for item in items:
+        mb = item.size / multipart.MB
+        rate = mb / item.seconds if item.status == 'uploaded' and item.seconds else 0.0
+        totals[item.status][0] += 1
+        totals[item.status][1] += item.size
+        print("{:<40} {:>9} {:>12.1f} {:>10.1f} {:>10.1f}".format(item.object, item.status, mb, item.seconds, rate))
+    uploaded_mb = totals['uploaded'][1] / multipart.MB
+    print("Uploaded {} files, {:.1f} MB in {:.1f} seconds ({:.1f} MB/s), skipped {} identical files, {:.1f} MB, "
+          "{} failed".format(totals['uploaded'][0], uploaded_mb, seconds, uploaded_mb / seconds if seconds else 0.0,
+                             totals['skipped'][0], totals['skipped'][1] / multipart.MB, totals['failed'][0]))
+
+
 def main():
     parser = argparse.ArgumentParser(
-        epilog="Note: Create a Service credential in the COS to get the apikey and the resource_instance_id")
+        epilog="Note: Create a Service credential in the COS to get the apikey and the resource_instance_id\n\n"
+               + help_epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("-b", "--bucket",
                         help="Bucket name",
                         required=True)
@@ -29,11 +208,17 @@ def main():
                         help="Bucket's region(e.g: us-south)",
                         required=True)
     parser.add_argument("-f", "--file",
-                        help="Input file to be uploaded",
-                        required=True)
+                        help="Input file to be uploaded(required unless --manifest set)")
     parser.add_argument("-o", "--object",
-                        help="Target object name to be created in the bucket",
-                        required=True)
+                        help="Target object name to be created in the bucket(required unless --manifest set)")
+    parser.add_argument("-m", "--manifest",
+                        help="YAML file listing the files to upload and their object names")
+    parser.add_argument("-j", "--maxJobs", type=int, default=4,
+                        help="Maximum number of files uploaded concurrently with --manifest. Default is %(default)s")
+    parser.add_argument("--force",
+                        help="Upload even when the object already has the size and sha256 of the file",
+                        action="store_true",
+                        default=False)
     parser.add_argument("-a", "--accesskey",
                         help="Storage Bucket's Access Key ID(not required if --aspera set")
     parser.add_argument("-s", "--secret",
@@ -46,8 +231,25 @@ def main():
                         help="IBM Cloud API Key(required if --aspera set)")
     parser.add_argument("-i", "--instanceid",
                         help="IBM COS resource instance ID(required if --aspera set)")
+    parser.add_argument("--endpoint",
+                        help="S3 endpoint URL, defaults to the COS endpoint of the region "
+                             "(e.g: http://localhost:9000 for a local S3 compatible server)")
+    parser.add_argument("--partSize", type=int,
+                        help="Multipart part size in MB, defaults to a size derived from the file size")
+    parser.add_argument("--concurrency", type=int,
+                        help="Fixed number of parts uploaded in parallel, tuned from the throughput by default")
+    parser.add_argument("--maxConcurrency", type=int, default=multipart.MAX_CONCURRENCY,
+                        help="Upper bound of the tuned number of parallel parts. Default is %(default)s")
+    parser.add_argument("--noResume",
+                        help="Don't record the upload progress in <file>.upload.json nor resume from it",
+                        action="store_true",
+                        default=False)
 
     args = parser.parse_args()
+    if args.manifest and args.aspera:
+        parser.error("--manifest isn't supported with --aspera")
+    if not args.manifest and (not args.file or not args.object):
+        parser.error("-f/--file and -o/--object are required unless --manifest is set")
     if args.aspera:
         print("Aspera option is set..")
         if platform.machine() != "x86_64" or platform.system() != "Linux":
@@ -67,14 +269,21 @@ def main():
         upload_object_aspera(cos, args.bucket, args.file, args.object)
     else:
         print("Aspera option is not set, continuing with normal boto3 client..")
-        import boto3
-        s3 = boto3.client('s3',
-                          endpoint_url='https://s3.' + args.region + '.cloud-object-storage.appdomain.cloud/',
-                          region_name=args.region,
-                          aws_access_key_id=args.accesskey,
-                          aws_secret_access_key=args.secret)
-        with open(args.file, "rb") as f:
-            s3.upload_fileobj(f, args.bucket, args.object)
+        if args.manifest:
+            try:
+                items = load_manifest(args.manifest)
+            except (OSError, ValueError) as e:
+                print("ERROR: Failed to read the manifest:", e)
+                sys.exit(2)
+        else:
+            items = [Upload(args.file, args.object)]
+        # One client, its connection pool is shared by all the files in flight
+        s3 = multipart.cos_client(args.region, args.accesskey, args.secret, args.endpoint, args.maxConcurrency)
+        started = time.time()
+        items = upload_files(s3, args.bucket, items, args)
+        print_summary(items, time.time() - started)
+        if any(item.status == 'failed' for item in items):
+            sys.exit(2)
 
 
 if __name__ == '__main__':